@@ -0,0 +1,509 @@
+# coding: utf-8
+
+"""
+Helpers and compiled kernels operating on flat buffers and offsets of ragged arrays.
+"""
+
+from __future__ import annotations
+
+__all__ = [
+    "get_offsets", "any_within_delta_r", "all_beyond_delta_r", "flat_argsort", "masked_argsort",
+    "masked_top_k", "take_padded", "padded_to_ragged", "ragged_isin", "unique_delta_r_match",
+    "match_pairs", "chain_delta_r_matches",
+]
+
+from typing import Sequence
+
+from columnflow.util import DotDict, maybe_import
+from columnflow.columnar_util import EMPTY_FLOAT, flat_np_view, layout_ak_array
+
+from hbt.util import njit
+
+
+np = maybe_import("numpy")
+ak = maybe_import("awkward")
+
+
+def get_offsets(array: ak.Array) -> np.ndarray:
+    """
+    Returns the int64 offsets of the first ragged dimension of *array*, i.e., an array of length
+    ``len(array) + 1`` starting at zero and containing the cumulative number of elements per entry.
+    """
+    counts = np.asarray(ak.num(array, axis=1))
+    offsets = np.zeros(len(counts) + 1, dtype=np.int64)
+    np.cumsum(counts, out=offsets[1:])
+    return offsets
+
+
+@njit
+def _delta_r_match(
+    offsets1: np.ndarray,
+    eta1: np.ndarray,
+    phi1: np.ndarray,
+    offsets2: np.ndarray,
+    eta2: np.ndarray,
+    phi2: np.ndarray,
+    threshold: float,
+    inclusive: bool,
+) -> np.ndarray:
+    """
+    Kernel that decides for each object in the first collection whether there is at least one
+    object in the second collection of the same event with a delta R below (or equal to, when
+    *inclusive* is *True*) *threshold*. Loops over partners exit early at the first match.
+    """
+    out = np.zeros(len(eta1), dtype=np.bool_)
+
+    for i in range(len(offsets1) - 1):
+        for j in range(offsets1[i], offsets1[i + 1]):
+            for k in range(offsets2[i], offsets2[i + 1]):
+                deta = eta1[j] - eta2[k]
+                dphi = (phi1[j] - phi2[k] + np.pi) % (2 * np.pi) - np.pi
+                dr = np.sqrt(deta**2 + dphi**2)
+                if dr < threshold or (inclusive and dr == threshold):
+                    out[j] = True
+                    break
+
+    return out
+
+
+def _delta_r_match_wrapper(
+    objects1: ak.Array,
+    objects2: ak.Array,
+    threshold: float,
+    inclusive: bool,
+) -> ak.Array:
+    out = _delta_r_match(
+        get_offsets(objects1),
+        flat_np_view(objects1.eta, axis=1),
+        flat_np_view(objects1.phi, axis=1),
+        get_offsets(objects2),
+        flat_np_view(objects2.eta, axis=1),
+        flat_np_view(objects2.phi, axis=1),
+        float(threshold),
+        inclusive,
+    )
+    return layout_ak_array(out, objects1.eta)
+
+
+def any_within_delta_r(objects1: ak.Array, objects2: ak.Array, threshold: float) -> ak.Array:
+    """
+    Returns a mask with the same shape as the ragged collection *objects1* denoting whether there is
+    at least one object in *objects2* (same number of events) with a delta R below *threshold*.
+    Both collections must provide *eta* and *phi* fields. Equivalent to
+
+    .. code-block:: python
+
+        ak.any(objects1.metric_table(objects2) < threshold, axis=2)
+
+    but without materializing the table of all distances.
+    """
+    return _delta_r_match_wrapper(objects1, objects2, threshold, False)
+
+
+def all_beyond_delta_r(objects1: ak.Array, objects2: ak.Array, threshold: float) -> ak.Array:
+    """
+    Returns a mask with the same shape as the ragged collection *objects1* denoting whether all
+    objects in *objects2* (same number of events) have a delta R above *threshold*. Equivalent to
+
+    .. code-block:: python
+
+        ak.all(objects1.metric_table(objects2) > threshold, axis=2)
+
+    but without materializing the table of all distances.
+    """
+    return ~_delta_r_match_wrapper(objects1, objects2, threshold, True)
+
+
+def _flat_sort_keys(
+    keys: ak.Array | Sequence[ak.Array],
+    ascending: bool,
+) -> tuple[np.ndarray, list[np.ndarray]]:
+    """
+    Returns the offsets and flat float64 buffers of one or multiple ragged sort *keys*, negated
+    unless *ascending* is *True* so that the larger values come first in an ascending sort.
+    """
+    if not isinstance(keys, (list, tuple)):
+        keys = [keys]
+    offsets = get_offsets(keys[0])
+    flat_keys = [flat_np_view(key, axis=1).astype(np.float64) for key in keys]
+    if not ascending:
+        flat_keys = [-key for key in flat_keys]
+    return offsets, flat_keys
+
+
+@njit
+def _less(keys: np.ndarray, i: int, j: int) -> bool:
+    """
+    Returns whether element *i* is strictly smaller than element *j* when comparing *keys* with
+    shape ``(n_elements, n_keys)`` lexicographically.
+    """
+    for c in range(keys.shape[1]):
+        if keys[i, c] != keys[j, c]:
+            return keys[i, c] < keys[j, c]
+    return False
+
+
+@njit
+def _segment_argsort(offsets: np.ndarray, keys: np.ndarray, mask: np.ndarray) -> np.ndarray:
+    """
+    Kernel that returns flat positions of elements passing *mask*, sorted by *keys* with shape
+    ``(n_elements, n_keys)`` within each event in ascending, lexicographic order. Events are kept in
+    order and equal elements keep their original order. Uses insertion sort, which is efficient for
+    the short lists found in events.
+    """
+    out = np.empty(mask.sum(), dtype=np.int64)
+    n = 0
+
+    for e in range(len(offsets) - 1):
+        start = n
+        for i in range(offsets[e], offsets[e + 1]):
+            if not mask[i]:
+                continue
+            pos = n
+            while pos > start and _less(keys, i, out[pos - 1]):
+                out[pos] = out[pos - 1]
+                pos -= 1
+            out[pos] = i
+            n += 1
+
+    return out
+
+
+def flat_argsort(keys: ak.Array | Sequence[ak.Array], ascending: bool = False) -> np.ndarray:
+    """
+    Returns positions in the flat buffer of ragged *keys* that sort elements within each event,
+    keeping events in order. When *keys* is a sequence of arrays with the same layout, elements are
+    ordered lexicographically with the first key being the most significant one. The sort is stable,
+    and the result can be passed as *flat_order* to :py:func:`masked_argsort` to reuse it for
+    different masks.
+    """
+    offsets, flat_keys = _flat_sort_keys(keys, ascending)
+    return _segment_argsort(offsets, np.stack(flat_keys, axis=1), np.ones(offsets[-1], dtype=bool))
+
+
+def masked_argsort(
+    keys: ak.Array | Sequence[ak.Array],
+    mask: ak.Array | None = None,
+    ascending: bool = False,
+    flat_order: np.ndarray | None = None,
+) -> ak.Array:
+    """
+    Returns ragged local indices of elements passing *mask* ordered by one or multiple *keys* (see
+    :py:func:`flat_argsort`), but only sorting elements that pass the mask. Equivalent to
+
+    .. code-block:: python
+
+        sorted_indices = ak.argsort(keys, axis=1, ascending=ascending)
+        sorted_indices[mask[sorted_indices]]
+
+    When a precomputed *flat_order* is given, no sorting takes place.
+    """
+    offsets, flat_keys = _flat_sort_keys(keys, ascending)
+    if mask is None:
+        flat_mask = np.ones(offsets[-1], dtype=bool)
+    else:
+        flat_mask = flat_np_view(mask, axis=1)
+
+    if flat_order is None:
+        pos = _segment_argsort(offsets, np.stack(flat_keys, axis=1), flat_mask)
+    else:
+        pos = flat_order[flat_mask[flat_order]]
+
+    # number of passing elements per event
+    n_passed = np.zeros(len(flat_mask) + 1, dtype=np.int64)
+    np.cumsum(flat_mask, out=n_passed[1:])
+    counts = n_passed[offsets[1:]] - n_passed[offsets[:-1]]
+
+    return ak.unflatten(pos - np.repeat(offsets[:-1], counts), counts)
+
+
+@njit
+def _top_k(offsets: np.ndarray, keys: np.ndarray, mask: np.ndarray, k: int) -> np.ndarray:
+    """
+    Kernel that selects per event the local indices of the *k* elements passing *mask* with the
+    smallest *keys*, given with shape ``(n_elements, n_keys)`` and compared lexicographically, in
+    ascending order. Equal elements keep their original order. Missing slots are set to -1.
+    """
+    n_events = len(offsets) - 1
+    out = np.full((n_events, k), -1, dtype=np.int64)
+
+    for e in range(n_events):
+        n = 0
+        for i in range(offsets[e], offsets[e + 1]):
+            if not mask[i]:
+                continue
+            # find the insertion slot, moving up while the new element is strictly smaller
+            pos = n
+            while pos > 0 and _less(keys, i, offsets[e] + out[e, pos - 1]):
+                pos -= 1
+            if pos >= k:
+                continue
+            # shift larger elements down and insert
+            for s in range(min(n, k - 1), pos, -1):
+                out[e, s] = out[e, s - 1]
+            out[e, pos] = i - offsets[e]
+            n = min(n + 1, k)
+
+    return out
+
+
+def masked_top_k(
+    keys: ak.Array | Sequence[ak.Array],
+    k: int,
+    mask: ak.Array | None = None,
+    ascending: bool = False,
+) -> np.ndarray:
+    """
+    Returns the local indices of the first *k* elements passing *mask* when ordered by one or
+    multiple *keys* (see :py:func:`flat_argsort`) as an array of shape ``(n_events, k)``, padded
+    with -1. Elements are selected in a single pass without sorting, which is preferred over
+    :py:func:`masked_argsort` for small *k*. Use :py:func:`take_padded` to obtain values and
+    :py:func:`padded_to_ragged` to obtain ragged indices.
+    """
+    offsets, flat_keys = _flat_sort_keys(keys, ascending)
+    if mask is None:
+        flat_mask = np.ones(offsets[-1], dtype=bool)
+    else:
+        flat_mask = flat_np_view(mask, axis=1)
+    return _top_k(offsets, np.stack(flat_keys, axis=1), flat_mask, int(k))
+
+
+def take_padded(array: ak.Array, indices: np.ndarray, fill_value: float | int) -> np.ndarray:
+    """
+    Returns values of the ragged *array* at local *indices* with shape ``(n_events, k)``, using
+    *fill_value* for padded slots that are marked by -1.
+    """
+    flat = flat_np_view(array, axis=1)
+    out = np.full(indices.shape, fill_value, dtype=flat.dtype)
+    valid = indices >= 0
+    flat_indices = get_offsets(array)[:-1, None] + indices
+    out[valid] = flat[flat_indices[valid]]
+    return out
+
+
+def padded_to_ragged(indices: np.ndarray) -> ak.Array:
+    """
+    Converts padded *indices* with shape ``(n_events, k)`` as returned by :py:func:`masked_top_k`
+    to a ragged array, removing slots marked by -1.
+    """
+    valid = indices >= 0
+    return ak.unflatten(indices[valid], valid.sum(axis=1))
+
+
+@njit
+def _ragged_isin(
+    offsets1: np.ndarray,
+    values1: np.ndarray,
+    offsets2: np.ndarray,
+    values2: np.ndarray,
+) -> np.ndarray:
+    """
+    Kernel that decides for each element in the first ragged array whether it is equal to at least
+    one element in the second ragged array in the same event.
+    """
+    out = np.zeros(len(values1), dtype=np.bool_)
+
+    for e in range(len(offsets1) - 1):
+        for i in range(offsets1[e], offsets1[e + 1]):
+            for j in range(offsets2[e], offsets2[e + 1]):
+                if values1[i] == values2[j]:
+                    out[i] = True
+                    break
+
+    return out
+
+
+def ragged_isin(elements: ak.Array, test_elements: ak.Array) -> ak.Array:
+    """
+    Returns a mask with the same shape as the ragged *elements* denoting whether each element is
+    contained in the list of *test_elements* of the same event. Missing values in *elements* are
+    considered not contained, and missing values in *test_elements* are ignored. Equivalent to
+
+    .. code-block:: python
+
+        ak.Array([np.isin(a, b) for a, b in zip(elements, test_elements)])
+
+    but without looping over events in python.
+    """
+    missing = ak.is_none(elements, axis=1)
+    elements = ak.fill_none(elements, 0, axis=1)
+    test_elements = test_elements[~ak.is_none(test_elements, axis=1)]
+
+    out = _ragged_isin(
+        get_offsets(elements),
+        flat_np_view(elements, axis=1),
+        get_offsets(test_elements),
+        flat_np_view(test_elements, axis=1),
+    )
+    return layout_ak_array(out, elements) & ~missing
+
+
+@njit
+def _unique_delta_r_match(
+    offsets1: np.ndarray,
+    eta1: np.ndarray,
+    phi1: np.ndarray,
+    mask1: np.ndarray,
+    offsets2: np.ndarray,
+    eta2: np.ndarray,
+    phi2: np.ndarray,
+    mask2: np.ndarray,
+    threshold: float,
+    empty_value: float,
+) -> tuple[np.ndarray, np.ndarray]:
+    """
+    Kernel that greedily matches objects of two collections passing *mask1* and *mask2* one-to-one
+    in increasing order of their delta R, considering only pairs with a delta R below *threshold*.
+    Ties are resolved by the order of objects. Returns for each object in the first collection the
+    local index of the matched object in the second collection (-1 when unmatched) and the delta R
+    (*empty_value* when unmatched).
+    """
+    index = np.full(len(eta1), -1, dtype=np.int64)
+    delta_r = np.full(len(eta1), empty_value, dtype=np.float64)
+
+    for e in range(len(offsets1) - 1):
+        n1 = offsets1[e + 1] - offsets1[e]
+        n2 = offsets2[e + 1] - offsets2[e]
+        if n1 == 0 or n2 == 0:
+            continue
+
+        # collect candidate pairs
+        pair_i = np.empty(n1 * n2, dtype=np.int64)
+        pair_j = np.empty(n1 * n2, dtype=np.int64)
+        pair_dr = np.empty(n1 * n2, dtype=np.float64)
+        n_pairs = 0
+        for i in range(offsets1[e], offsets1[e + 1]):
+            if not mask1[i]:
+                continue
+            for j in range(offsets2[e], offsets2[e + 1]):
+                if not mask2[j]:
+                    continue
+                deta = eta1[i] - eta2[j]
+                dphi = (phi1[i] - phi2[j] + np.pi) % (2 * np.pi) - np.pi
+                dr = np.sqrt(deta**2 + dphi**2)
+                if dr < threshold:
+                    pair_i[n_pairs] = i
+                    pair_j[n_pairs] = j
+                    pair_dr[n_pairs] = dr
+                    n_pairs += 1
+
+        # assign pairs with the smallest distance first
+        used2 = np.zeros(n2, dtype=np.bool_)
+        for p in np.argsort(pair_dr[:n_pairs], kind="mergesort"):
+            i = pair_i[p]
+            j = pair_j[p] - offsets2[e]
+            if index[i] >= 0 or used2[j]:
+                continue
+            index[i] = j
+            delta_r[i] = pair_dr[p]
+            used2[j] = True
+
+    return index, delta_r
+
+
+def unique_delta_r_match(
+    objects1: ak.Array,
+    objects2: ak.Array,
+    threshold: float,
+    mask1: ak.Array | None = None,
+    mask2: ak.Array | None = None,
+) -> DotDict:
+    """
+    Matches objects of the ragged collections *objects1* and *objects2*, optionally restricted to
+    those passing *mask1* and *mask2*, one-to-one and greedily by delta R below *threshold*, i.e.,
+    the closest pair is matched first, then the closest among the remaining objects, and so on.
+    Only *eta* and *phi* fields are read. Returns a DotDict with two arrays in the layout of
+    *objects1*: ``index`` refers to the local index of the matched object in *objects2* (-1 when
+    unmatched) and ``delta_r`` contains the distance (``EMPTY_FLOAT`` when unmatched). Use
+    :py:func:`match_pairs` to obtain the matched pairs.
+    """
+    offsets1 = get_offsets(objects1.eta)
+    offsets2 = get_offsets(objects2.eta)
+    index, delta_r = _unique_delta_r_match(
+        offsets1,
+        flat_np_view(objects1.eta, axis=1),
+        flat_np_view(objects1.phi, axis=1),
+        np.ones(offsets1[-1], dtype=bool) if mask1 is None else flat_np_view(mask1, axis=1),
+        offsets2,
+        flat_np_view(objects2.eta, axis=1),
+        flat_np_view(objects2.phi, axis=1),
+        np.ones(offsets2[-1], dtype=bool) if mask2 is None else flat_np_view(mask2, axis=1),
+        float(threshold),
+        float(EMPTY_FLOAT),
+    )
+    return DotDict(
+        index=layout_ak_array(index, objects1.eta),
+        delta_r=layout_ak_array(delta_r, objects1.eta),
+    )
+
+
+def match_pairs(match: DotDict) -> DotDict:
+    """
+    Converts the *match* result of :py:func:`unique_delta_r_match` into ragged lists of matched
+    pairs, returning a DotDict with the local indices ``index1`` and ``index2`` in the two matched
+    collections and the ``delta_r`` per pair.
+    """
+    matched = match.index >= 0
+    return DotDict(
+        index1=ak.local_index(match.index, axis=1)[matched],
+        index2=match.index[matched],
+        delta_r=match.delta_r[matched],
+    )
+
+
+def chain_delta_r_matches(
+    collections: Sequence[ak.Array],
+    thresholds: float | Sequence[float],
+    masks: Sequence[ak.Array | None] | None = None,
+) -> DotDict:
+    """
+    Matches a chain of ragged *collections* stage by stage with :py:func:`unique_delta_r_match`,
+    e.g. partons to gen jets to reconstructed jets, using one threshold or one per stage given by
+    *thresholds*, and optional *masks* per collection. Objects in intermediate collections are
+    only considered in the next stage when they were matched in the previous one. Returns a
+    DotDict with the match results per ``stages`` and the ``index`` of the object in the last
+    collection matched to each object in the first one through the full chain (-1 otherwise).
+    """
+    n_stages = len(collections) - 1
+    if not isinstance(thresholds, (list, tuple)):
+        thresholds = n_stages * [thresholds]
+    if masks is None:
+        masks = len(collections) * [None]
+
+    # offsets and event indices of all flat objects per collection
+    offsets = [get_offsets(objects.eta) for objects in collections]
+    events = [np.repeat(np.arange(len(_offsets) - 1), np.diff(_offsets)) for _offsets in offsets]
+
+    # start the chain with local indices of the first collection
+    index = np.arange(offsets[0][-1]) - offsets[0][events[0]]
+
+    stages = []
+    for stage in range(n_stages):
+        mask1 = masks[stage]
+        if stage > 0:
+            # only consider objects that were matched in the previous stage
+            prev_index = flat_np_view(stages[-1].index, axis=1)
+            valid = prev_index >= 0
+            matched = np.zeros(offsets[stage][-1], dtype=bool)
+            matched[offsets[stage][events[stage - 1][valid]] + prev_index[valid]] = True
+            matched = layout_ak_array(matched, collections[stage].eta)
+            mask1 = matched if mask1 is None else (matched & mask1)
+
+        match = unique_delta_r_match(
+            collections[stage],
+            collections[stage + 1],
+            thresholds[stage],
+            mask1=mask1,
+            mask2=masks[stage + 1],
+        )
+        stages.append(match)
+
+        # follow the chain
+        next_index = flat_np_view(match.index, axis=1)
+        valid = index >= 0
+        index[valid] = next_index[offsets[stage][events[0][valid]] + index[valid]]
+
+    return DotDict(
+        stages=stages,
+        index=layout_ak_array(index, collections[0].eta),
+    )
@@ -197,6 +197,16 @@ def add_config(
         "boosted": ["trigger", "lepton", "boosted_jet_selector"]
     }
 
+    # bit registry of selection steps encoded in the selection_steps column, see
+    # hbt.selection.cutflow.selection_steps (existing bits should not be changed so that outputs
+    # of previous selections remain readable, and new steps should be appended)
+    cfg.x.selection_step_bits = {
+        step: bit for bit, step in enumerate([
+            "golden", "met_filter", "trigger", "lepton", "jet", "bjet", "fatjet", "gen_matched_1",
+            "first_matched", "gen_matched_2",
+        ])
+    }
+
     # custom method and sandbox for determining dataset lfns
     cfg.x.get_dataset_lfns = None
     cfg.x.get_dataset_lfns_sandbox = None
@@ -369,6 +379,17 @@ def add_config(
     # name of the btag_sf correction set and jec uncertainties to propagate through
     cfg.x.btag_sf = ("deepJet_shape", cfg.x.btag_sf_jec_sources)
 
+    # location and maximum size in MB of the on-disk cache of hhbtag scores per dataset, and the
+    # time in seconds during which shards used by possibly running jobs are not evicted, the cache
+    # is opt-in and only used when a path is set, e.g. "$CF_DATA/hhbtag_score_cache", and the
+    # producer is configured with use_score_cache=True
+    # (used in the hhbtag producer)
+    cfg.x.hhbtag_score_cache = DotDict.wrap({
+        "path": None,
+        "max_size_mb": 2000.0,
+        "grace_period": 6 * 3600.0,
+    })
+
     # name of the deep tau tagger
     # (used in the tec calibrator)
     cfg.x.tau_tagger = "DeepTau2017v2p1"
@@ -672,10 +693,10 @@ def add_config(
             # columns added during selection
             "channel_id", "process_id", "category_ids", "mc_weight", "pdf_weight*", "murmuf_weight*",
             "leptons_os", "tau2_isolated", "single_triggered", "cross_triggered",
-            "deterministic_seed", "pu_weight*", "btag_weight*", "cutflow.*",
+            "deterministic_seed", "pu_weight*", "btag_weight*", "cutflow.*", "selection_steps",
         },
         "cf.MergeSelectionMasks": {
-            "normalization_weight", "process_id", "category_ids", "cutflow.*",
+            "normalization_weight", "process_id", "category_ids", "cutflow.*", "selection_steps",
         },
         "cf.UniteColumns": {
             "*",
@@ -9,6 +9,18 @@ import order as od
 from hbt.config.util import Trigger, TriggerLeg
 
 
+def add_trigger_bits(config: od.Config) -> None:
+    """
+    Registers the bit index per trigger id that is used to encode trigger decisions in the compact
+    ``trigger_mask`` column in the auxiliary field *trigger_bits* of a *config*. Bits are assigned
+    in the order of triggers in ``config.x.triggers``, of which there must not be more than 64.
+    """
+    if len(config.x.triggers) > 64:
+        raise ValueError(f"cannot encode more than 64 triggers in uint64 masks, got {len(config.x.triggers)}")
+
+    config.x.trigger_bits = {trigger.id: bit for bit, trigger in enumerate(config.x.triggers)}
+
+
 def add_triggers_2017(config: od.Config) -> None:
     """
     Adds all triggers to a *config*. For the conversion from filter names to trigger bits, see
@@ -329,3 +341,6 @@ def add_triggers_2017(config: od.Config) -> None:
             tags={"cross_trigger", "cross_tau_tau_vbf", "channel_tau_tau"},
         ),
     ])
+
+    # register trigger bits
+    add_trigger_bits(config)
@@ -46,6 +46,18 @@ class TriggerLeg(object):
             f"at {hex(id(self))}>"
         )
 
+    @property
+    def key(self) -> tuple[int | None, float | None, tuple[int] | None]:
+        """
+        Canonical, hashable key of this leg. Legs with identical keys select the exact same trigger
+        objects, so that their matching results can be shared.
+        """
+        return (
+            None if self.pdg_id is None else abs(self.pdg_id),
+            self.min_pt,
+            None if self.trigger_bits is None else tuple(sorted(set(self.trigger_bits))),
+        )
+
     @typed
     def pdg_id(self, pdg_id: int | None) -> int | None:
         if pdg_id is None:
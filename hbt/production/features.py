@@ -13,6 +13,8 @@ from columnflow.util import maybe_import
 from columnflow.columnar_util import EMPTY_FLOAT, Route, set_ak_column
 from IPython import embed
 
+from hbt.columnar_util import masked_top_k, take_padded
+
 
 np = maybe_import("numpy")
 ak = maybe_import("awkward")
@@ -90,37 +92,37 @@ def cutflow_features(
     events = set_ak_column_f32(events, "cutflow.jet1_eta", Route("eta[:,0]").apply(selected_jet, EMPTY_FLOAT))
     events = set_ak_column_f32(events, "cutflow.jet1_phi", Route("phi[:,0]").apply(selected_jet, EMPTY_FLOAT))
     events = set_ak_column_f32(events, "cutflow.jet2_pt", Route("pt[:,1]").apply(selected_jet, EMPTY_FLOAT))
+
+    # leading and subleading values of a column, padded with EMPTY_FLOAT
+    def top_two(variable: str, ascending: bool = False) -> np.ndarray:
+        column = Route(variable).apply(events)
+        return take_padded(column, masked_top_k(column, 2, ascending=ascending), EMPTY_FLOAT)
+
     # btags
-    events = set_ak_column_f32(events, "cutflow.btagDeepFlavB1", ak.sort(events.Jet.btagDeepFlavB, axis=1, ascending=False)[:,0])
-    events = set_ak_column_f32(events, "cutflow.btagDeepFlavCvB1", ak.sort(events.Jet.btagDeepFlavCvB, axis=1, ascending=True)[:,0])
-    events = set_ak_column_f32(events, "cutflow.btagDeepFlavB2", ak.sort(events.Jet.btagDeepFlavB, axis=1, ascending=False)[:,1])
-    events = set_ak_column_f32(events, "cutflow.btagDeepFlavCvB2", ak.sort(events.Jet.btagDeepFlavCvB, axis=1, ascending=True)[:,1])
-    
-    # add EMPTY_FLOAT default value for columns with empty collections
-    def pad_events(events: ak.Array, variable: str, number_required_objects: int):
-            column = Route(variable).apply(events)
-            column_padded = ak.pad_none(column, number_required_objects, axis=1)
-            column_padded = ak.fill_none(column_padded, EMPTY_FLOAT, axis=1)
-            return column_padded
-
-    # padded columns
-    rawDeepTau2017v2p1VSe_padded = pad_events(events, "Tau.rawDeepTau2017v2p1VSe", 2)
-    rawDeepTau2017v2p1VSjet_padded = pad_events(events, "Tau.rawDeepTau2017v2p1VSjet", 2)
-    rawDeepTau2017v2p1VSmu_padded = pad_events(events, "Tau.rawDeepTau2017v2p1VSmu", 2)
-    btagHbb_padded = pad_events(events, "FatJet.btagHbb", 2)
-    btagDeepb_padded = pad_events(events, "FatJet.btagDeepB", 2)
-    
+    btagDeepFlavB = top_two("Jet.btagDeepFlavB")
+    btagDeepFlavCvB = top_two("Jet.btagDeepFlavCvB", ascending=True)
+    events = set_ak_column_f32(events, "cutflow.btagDeepFlavB1", btagDeepFlavB[:, 0])
+    events = set_ak_column_f32(events, "cutflow.btagDeepFlavCvB1", btagDeepFlavCvB[:, 0])
+    events = set_ak_column_f32(events, "cutflow.btagDeepFlavB2", btagDeepFlavB[:, 1])
+    events = set_ak_column_f32(events, "cutflow.btagDeepFlavCvB2", btagDeepFlavCvB[:, 1])
+
     # deeptau
-    events = set_ak_column_f32(events, "cutflow.rawDeepTau2017v2p1VSe1", ak.sort(rawDeepTau2017v2p1VSe_padded, axis=1, ascending=False)[:,0])
-    events = set_ak_column_f32(events, "cutflow.rawDeepTau2017v2p1VSjet1", ak.sort(rawDeepTau2017v2p1VSjet_padded, axis=1, ascending=False)[:,0])
-    events = set_ak_column_f32(events, "cutflow.rawDeepTau2017v2p1VSmu1", ak.sort(rawDeepTau2017v2p1VSmu_padded, axis=1, ascending=False)[:,0])
+    rawDeepTau2017v2p1VSe = top_two("Tau.rawDeepTau2017v2p1VSe")
+    rawDeepTau2017v2p1VSjet = top_two("Tau.rawDeepTau2017v2p1VSjet")
+    rawDeepTau2017v2p1VSmu = top_two("Tau.rawDeepTau2017v2p1VSmu")
+    events = set_ak_column_f32(events, "cutflow.rawDeepTau2017v2p1VSe1", rawDeepTau2017v2p1VSe[:, 0])
+    events = set_ak_column_f32(events, "cutflow.rawDeepTau2017v2p1VSjet1", rawDeepTau2017v2p1VSjet[:, 0])
+    events = set_ak_column_f32(events, "cutflow.rawDeepTau2017v2p1VSmu1", rawDeepTau2017v2p1VSmu[:, 0])
+    events = set_ak_column_f32(events, "cutflow.rawDeepTau2017v2p1VSe2", rawDeepTau2017v2p1VSe[:, 1])
+    events = set_ak_column_f32(events, "cutflow.rawDeepTau2017v2p1VSjet2", rawDeepTau2017v2p1VSjet[:, 1])
+    events = set_ak_column_f32(events, "cutflow.rawDeepTau2017v2p1VSmu2", rawDeepTau2017v2p1VSmu[:, 1])
 
-    events = set_ak_column_f32(events, "cutflow.rawDeepTau2017v2p1VSe2", ak.sort(rawDeepTau2017v2p1VSe_padded, axis=1, ascending=False)[:,1])
-    events = set_ak_column_f32(events, "cutflow.rawDeepTau2017v2p1VSjet2", ak.sort(rawDeepTau2017v2p1VSjet_padded, axis=1, ascending=False)[:,1])
-    events = set_ak_column_f32(events, "cutflow.rawDeepTau2017v2p1VSmu2", ak.sort(rawDeepTau2017v2p1VSmu_padded, axis=1, ascending=False)[:,1])
     # fatjets
-    events = set_ak_column_f32(events, "cutflow.fatJet1.btagHbb", ak.sort(btagHbb_padded, axis=1, ascending=False)[:,0])
-    events = set_ak_column_f32(events, "cutflow.fatJet1.btagDeepb", ak.sort(btagDeepb_padded, axis=1, ascending=False)[:,0])
-    events = set_ak_column_f32(events, "cutflow.fatJet2.btagHbb", ak.sort(btagHbb_padded, axis=1, ascending=False)[:,1])
-    events = set_ak_column_f32(events, "cutflow.fatJet2.btagDeepb", ak.sort(btagDeepb_padded, axis=1, ascending=False)[:,1])
+    btagHbb = top_two("FatJet.btagHbb")
+    btagDeepb = top_two("FatJet.btagDeepB")
+    events = set_ak_column_f32(events, "cutflow.fatJet1.btagHbb", btagHbb[:, 0])
+    events = set_ak_column_f32(events, "cutflow.fatJet1.btagDeepb", btagDeepb[:, 0])
+    events = set_ak_column_f32(events, "cutflow.fatJet2.btagHbb", btagHbb[:, 1])
+    events = set_ak_column_f32(events, "cutflow.fatJet2.btagDeepb", btagDeepb[:, 1])
+
     return events
\ No newline at end of file
@@ -6,12 +6,68 @@ Producers that determine the generator-level particles related to a top quark de
 
 from columnflow.production import Producer, producer
 from columnflow.util import maybe_import, dev_sandbox
-from columnflow.columnar_util import EMPTY_FLOAT, layout_ak_array
+from columnflow.columnar_util import EMPTY_FLOAT, flat_np_view, layout_ak_array
 from columnflow.columnar_util import set_ak_column
 
+from hbt.columnar_util import get_offsets, chain_delta_r_matches, match_pairs
+from hbt.util import njit
 
+
+np = maybe_import("numpy")
 ak = maybe_import("awkward")
 
+# bit of the isHardProcess flag in GenPart.statusFlags
+IS_HARD_PROCESS = 1 << 7
+
+
+@njit
+def _distinct_parents(
+    offsets: np.ndarray,
+    mother_idx: np.ndarray,
+    pdg_id: np.ndarray,
+) -> np.ndarray:
+    """
+    Kernel that determines for each generator particle the flat index of its distinct parent, i.e.,
+    the first ancestor with a different pdg id (-1 if there is none). Since mothers usually precede
+    their daughters, the result of a mother with the same pdg id is reused, so that the chain is
+    only walked explicitly otherwise.
+    """
+    out = np.full(len(pdg_id), -1, dtype=np.int64)
+
+    for e in range(len(offsets) - 1):
+        o = offsets[e]
+        n = offsets[e + 1] - o
+        for i in range(o, offsets[e + 1]):
+            m = mother_idx[i]
+            # guard against malformed, cyclic chains
+            for _ in range(n):
+                if m < 0:
+                    break
+                j = o + m
+                if pdg_id[j] != pdg_id[i]:
+                    out[i] = j
+                    break
+                if j < i:
+                    out[i] = out[j]
+                    break
+                m = mother_idx[j]
+
+    return out
+
+
+def get_distinct_parents(gen_part: ak.Array) -> np.ndarray:
+    """
+    Returns the flat indices of the distinct parents of all particles in the ragged *gen_part*
+    collection, equivalent to ``gen_part.distinctParent`` in coffea, but computed in a single pass
+    over flat buffers. Particles without a distinct parent are marked by -1.
+    """
+    return _distinct_parents(
+        get_offsets(gen_part.pdgId),
+        flat_np_view(gen_part.genPartIdxMother, axis=1).astype(np.int64),
+        flat_np_view(gen_part.pdgId, axis=1),
+    )
+
+
 @producer(
         uses={
             # nano columns
@@ -20,38 +76,48 @@ ak = maybe_import("awkward")
             "nGenPart", "GenPart.*",
         },
         produces={
-            "genBpartonH", "genTaupartonH",
+            "genBpartonH", "genTaupartonH", "genBJetH",
         },
         sandbox=dev_sandbox("bash::$HBT_BASE/sandboxes/venv_columnar.sh"),
 )
 def gen_HH_decay_products(self: Producer, events: ak.Array, **kwargs) -> ak.Array:
     """
-    Creates a new ragged column "gen_top_decay" with one element per hard top quark. Each element is
-    a GenParticleArray with five or more objects in a distinct order: top quark, bottom quark,
-    W boson, down-type quark or charged lepton, up-type quark or neutrino, and any additional decay
-    produces of the W boson (if any, then most likly photon radiations). Per event, the structure
-    will be similar to:
+    Creates the new ragged columns "genBpartonH" and "genTaupartonH" containing generator-level b
+    quarks and taus of the hard process whose distinct parent is a Higgs boson. Parents are
+    resolved in a single pass over the flat GenPart buffers, after which the daughters are selected
+    by simple masks. In addition, b quarks are matched uniquely by delta R to GenJets with b as
+    parton flavour, storing the local index of the matched GenJet as "genBpartonH.genJetIdx" (-1
+    if unmatched) and the matched GenJets in the order of b quarks as "genBJetH".
 
-    .. code-block:: python
-
-        [[t1, b1, W1, q1/l, q2/n(, additional_w_decay_products)], [t2, ...], ...]
+    All columns are shift independent and can be produced once per file with
+    :py:class:`hbt.tasks.production.ProduceGenSidecar`.
     """
+    gen_part = events.GenPart
+    abs_id = np.abs(flat_np_view(gen_part.pdgId, axis=1))
+
+    # classify particles as daughters of a higgs in the hard process
+    parent = get_distinct_parents(gen_part)
+    parent_abs_id = np.where(parent >= 0, abs_id[parent], 0)
+    higgs_daughter = (
+        ((flat_np_view(gen_part.statusFlags, axis=1) & IS_HARD_PROCESS) != 0) &
+        (parent_abs_id == 25)
+    )
+
+    # save the columns
+    for column, pdg_id in [("genBpartonH", 5), ("genTaupartonH", 15)]:
+        mask = layout_ak_array(higgs_daughter & (abs_id == pdg_id), gen_part.pdgId)
+        events = set_ak_column(events, column, gen_part[mask])
+
+    # match b quarks to GenJets with b as parton flavour
+    chain = chain_delta_r_matches(
+        [events.genBpartonH, events.GenJet],
+        0.4,
+        masks=[None, abs(events.GenJet.partonFlavour) == 5],
+    )
+    events = set_ak_column(events, "genBpartonH.genJetIdx", chain.index, value_type=np.int32)
+    pairs = match_pairs(chain.stages[0])
+    events = set_ak_column(events, "genBJetH", events.GenJet[pairs.index2])
 
-    def find_partons(events: ak.Array, pdgId: int, mother_pdgId: int=25):
-        abs_id = abs(events.GenPart.pdgId)
-        part = events.GenPart[abs_id == pdgId]
-        part = part[part.hasFlags("isHardProcess")& (abs(part.distinctParent.pdgId) == mother_pdgId)]
-        part = part[~ak.is_none(part, axis=1)]
-
-        return part
-    # from IPython import embed; embed()
-    
-    gen_b_from_h = find_partons(events=events, pdgId=5)
-    gen_tau_from_h = find_partons(events=events, pdgId=15)
-    # save the column
-    # events = set_ak_column(events, "gen_top_decay", groups)
-    events = set_ak_column(events, "genBpartonH", gen_b_from_h)
-    events = set_ak_column(events, "genTaupartonH", gen_tau_from_h)
     return events
 
 
@@ -62,4 +128,4 @@ def gen_HH_decay_products_init(self: Producer) -> None:
     a dataset including top decays is processed.
     """
     self.uses |= {"nGenPart", "GenPart.*", "nGenJet", 'GenJet.*'}
-    self.produces |= {"genBpartonH", "genTaupartonH"}
+    self.produces |= {"genBpartonH", "genTaupartonH", "genBJetH"}
@@ -5,16 +5,27 @@ Producers for the HHBtag score.
 See https://github.com/hh-italian-group/HHbtag.
 """
 
+from __future__ import annotations
+
+import os
+import sys
+import time
+import uuid
+import shutil
+
 import law
 
 from columnflow.production import Producer, producer
 from columnflow.util import maybe_import, dev_sandbox
-from columnflow.columnar_util import EMPTY_FLOAT, layout_ak_array
+from columnflow.columnar_util import EMPTY_FLOAT, flat_np_view
+
+from hbt.columnar_util import get_offsets
+from hbt.selection.lepton import LeptonPair
+from hbt.util import njit
 
 
 np = maybe_import("numpy")
 ak = maybe_import("awkward")
-tf = maybe_import("tensorflow")
 
 logger = law.logger.get_logger(__name__)
 
@@ -24,114 +35,467 @@ logger = law.logger.get_logger(__name__)
         # custom columns created upstream, probably by a selector
         "channel_id",
         # nano columns
-        "event",
+        "run", "luminosityBlock", "event",
         "nJet", "Jet.pt", "Jet.eta", "Jet.phi", "Jet.mass", "Jet.jetId", "Jet.puId",
         "Jet.btagDeepFlavB",
         "MET.pt", "MET.phi",
     },
     sandbox=dev_sandbox("bash::$HBT_BASE/sandboxes/venv_columnar_tf.sh"),
+    # inference backend, either "tf" or "onnx"
+    backend="tf",
+    # number of threads used by onnxruntime within and across operators
+    onnx_intra_op_threads=1,
+    onnx_inter_op_threads=1,
+    # maximum number of events per model evaluation, None to evaluate all at once
+    batch_size=None,
+    # input dimensions of the models
+    n_jets_max=10,
+    n_features=15,
+    # whether to use the on-disk score cache configured in the config as "hhbtag_score_cache", which
+    # is opt-in and also requires its path to be set
+    use_score_cache=False,
 )
 def hhbtag(
     self: Producer,
     events: ak.Array,
     jet_mask: ak.Array,
-    lepton_pair: ak.Array,
+    lepton_pair: LeptonPair,
+    alive_mask: ak.Array | np.ndarray | None = None,
+    stats: dict | None = None,
     **kwargs,
 ) -> ak.Array:
     """
-    Returns the HHBtag score per passed jet.
+    Returns the HHBtag score per passed jet, given a *jet_mask* and the selected *lepton_pair*.
+
+    The models are evaluated with TensorFlow by default. Setting the *backend* attribute to
+    ``"onnx"`` evaluates them with onnxruntime instead, using models converted once during the
+    setup and cached next to the unpacked external files. The number of onnxruntime threads is
+    controlled by *onnx_intra_op_threads* and *onnx_inter_op_threads*, and *batch_size* limits the
+    number of events per model call for both backends.
+
+    When *use_score_cache* is *True* and a cache location is configured, both of which are opt-in,
+    scores are looked up per event in an :py:class:`HHBtagScoreCache` first and the models are
+    only evaluated for events whose input features changed or that were not seen before, e.g. when
+    selecting the same file for a different shift.
     """
     # get a mask of events where there are at least two tau candidates and at least two jets
     # and only get the scores for jets in these events
     event_mask = (
-        (ak.num(lepton_pair, axis=1) >= 2) &
-        (ak.sum(jet_mask, axis=1) >= 2)
+        (lepton_pair.n_candidates >= 2) &
+        (np.asarray(ak.sum(jet_mask, axis=1)) >= 2)
     )
 
-    # prepare objects
-    n_jets_max = 10
-    jets = events.Jet[jet_mask][event_mask][..., :n_jets_max]
-    leps = lepton_pair[event_mask][..., [0, 1]]
-    htt = leps[..., 0] + leps[..., 1]
-    met = events[event_mask].MET
-    jet_shape = abs(jets.pt) >= 0
-    n_jets_capped = ak.num(jets, axis=1)
-
-    # get input features
-    input_features = [
-        jet_shape * 1,
-        jets.pt,
-        jets.eta,
-        jets.mass / jets.pt,
-        jets.energy / jets.pt,
-        abs(jets.eta - htt.eta),
-        jets.btagDeepFlavB,
-        jets.delta_phi(htt),
-        jet_shape * (self.config_inst.campaign.x.year),
-        jet_shape * (events[event_mask].channel_id - 1),
-        jet_shape * htt.pt,
-        jet_shape * htt.eta,
-        jet_shape * htt.delta_phi(met),
-        jet_shape * (met.pt / htt.pt),
-        jet_shape * ak.sum(leps.pt, axis=1),
+    # skip events that cannot pass the selection anymore
+    if alive_mask is not None:
+        alive_mask = np.asarray(alive_mask, dtype=bool)
+        if stats is not None:
+            stats["n_hhbtag_skipped"] += int(np.sum(event_mask & ~alive_mask))
+        event_mask = event_mask & alive_mask
+
+    # flat jet buffers and offsets
+    jet_offsets = get_offsets(events.Jet.pt)
+    flat_jet_mask = flat_np_view(jet_mask, axis=1)
+    jet_buffers = [
+        flat_np_view(events.Jet[field], axis=1)
+        for field in ["pt", "eta", "phi", "mass", "btagDeepFlavB"]
     ]
 
-    # helper to split events, cast to float 32, concatenate across new axis,
-    # then pad with zeros for up to n_jets_max jets
-    def split(where):
-        # when there are no events matched by the mask, ak.concatenate (unlike np) fails
-        features = np.concatenate(
-            [
-                ak.values_astype(f[where][..., None], np.float32)
-                for f in input_features
-            ],
-            axis=2,
-        )
-        # fill
-        features = ak.fill_none(
-            ak.pad_none(features, n_jets_max, axis=1),
-            np.zeros(len(input_features), dtype=np.float32),
+    # di-tau system from the two lepton slots
+    htt_pt, htt_eta, htt_phi = sum_pt_eta_phi_m(
+        lepton_pair.pt[:, 0], lepton_pair.eta[:, 0], lepton_pair.phi[:, 0], lepton_pair.mass[:, 0],
+        lepton_pair.pt[:, 1], lepton_pair.eta[:, 1], lepton_pair.phi[:, 1], lepton_pair.mass[:, 1],
+    )
+    event_buffers = [
+        htt_pt,
+        htt_eta,
+        htt_phi,
+        lepton_pair.pt[:, 0] + lepton_pair.pt[:, 1],
+        np.asarray(events.MET.pt),
+        np.asarray(events.MET.phi),
+        np.asarray(events.channel_id),
+    ]
+
+    # output scores, filled in-place below
+    all_scores = ak.full_like(events.Jet.pt, EMPTY_FLOAT, dtype=np.float32)
+    flat_scores = flat_np_view(all_scores, axis=1)
+
+    # event identifiers for cache lookups
+    cache = self.hhbtag_score_cache
+    if cache is not None:
+        event_ids = np.stack(
+            [np.asarray(events[field], dtype=np.uint64) for field in ["run", "luminosityBlock", "event"]],
             axis=1,
         )
-        # fix the dimension of the last axis to the known number of input features
-        features = features[..., list(range(len(input_features)))]
-        return features
-
-    # reserve an output score array
-    scores = np.ones((ak.sum(event_mask), n_jets_max), dtype=np.float32) * EMPTY_FLOAT
-
-    # fill even and odd events if there are any
-    even_mask = (events[event_mask].event % 2) == 0
-    if ak.sum(even_mask):
-        input_features_even = split(even_mask)
-        scores_even = self.hhbtag_model_even(input_features_even)[0].numpy()
-        scores[even_mask] = scores_even
-    if ak.sum(~even_mask):
-        input_features_odd = split(~even_mask)
-        scores_odd = self.hhbtag_model_odd(input_features_odd)[0].numpy()
-        scores[~even_mask] = scores_odd
-
-    # remove the scores of padded jets
-    where = ak.from_regular(ak.local_index(scores) < n_jets_capped[..., None], axis=1)
-    scores = ak.from_regular(scores, axis=1)[where]
-
-    # add scores to events that had more than n_jets_max selected jets
-    # (use zero here as this is also what the hhbtag model does for missing jets)
-    layout_ext = events.Jet.pt[jet_mask][event_mask][..., n_jets_max:]
-    # when there are no selected events, we can reuse layout_ext and consider it to be scores_ext
-    if len(layout_ext) == 0:
-        scores_ext = layout_ext
-    else:
-        scores_ext = layout_ak_array(np.zeros(len(ak.flatten(layout_ext)), dtype=np.int32), layout_ext)
-    scores = ak.concatenate([scores, scores_ext], axis=1)
-
-    # insert scores into an array with same shape as input jets (without jet_mask and event_mask)
-    all_scores = ak.full_like(events.Jet.pt, EMPTY_FLOAT, dtype=np.float32)
-    np.asarray(ak.flatten(all_scores))[ak.flatten(jet_mask & event_mask, axis=1)] = np.asarray(ak.flatten(scores))
+
+    # evaluate even and odd events with their respective model
+    event_indices = np.flatnonzero(event_mask)
+    is_even = (np.asarray(events.event)[event_indices] % 2) == 0
+    for model, parity_indices in [
+        (self.hhbtag_model_even, event_indices[is_even]),
+        (self.hhbtag_model_odd, event_indices[~is_even]),
+    ]:
+        if not len(parity_indices):
+            continue
+
+        # fill input features, zero-padded for up to n_jets_max jets
+        features = np.zeros((len(parity_indices), self.n_jets_max, self.n_features), dtype=np.float32)
+        _fill_hhbtag_features(
+            features,
+            parity_indices,
+            jet_offsets,
+            flat_jet_mask,
+            *jet_buffers,
+            *event_buffers,
+            self.config_inst.campaign.x.year,
+        )
+
+        # evaluate, only for events without cached scores
+        if cache is None:
+            scores = self.hhbtag_evaluate(model, features)
+            n_evaluated = len(scores)
+        else:
+            ids = event_ids[parity_indices]
+            hashes = cache.hash_features(features)
+            scores, found = cache.lookup(ids, hashes)
+            n_evaluated = int(np.sum(~found))
+            if n_evaluated:
+                scores[~found] = self.hhbtag_evaluate(model, features[~found])
+                cache.add(ids[~found], hashes[~found], scores[~found])
+        if stats is not None:
+            stats["n_hhbtag_evaluated"] += n_evaluated
+
+        # insert scores, using zero for selected jets beyond n_jets_max
+        # (as this is also what the hhbtag model does for missing jets)
+        _scatter_hhbtag_scores(flat_scores, parity_indices, scores, jet_offsets, flat_jet_mask)
+
+    if cache is not None:
+        logger.info(repr(cache))
 
     return all_scores
 
 
+def sum_pt_eta_phi_m(
+    pt1: np.ndarray,
+    eta1: np.ndarray,
+    phi1: np.ndarray,
+    mass1: np.ndarray,
+    pt2: np.ndarray,
+    eta2: np.ndarray,
+    phi2: np.ndarray,
+    mass2: np.ndarray,
+) -> tuple[np.ndarray, np.ndarray, np.ndarray]:
+    """
+    Returns pt, eta and phi of the sum of two four-vectors given in pt, eta, phi and mass.
+    """
+    px = pt1 * np.cos(phi1) + pt2 * np.cos(phi2)
+    py = pt1 * np.sin(phi1) + pt2 * np.sin(phi2)
+    pz = pt1 * np.sinh(eta1) + pt2 * np.sinh(eta2)
+    pt = np.hypot(px, py)
+    with np.errstate(divide="ignore", invalid="ignore"):
+        eta = np.arcsinh(pz / pt)
+    return pt, eta, np.arctan2(py, px)
+
+
+@njit
+def _fill_hhbtag_features(
+    out: np.ndarray,
+    event_indices: np.ndarray,
+    jet_offsets: np.ndarray,
+    jet_mask: np.ndarray,
+    jet_pt: np.ndarray,
+    jet_eta: np.ndarray,
+    jet_phi: np.ndarray,
+    jet_mass: np.ndarray,
+    jet_btag: np.ndarray,
+    htt_pt: np.ndarray,
+    htt_eta: np.ndarray,
+    htt_phi: np.ndarray,
+    lep_pt_sum: np.ndarray,
+    met_pt: np.ndarray,
+    met_phi: np.ndarray,
+    channel_id: np.ndarray,
+    year: int,
+) -> None:
+    """
+    Fills the zero-initialized feature tensor *out* with shape ``(n, n_jets_max, n_features)`` for
+    the *n* events in *event_indices*, reading from flat jet buffers with *jet_offsets* and per-event
+    buffers. Only jets passing *jet_mask* are considered, in their original order.
+    """
+    n_jets_max = out.shape[1]
+    for i in range(len(event_indices)):
+        e = event_indices[i]
+
+        # event-level features
+        dphi_htt_met = (htt_phi[e] - met_phi[e] + np.pi) % (2 * np.pi) - np.pi
+
+        n = 0
+        for j in range(jet_offsets[e], jet_offsets[e + 1]):
+            if not jet_mask[j]:
+                continue
+            if n >= n_jets_max:
+                break
+
+            pt = jet_pt[j]
+            energy = np.sqrt((pt * np.cosh(jet_eta[j]))**2 + jet_mass[j]**2)
+            f = out[i, n]
+            f[0] = 1.0
+            f[1] = pt
+            f[2] = jet_eta[j]
+            f[3] = jet_mass[j] / pt
+            f[4] = energy / pt
+            f[5] = abs(jet_eta[j] - htt_eta[e])
+            f[6] = jet_btag[j]
+            f[7] = (jet_phi[j] - htt_phi[e] + np.pi) % (2 * np.pi) - np.pi
+            f[8] = year
+            f[9] = channel_id[e] - 1
+            f[10] = htt_pt[e]
+            f[11] = htt_eta[e]
+            f[12] = dphi_htt_met
+            f[13] = met_pt[e] / htt_pt[e]
+            f[14] = lep_pt_sum[e]
+            n += 1
+
+
+@njit
+def _scatter_hhbtag_scores(
+    out: np.ndarray,
+    event_indices: np.ndarray,
+    scores: np.ndarray,
+    jet_offsets: np.ndarray,
+    jet_mask: np.ndarray,
+) -> None:
+    """
+    Writes *scores* with shape ``(n, n_jets_max)`` of the *n* events in *event_indices* into the
+    flat output buffer *out* at the positions of jets passing *jet_mask*. Passing jets beyond
+    *n_jets_max* receive a score of zero.
+    """
+    n_jets_max = scores.shape[1]
+    for i in range(len(event_indices)):
+        e = event_indices[i]
+        n = 0
+        for j in range(jet_offsets[e], jet_offsets[e + 1]):
+            if not jet_mask[j]:
+                continue
+            out[j] = scores[i, n] if n < n_jets_max else 0.0
+            n += 1
+
+
+class HHBtagScoreCache(object):
+    """
+    On-disk cache of hhbtag scores of a single dataset, located in directory *path*. Entries are
+    keyed by event identity (run, luminosity block, event number) and store the scores of all
+    :py:attr:`n_jets_max` jet slots together with a hash of the input tensor of the event, so that
+    stored scores are only reused when all inputs are unchanged.
+
+    Entries are grouped into shards, usually one per input file, that are loaded with :py:meth:`open`.
+    New entries added with :py:meth:`add` are kept in memory and written to a new chunk file in the
+    shard directory right away, so that concurrent jobs never write the same files. When opening a
+    shard and the total size of all shards exceeds *max_size_mb*, least recently used shards are
+    removed, except for those used within the last *grace_period* seconds, which might still be in
+    use by other jobs. Shards are marked as used when opened and when entries are added, and a shard
+    that was removed nonetheless is recreated upon the next write. Failing writes are not fatal but
+    only logged. Lookups are counted in :py:attr:`hits` and :py:attr:`misses`.
+    """
+
+    n_jets_max = 10
+
+    def __init__(
+        self,
+        path: str,
+        max_size_mb: float = 2000.0,
+        grace_period: float = 6 * 3600.0,
+    ) -> None:
+        super().__init__()
+
+        self.path = os.path.expandvars(os.path.expanduser(path))
+        self.max_size_mb = max_size_mb
+        self.grace_period = grace_period
+
+        self.shard_dir = None
+        self._clear()
+
+        # counters
+        self.hits = 0
+        self.misses = 0
+
+    def __repr__(self) -> str:
+        n = self.hits + self.misses
+        rate = (100.0 * self.hits / n) if n else 0.0
+        return (
+            f"<{self.__class__.__name__} entries={len(self.ids)} hits={self.hits} "
+            f"misses={self.misses} ({rate:.1f}% hit rate) at {self.path}>"
+        )
+
+    def _clear(self) -> None:
+        self.ids = np.zeros((0, 3), dtype=np.uint64)
+        self.hashes = np.zeros(0, dtype=np.uint64)
+        self.scores = np.zeros((0, self.n_jets_max), dtype=np.float32)
+        self._sorted_keys = np.zeros(0, dtype=np.uint64)
+        self._sort_indices = np.zeros(0, dtype=np.int64)
+
+    @classmethod
+    def event_keys(cls, ids: np.ndarray) -> np.ndarray:
+        """
+        Returns a single uint64 key per row of event *ids*. Keys are not guaranteed to be unique,
+        so lookups always compare full ids in addition.
+        """
+        with np.errstate(over="ignore"):
+            return (
+                (ids[:, 0] << np.uint64(32)) ^ ids[:, 1] ^
+                (ids[:, 2] * np.uint64(0x9E3779B97F4A7C15))
+            )
+
+    @classmethod
+    def hash_features(cls, features: np.ndarray) -> np.ndarray:
+        """
+        Returns a uint64 hash per event of the float32 input tensor *features*.
+        """
+        bits = np.ascontiguousarray(features, dtype=np.float32).reshape(len(features), -1)
+        bits = bits.view(np.uint32).astype(np.uint64)
+        # fixed odd multipliers per feature
+        mults = np.random.default_rng(12345).integers(1, 2**63, bits.shape[1], dtype=np.uint64)
+        mults |= np.uint64(1)
+        with np.errstate(over="ignore"):
+            return (bits * mults).sum(axis=1, dtype=np.uint64)
+
+    def _update_index(self) -> None:
+        # deduplicate by full event ids, keeping the latest entries
+        _, rev_indices = np.unique(self.ids[::-1], axis=0, return_index=True)
+        keep = np.sort(len(self.ids) - 1 - rev_indices)
+        self.ids, self.hashes, self.scores = self.ids[keep], self.hashes[keep], self.scores[keep]
+        keys = self.event_keys(self.ids)
+
+        # sorted keys for lookups
+        self._sort_indices = np.argsort(keys, kind="stable")
+        self._sorted_keys = keys[self._sort_indices]
+
+    def _shard_sizes(self) -> dict[str, tuple[float, float]]:
+        # shard directory -> (size in bytes, last modification time)
+        sizes = {}
+        if not os.path.isdir(self.path):
+            return sizes
+        for name in os.listdir(self.path):
+            shard_dir = os.path.join(self.path, name)
+            if not os.path.isdir(shard_dir):
+                continue
+            files = [os.path.join(shard_dir, f) for f in os.listdir(shard_dir)]
+            sizes[shard_dir] = (
+                sum(os.path.getsize(f) for f in files),
+                os.path.getmtime(shard_dir),
+            )
+        return sizes
+
+    def evict(self, keep: str | None = None) -> None:
+        """
+        Removes least recently used shards until the total size is below :py:attr:`max_size_mb`,
+        but never removes the shard directory *keep* and shards used within the last
+        :py:attr:`grace_period` seconds.
+        """
+        sizes = self._shard_sizes()
+        total = sum(size for size, _ in sizes.values())
+        min_mtime = time.time() - self.grace_period
+        for shard_dir, (size, mtime) in sorted(sizes.items(), key=lambda item: item[1][1]):
+            if total <= self.max_size_mb * 1024**2:
+                break
+            if shard_dir == keep or mtime > min_mtime:
+                continue
+            logger.info(f"evicting hhbtag score cache shard {shard_dir}")
+            shutil.rmtree(shard_dir, ignore_errors=True)
+            total -= size
+
+    def open(self, shard: str) -> None:
+        """
+        Opens the *shard*, applying the size policy first and loading all its entries.
+        """
+        self._clear()
+        self.shard_dir = os.path.join(self.path, shard)
+        os.makedirs(self.shard_dir, exist_ok=True)
+        # mark as recently used
+        os.utime(self.shard_dir)
+
+        self.evict(keep=self.shard_dir)
+
+        # load chunk files ordered by modification time so that newer entries are preferred
+        chunk_files = sorted(
+            (os.path.join(self.shard_dir, f) for f in os.listdir(self.shard_dir) if f.endswith(".npz")),
+            key=os.path.getmtime,
+        )
+        ids, hashes, scores = [self.ids], [self.hashes], [self.scores]
+        for chunk_file in chunk_files:
+            try:
+                with np.load(chunk_file) as data:
+                    ids.append(data["ids"])
+                    hashes.append(data["hashes"])
+                    scores.append(data["scores"])
+            except Exception as e:
+                logger.warning(f"skipping unreadable hhbtag score cache file {chunk_file}: {e}")
+        self.ids = np.concatenate(ids, axis=0)
+        self.hashes = np.concatenate(hashes, axis=0)
+        self.scores = np.concatenate(scores, axis=0)
+        self._update_index()
+
+    def lookup(self, ids: np.ndarray, hashes: np.ndarray) -> tuple[np.ndarray, np.ndarray]:
+        """
+        Looks up entries for events with *ids* and input *hashes* and returns the scores (zeros
+        for missing entries) and a mask of found entries.
+        """
+        scores = np.zeros((len(ids), self.n_jets_max), dtype=np.float32)
+        found = np.zeros(len(ids), dtype=bool)
+        if len(self._sorted_keys) and len(ids):
+            # compare full ids of all entries with the same key, which are adjacent after sorting
+            keys = self.event_keys(ids)
+            pos = np.searchsorted(self._sorted_keys, keys, side="left")
+            end = np.searchsorted(self._sorted_keys, keys, side="right")
+            active = np.flatnonzero(pos < end)
+            while len(active):
+                candidates = self._sort_indices[pos[active]]
+                match = np.all(self.ids[candidates] == ids[active], axis=1)
+                hit = match & (self.hashes[candidates] == hashes[active])
+                found[active[hit]] = True
+                scores[active[hit]] = self.scores[candidates[hit]]
+                # continue with the next entry of the same key until the event is matched
+                pos[active] += 1
+                active = active[~match & (pos[active] < end[active])]
+
+        # update counters
+        n_found = int(found.sum())
+        self.hits += n_found
+        self.misses += len(found) - n_found
+
+        return scores, found
+
+    def add(self, ids: np.ndarray, hashes: np.ndarray, scores: np.ndarray) -> None:
+        """
+        Adds entries for events with *ids*, input *hashes* and *scores*, replacing existing entries
+        of the same events, and writes them to a new chunk file in the shard directory.
+        """
+        if not len(ids):
+            return
+
+        self.ids = np.concatenate([self.ids, ids], axis=0)
+        self.hashes = np.concatenate([self.hashes, hashes], axis=0)
+        self.scores = np.concatenate([self.scores, scores.astype(np.float32)], axis=0)
+        self._update_index()
+
+        if self.shard_dir is None:
+            return
+
+        # write to a temporary file first and move it to make it appear atomically, recreating the
+        # shard directory in case it was evicted in the meantime and marking it as recently used
+        name = f"chunk_{uuid.uuid4().hex}.npz"
+        tmp_path = os.path.join(self.shard_dir, f".{name}")
+        try:
+            os.makedirs(self.shard_dir, exist_ok=True)
+            with open(tmp_path, "wb") as f:
+                np.savez(f, ids=ids, hashes=hashes, scores=scores)
+            os.replace(tmp_path, os.path.join(self.shard_dir, name))
+            os.utime(self.shard_dir)
+        except OSError as e:
+            logger.warning(f"could not write hhbtag score cache file to {self.shard_dir}: {e}")
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+
+
 @hhbtag.requires
 def hhbtag_requires(self: Producer, reqs: dict) -> None:
     """
@@ -144,10 +508,16 @@ def hhbtag_requires(self: Producer, reqs: dict) -> None:
     reqs["external_files"] = BundleExternalFiles.req(self.task)
 
 
+@hhbtag.init
+def hhbtag_init(self: Producer) -> None:
+    if self.backend not in ("tf", "onnx"):
+        raise ValueError(f"unknown hhbtag backend '{self.backend}', expected 'tf' or 'onnx'")
+
+
 @hhbtag.setup
 def hhbtag_setup(self: Producer, reqs: dict, inputs: dict) -> None:
     """
-    Sets up the two HHBtag TF models.
+    Sets up the two HHBtag models with the configured backend.
     """
     # unpack the external files bundle, create a subdiretory and unpack the hhbtag repo in it
     bundle = reqs["external_files"]
@@ -160,7 +530,128 @@ def hhbtag_setup(self: Producer, reqs: dict, inputs: dict) -> None:
     # (could be used to distinguish between model paths in repo)
     self.hhbtag_version = self.config_inst.x.external_files["hh_btag_repo"][1]
 
-    # save both models (even and odd event numbers)
-    with self.task.publish_step("loading hhbtag models ..."):
-        self.hhbtag_model_even = tf.saved_model.load(repo_dir.child("models/HHbtag_v1_par_0").path)
-        self.hhbtag_model_odd = tf.saved_model.load(repo_dir.child("models/HHbtag_v1_par_1").path)
+    # model paths (even and odd event numbers)
+    model_dirs = [repo_dir.child(f"models/HHbtag_v1_par_{i}", type="d") for i in range(2)]
+
+    # save both models
+    with self.task.publish_step(f"loading hhbtag models with {self.backend} backend ..."):
+        if self.backend == "tf":
+            import tensorflow as tf
+
+            self.hhbtag_model_even, self.hhbtag_model_odd = [
+                tf.saved_model.load(model_dir.path)
+                for model_dir in model_dirs
+            ]
+
+            def predict(model, features: np.ndarray) -> np.ndarray:
+                return model(features)[0].numpy()
+
+        else:  # onnx
+            import onnxruntime as ort
+
+            # convert models once and cache them next to the unpacked repository
+            onnx_dir = bundle.files_dir.child(f"hh_btag_onnx_{self.hhbtag_version}", type="d")
+            onnx_files = [onnx_dir.child(f"{model_dir.basename}.onnx", type="f") for model_dir in model_dirs]
+            for model_dir, onnx_file in zip(model_dirs, onnx_files):
+                if not onnx_file.exists():
+                    convert_hhbtag_model(model_dir, onnx_file)
+
+            # create sessions
+            opts = ort.SessionOptions()
+            opts.intra_op_num_threads = self.onnx_intra_op_threads
+            opts.inter_op_num_threads = self.onnx_inter_op_threads
+            opts.execution_mode = (
+                ort.ExecutionMode.ORT_PARALLEL
+                if self.onnx_inter_op_threads > 1
+                else ort.ExecutionMode.ORT_SEQUENTIAL
+            )
+            opts.graph_optimization_level = ort.GraphOptimizationLevel.ORT_ENABLE_ALL
+            self.hhbtag_model_even, self.hhbtag_model_odd = [
+                ort.InferenceSession(onnx_file.path, sess_options=opts, providers=["CPUExecutionProvider"])
+                for onnx_file in onnx_files
+            ]
+
+            def predict(model, features: np.ndarray) -> np.ndarray:
+                return model.run(None, {model.get_inputs()[0].name: features})[0]
+
+    # score cache, grouped by dataset, model version and backend, with one shard per input file
+    self.hhbtag_score_cache = None
+    cache_cfg = self.config_inst.x("hhbtag_score_cache", None)
+    if self.use_score_cache and cache_cfg and cache_cfg.get("path"):
+        self.hhbtag_score_cache = HHBtagScoreCache(
+            os.path.join(
+                cache_cfg["path"],
+                self.config_inst.name,
+                self.dataset_inst.name,
+                f"{self.hhbtag_version}_{self.backend}",
+            ),
+            max_size_mb=cache_cfg.get("max_size_mb", 2000.0),
+            grace_period=cache_cfg.get("grace_period", 6 * 3600.0),
+        )
+        branch = self.task.branch if self.task.is_branch() else "all"
+        self.hhbtag_score_cache.open(f"file_{branch}")
+
+    # evaluation helper that optionally splits inputs into batches
+    def hhbtag_evaluate(model, features: np.ndarray) -> np.ndarray:
+        features = np.ascontiguousarray(features, dtype=np.float32)
+        if not self.batch_size or len(features) <= self.batch_size:
+            return predict(model, features)
+        return np.concatenate(
+            [
+                predict(model, features[start:start + self.batch_size])
+                for start in range(0, len(features), self.batch_size)
+            ],
+            axis=0,
+        )
+
+    self.hhbtag_evaluate = hhbtag_evaluate
+
+
+def convert_hhbtag_model(
+    model_dir: law.LocalDirectoryTarget,
+    onnx_file: law.LocalFileTarget,
+    opset: int = 13,
+    n_validate: int = 1000,
+    atol: float = 1e-5,
+    rtol: float = 1e-4,
+) -> None:
+    """
+    Converts the HHBtag TF SavedModel in *model_dir* to an ONNX model saved at *onnx_file* using
+    tf2onnx with a certain *opset*. Afterwards, scores of both models are compared for *n_validate*
+    random input tensors, raising an exception when they differ by more than *atol* and *rtol*.
+    The conversion is first written to a temporary file that is moved to *onnx_file* only after
+    a successful validation, so that concurrent jobs do not pick up incomplete files.
+    """
+    import tensorflow as tf
+    import onnxruntime as ort
+
+    logger.info(f"converting hhbtag model {model_dir.path} to onnx")
+
+    # run the conversion
+    tmp_file = law.LocalFileTarget(is_tmp=".onnx")
+    cmd = [
+        sys.executable, "-m", "tf2onnx.convert",
+        "--saved-model", model_dir.path,
+        "--output", tmp_file.path,
+        "--opset", str(opset),
+    ]
+    code = law.util.interruptable_popen(cmd, stdout=None, stderr=None)[0]
+    if code != 0:
+        raise Exception(f"hhbtag model conversion failed with exit code {code}")
+
+    # validate against the tf model with random inputs in the range of typical features
+    rng = np.random.default_rng(0)
+    features = rng.normal(0.0, 50.0, size=(n_validate, 10, 15)).astype(np.float32)
+    scores_tf = tf.saved_model.load(model_dir.path)(features)[0].numpy()
+    session = ort.InferenceSession(tmp_file.path, providers=["CPUExecutionProvider"])
+    scores_onnx = session.run(None, {session.get_inputs()[0].name: features})[0]
+    if not np.allclose(scores_tf, scores_onnx, atol=atol, rtol=rtol):
+        max_diff = np.max(np.abs(scores_tf - scores_onnx))
+        raise Exception(
+            f"scores of converted hhbtag model {model_dir.path} differ from tf scores by up to "
+            f"{max_diff}, exceeding atol={atol} and rtol={rtol}",
+        )
+
+    # move to the final location
+    onnx_file.parent.touch()
+    tmp_file.move_to_local(onnx_file)
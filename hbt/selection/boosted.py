@@ -20,6 +20,7 @@ from hbt.selection.jet import jet_selection
 from hbt.selection.lepton import lepton_selection
 from hbt.selection.trigger import trigger_selection
 from hbt.selection.default import increment_stats
+from hbt.selection.cutflow import selection_steps
 from hbt.production.gen_HH_decay import gen_HH_decay_products
 from hbt.selection.genmatching import genmatching_selector
 from hbt.production.delta_r import delta_r, get_pt
@@ -31,47 +32,26 @@ ak = maybe_import("awkward")
 
 
 
-def print_efficiency(results, skip_steps_list1, skip_steps_list2, name_selection1, name_selection2):
-    """
-    calculate and print efficiency between two selections, given by the steps to skip in results
-    """
-    results_reduced1 = reduce(
-        and_,
-        [mask for step_name, mask in results.steps.items() if step_name not in skip_steps_list1],
-    )
-    results_reduced2 = reduce(
-        and_,
-        [mask for step_name, mask in results.steps.items() if step_name not in skip_steps_list2],
-    )
-
-    n_events_results1=ak.sum(results_reduced1, axis=0)
-    n_events_results2=ak.sum(results_reduced2, axis=0)
-
-    print("n_events",name_selection1,n_events_results1)
-    print("n_events",name_selection2,n_events_results2)
-
-    efficiency=n_events_results2/n_events_results1
-    print("efficiency between",name_selection1,"and",name_selection2,efficiency)
-
-
-
-
 @selector(
     uses={boosted_jet_selector, lepton_selection, trigger_selection,
         process_ids, increment_stats, attach_coffea_behavior,
         btag_weights, pu_weight, mc_weight, pdf_weights, murmuf_weights,
         cutflow_features, gen_HH_decay_products, genmatching_selector, delta_r, get_pt,
-        jet_selection
+        jet_selection, selection_steps,
           },
     produces={
         trigger_selection, lepton_selection, boosted_jet_selector,
         process_ids, increment_stats, attach_coffea_behavior,
         btag_weights, pu_weight, mc_weight, pdf_weights, murmuf_weights,
         cutflow_features,
-        jet_selection
+        jet_selection, selection_steps,
     },
     sandbox=dev_sandbox("bash::$HBT_BASE/sandboxes/venv_columnar_tf.sh"),
     exposed=True,
+    # used columns that are no longer needed when the shift independent columns produced by
+    # gen_HH_decay_products are joined from a sidecar, see hbt.tasks.production.ProduceGenSidecar,
+    # while GenJets are still read for the matching chain in genmatching_selector
+    gen_sidecar_columns={"nGenPart", "GenPart.*"},
 )
 def boosted(
     self: Selector,
@@ -114,29 +94,22 @@ def boosted(
         # btag weights
         events = self[btag_weights](events, results.x.jet_mask, **kwargs)
 
-    events = self[gen_HH_decay_products](events, **kwargs)
+    # gen-level products, unless already joined from a sidecar
+    if "genBJetH" not in events.fields:
+        events = self[gen_HH_decay_products](events, **kwargs)
 
     events, genmatching_results = self[genmatching_selector](events, jet_collection=events.Jet, jet_results=jet_results)
     results += genmatching_results
 
-    print_efficiency(results, skip_steps_list1=["gen_matched_1","first_matched","gen_matched_2"], 
-                     skip_steps_list2=["first_matched","gen_matched_2"], name_selection1="jet_selection", 
-                     name_selection2="gen_matched_1")
-    
-    print_efficiency(results, skip_steps_list1=["gen_matched_1","first_matched","gen_matched_2"], 
-                     skip_steps_list2=["gen_matched_2"], name_selection1="jet_selection", 
-                     name_selection2="first_matched")
-    
-    print_efficiency(results, skip_steps_list1=["gen_matched_1","first_matched","gen_matched_2"], 
-                     skip_steps_list2=[], name_selection1="jet_selection", 
-                     name_selection2="gen_matched_2")
-    
-    print_efficiency(results, skip_steps_list1=["first_matched","gen_matched_2"], 
-                     skip_steps_list2=["gen_matched_2"], name_selection1="gen_matched_1", 
-                     name_selection2="first_matched")
+    # efficiencies of the gen matching steps, e.g. of "gen_matched_1" after the jet selection, are
+    # derived for full datasets from the cutflow counts accumulated in increment_stats, see
+    # hbt.selection.cutflow.Cutflow.efficiency
 
     #embed()
 
+    # encode the decisions of all steps in a single column
+    events = self[selection_steps](events, results, **kwargs)
+
     event_sel = reduce(and_, results.steps.values())
     results.main["event"] = event_sel
 
@@ -6,6 +6,10 @@ from columnflow.selection import Selector, SelectionResult, selector
 from columnflow.util import maybe_import, dev_sandbox
 from collections import defaultdict, OrderedDict
 
+from hbt.selection.jet import (
+    get_selected_lepton_indices, get_lepton_separation_mask, get_vanilla_fatjet_mask,
+)
+
 np = maybe_import("numpy")
 ak = maybe_import("awkward")
 
@@ -26,14 +30,8 @@ def boosted_jet_selector(
     **kwargs,
 ) -> tuple[ak.Array, SelectionResult]:
     # check whether the two bjets were matched by fatjet subjets to mark it as boosted
-    fatjet_mask = (
-        (events.FatJet.jetId == 6) &  # tight plus lepton veto
-        (events.FatJet.msoftdrop > 30.0) &
-        (abs(events.FatJet.eta) < 2.4) &
-        ak.all(events.FatJet.metric_table(lepton_results.x.lepton_pair) > 0.5, axis=2) &  # metric_table = delta R
-        (events.FatJet.subJetIdx1 >= 0) &
-        (events.FatJet.subJetIdx2 >= 0)
-    )
+    lepton_indices = get_selected_lepton_indices(lepton_results)
+    fatjet_mask = get_vanilla_fatjet_mask(events, lepton_indices)
 
     fatjet_indices = ak.local_index(events.FatJet.pt)[fatjet_mask]
     # sorted_indices = ak.argsort(events.FatJet.pt, axis=-1, ascending=False)
@@ -51,7 +49,7 @@ def boosted_jet_selector(
     ak4_mask = (
         (events.Jet.jetId == 6) &  # tight plus lepton veto
         ((events.Jet.pt >= 50.0) | (events.Jet.puId == (1 if is_2016 else 4))) &  # flipped in 2016
-        ak.all(events.Jet.metric_table(lepton_results.x.lepton_pair) > 0.5, axis=2)
+        get_lepton_separation_mask(events, events.Jet, lepton_indices, 0.5)
     )
 
     # default jets
@@ -0,0 +1,237 @@
+# coding: utf-8
+
+"""
+Cutflow bookkeeping based on per-event bitmasks of selection steps.
+"""
+
+from __future__ import annotations
+
+from collections import OrderedDict
+
+from columnflow.selection import Selector, SelectionResult, selector
+from columnflow.columnar_util import set_ak_column
+from columnflow.util import maybe_import
+
+
+np = maybe_import("numpy")
+ak = maybe_import("awkward")
+
+
+def pack_steps(steps: dict[str, ak.Array]) -> np.ndarray:
+    """
+    Packs the boolean event masks of all *steps* into a single integer bitmask per event, with bit
+    *i* denoting whether the *i*-th step was passed.
+    """
+    if len(steps) > 63:
+        raise ValueError(f"cannot pack more than 63 steps into a bitmask, got {len(steps)}")
+
+    bitmask = None
+    for i, mask in enumerate(steps.values()):
+        bits = np.asarray(ak.to_numpy(mask), dtype=np.int64) << i
+        bitmask = bits if bitmask is None else (bitmask | bits)
+    return bitmask
+
+
+def accumulate_cutflow(
+    stats: dict,
+    steps: dict[str, ak.Array],
+    weights: dict[str, ak.Array] | None = None,
+) -> None:
+    """
+    Counts events per pattern of passed and failed *steps* and adds the counts to the selection
+    *stats* in-place, along with the sums of all *weights* given by name. Entries are stored as
+
+    .. code-block:: python
+
+        stats["cutflow"][<comma separated step names>][<"n_events" or "sum_<weight name>">][<bitmask>]
+
+    so that they merge across chunks and files by simple addition of all leaves. Patterns are
+    counted with a single ``np.bincount`` per entry and only patterns that occur are stored.
+    Use :py:class:`Cutflow` to derive cutflow and efficiency tables.
+    """
+    bitmask = pack_steps(steps)
+
+    # count events per pattern, and sum weights for occurring patterns
+    entries = OrderedDict([("n_events", np.bincount(bitmask))])
+    patterns = np.flatnonzero(entries["n_events"])
+    for name, w in (weights or {}).items():
+        w = np.asarray(ak.to_numpy(w), dtype=np.float64)
+        entries[f"sum_{name}"] = np.bincount(bitmask, weights=w)
+
+    # add to stats
+    cutflow = stats.setdefault("cutflow", {}).setdefault(",".join(steps), {})
+    for key, counts in entries.items():
+        dst = cutflow.setdefault(key, {})
+        for pattern in patterns:
+            dst[str(pattern)] = dst.get(str(pattern), 0) + counts[pattern].item()
+
+
+@selector(
+    produces={"selection_steps"},
+)
+def selection_steps(
+    self: Selector,
+    events: ak.Array,
+    results: SelectionResult,
+    **kwargs,
+) -> ak.Array:
+    """
+    Encodes the decisions of all steps in the selection *results* in a uint64 ``selection_steps``
+    column, following the bit registry in ``config_inst.x.selection_step_bits``. All steps must be
+    registered, so steps derived from others (such as ``all_but_bjet``) should be added to the
+    *results* only afterwards. Use :py:meth:`Cutflow.from_column` to query the column.
+    """
+    step_bits = self.config_inst.x.selection_step_bits
+    unknown = set(results.steps) - set(step_bits)
+    if unknown:
+        raise ValueError(
+            f"selection steps {','.join(sorted(unknown))} are missing in the bit registry "
+            "config.x.selection_step_bits",
+        )
+
+    column = np.zeros(len(events), dtype=np.uint64)
+    for name, mask in results.steps.items():
+        column |= np.asarray(ak.to_numpy(mask), dtype=np.uint64) << np.uint64(step_bits[name])
+
+    return set_ak_column(events, "selection_steps", column)
+
+
+class Cutflow(object):
+    """
+    Cutflow and efficiency tables derived from pattern counts of selection *steps* as accumulated by
+    :py:func:`accumulate_cutflow`. *patterns* is an array of occurring bitmasks and *counts* maps
+    entry names (such as ``"n_events"`` or ``"sum_mc_weight"``) to arrays with one value per
+    pattern. All tables are obtained by summing over patterns, without access to individual events.
+    """
+
+    @classmethod
+    def from_stats(cls, stats: dict, steps: str | None = None) -> Cutflow:
+        """
+        Creates a cutflow from (merged) selection *stats*. When the stats contain counts for
+        multiple sequences of steps, the comma separated *steps* to use must be given.
+        """
+        cutflows = stats["cutflow"]
+        if steps is None:
+            if len(cutflows) != 1:
+                raise ValueError(
+                    f"stats contain cutflows for {len(cutflows)} sequences of steps, choose one of "
+                    f"{', '.join(cutflows)}",
+                )
+            steps = list(cutflows)[0]
+
+        entries = cutflows[steps]
+        patterns = sorted(set.union(*(set(map(int, d)) for d in entries.values())))
+        counts = {
+            key: np.array([d.get(str(pattern), 0.0) for pattern in patterns], dtype=np.float64)
+            for key, d in entries.items()
+        }
+
+        return cls(steps.split(","), np.array(patterns, dtype=np.int64), counts)
+
+    @classmethod
+    def from_column(
+        cls,
+        column: np.ndarray | ak.Array,
+        step_bits: dict[str, int],
+        weights: dict[str, np.ndarray | ak.Array] | None = None,
+    ) -> Cutflow:
+        """
+        Creates a cutflow from a ``selection_steps`` *column* as produced by
+        :py:func:`selection_steps` and the bit registry *step_bits* it was encoded with, optionally
+        summing *weights* given by name.
+        """
+        if sorted(step_bits.values()) != list(range(len(step_bits))):
+            raise ValueError(f"step bits must be contiguous and start at 0, got {step_bits}")
+        if len(step_bits) > 63:
+            raise ValueError(f"cannot query more than 63 steps, got {len(step_bits)}")
+        steps = sorted(step_bits, key=step_bits.get)
+
+        # count events per occurring pattern
+        patterns, inverse = np.unique(np.asarray(column, dtype=np.int64), return_inverse=True)
+        counts = {"n_events": np.bincount(inverse, minlength=len(patterns)).astype(np.float64)}
+        for name, w in (weights or {}).items():
+            w = np.asarray(ak.to_numpy(w), dtype=np.float64)
+            counts[f"sum_{name}"] = np.bincount(inverse, weights=w, minlength=len(patterns))
+
+        return cls(steps, patterns, counts)
+
+    def __init__(self, steps: list[str], patterns: np.ndarray, counts: dict[str, np.ndarray]) -> None:
+        super().__init__()
+
+        self.steps = list(steps)
+        self.patterns = patterns
+        self.counts = counts
+
+    def __repr__(self) -> str:
+        return f"<{self.__class__.__name__} steps={','.join(self.steps)} at {hex(id(self))}>"
+
+    def get_bits(self, steps: list[str] | tuple[str, ...]) -> tuple[int, int]:
+        """
+        Returns the bitmasks of the given *steps* that must have passed and failed, respectively.
+        """
+        passed, failed = 0, 0
+        for step in steps:
+            if step.startswith("!"):
+                failed |= 1 << self.steps.index(step[1:])
+            else:
+                passed |= 1 << self.steps.index(step)
+        return passed, failed
+
+    def passed(self, steps: list[str] | tuple[str, ...], key: str = "n_events") -> float:
+        """
+        Returns the count *key* of events passing all *steps*.
+        """
+        passed, failed = self.get_bits(steps)
+        mask = ((self.patterns & passed) == passed) & ((self.patterns & failed) == 0)
+        return float(self.counts[key][mask].sum())
+
+    def efficiency(
+        self,
+        steps_a: list[str] | tuple[str, ...],
+        steps_b: list[str] | tuple[str, ...],
+        key: str = "n_events",
+    ) -> float:
+        """
+        Returns the fraction of events passing all *steps_b* among those passing all *steps_a*,
+        with respect to the count *key*.
+        """
+        n_a = self.passed(steps_a, key=key)
+        n_ab = self.passed(list(steps_a) + list(steps_b), key=key)
+        return n_ab / n_a if n_a else np.nan
+
+    def sequential(
+        self,
+        key: str = "n_events",
+        steps: list[str] | tuple[str, ...] | None = None,
+    ) -> OrderedDict[str, tuple[float, float]]:
+        """
+        Returns an ordered mapping of step names to the count *key* of events passing this and all
+        previous steps, and the efficiency relative to the previous step. By default, all steps are
+        considered in their original order, which can be changed by passing *steps*.
+        """
+        steps = list(self.steps if steps is None else steps)
+        table = OrderedDict()
+        prev = float(self.counts[key].sum())
+        for i, step in enumerate(steps):
+            n = self.passed(steps[:i + 1], key=key)
+            table[step] = (n, n / prev if prev else np.nan)
+            prev = n
+        return table
+
+    def n_minus_one(
+        self,
+        key: str = "n_events",
+        steps: list[str] | tuple[str, ...] | None = None,
+    ) -> OrderedDict[str, tuple[float, float]]:
+        """
+        Returns an ordered mapping of step names to the count *key* of events passing all other
+        steps, and the efficiency of the step for these events. By default, all steps are
+        considered, which can be restricted by passing *steps*.
+        """
+        steps = list(self.steps if steps is None else steps)
+        table = OrderedDict()
+        n_all = self.passed(steps, key=key)
+        for step in steps:
+            n = self.passed([s for s in steps if s != step], key=key)
+            table[step] = (n, n_all / n if n else np.nan)
+        return table
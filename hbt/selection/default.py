@@ -4,6 +4,8 @@
 Selection methods.
 """
 
+from __future__ import annotations
+
 from operator import and_
 from functools import reduce
 from collections import defaultdict, OrderedDict
@@ -18,11 +20,13 @@ from columnflow.production.cms.pdf import pdf_weights
 from columnflow.production.cms.scale import murmuf_weights
 from columnflow.production.cms.btag import btag_weights
 from columnflow.production.util import attach_coffea_behavior
-from columnflow.util import maybe_import, dev_sandbox
+from columnflow.columnar_util import set_ak_column
+from columnflow.util import DotDict, maybe_import, dev_sandbox
 
 from hbt.selection.trigger import trigger_selection
 from hbt.selection.lepton import lepton_selection
 from hbt.selection.jet import jet_selection
+from hbt.selection.cutflow import accumulate_cutflow, selection_steps
 from hbt.production.features import cutflow_features
 
 
@@ -55,6 +59,19 @@ def increment_stats(
     stats["n_events"] += len(events)
     stats["n_events_selected"] += ak.sum(event_mask, axis=0)
 
+    # accumulate counts per pattern of passed steps to derive cutflows and efficiencies later on
+    accumulate_cutflow(
+        stats,
+        {name: mask for name, mask in results.steps.items() if name != "all_but_bjet"},
+        weights={"mc_weight": events.mc_weight} if self.dataset_inst.is_mc else None,
+    )
+
+    # lookups of the trigger leg cache for profiling
+    if results.has_aux("trigger_leg_cache"):
+        hits, misses = results.x.trigger_leg_cache.pop_counts()
+        stats["n_trigger_leg_cache_hits"] += hits
+        stats["n_trigger_leg_cache_misses"] += misses
+
     # get a list of unique jet multiplicities present in the chunk
     unique_process_ids = np.unique(events.process_id)
     unique_n_jets = []
@@ -143,65 +160,154 @@ def increment_stats(
     uses={
         json_filter, met_filters, trigger_selection, lepton_selection, jet_selection, mc_weight,
         pdf_weights, murmuf_weights, pu_weight, btag_weights, process_ids, cutflow_features,
-        increment_stats, attach_coffea_behavior,
+        increment_stats, attach_coffea_behavior, selection_steps,
     },
     produces={
         trigger_selection, lepton_selection, jet_selection, mc_weight,
         pdf_weights, murmuf_weights, pu_weight, btag_weights, process_ids, cutflow_features,
-        increment_stats,
+        increment_stats, selection_steps,
     },
     sandbox=dev_sandbox("bash::$HBT_BASE/sandboxes/venv_columnar_tf.sh"),
     exposed=True,
+    # whether expensive steps (such as the hhbtag evaluation) should skip events that already
+    # failed previous steps, which then also fail the jet and bjet steps (see below)
+    skip_dead_events=True,
+    # used columns that can be loaded lazily through a load_deferred_columns function
+    deferred_columns=jet_selection.deferred_columns,
 )
 def default(
     self: Selector,
     events: ak.Array,
     stats: defaultdict,
+    shift_cache: dict | None = None,
+    shifted_columns: set[str] | None = None,
     **kwargs,
 ) -> tuple[ak.Array, SelectionResult]:
+    """
+    Default selection. When the same chunk is selected multiple times for different shifts, a
+    *shift_cache* dictionary can be passed to all calls to evaluate shift-invariant steps only once
+    and reuse their results and columns in subsequent calls. The first call is expected to be the
+    nominal one, and *shifted_columns* should name the columns altered by the shift of each call.
+    The lepton selection is reused entirely when no lepton columns are shifted (e.g. for jec or jer
+    shifts), and otherwise only its electron and muon parts (e.g. for tec shifts).
+
+    When *skip_dead_events* is *True*, the hhbtag scores are only evaluated for events that passed
+    all steps up to the jet selection, and the number of skipped evaluations is stored in the
+    *stats*. The final event selection is unaffected. Skipped events are marked as failing the jet
+    and bjet steps instead of deciding on default scores, so the selection_steps column and the
+    cutflow counts in the *stats* never contain decisions based on meaningless inputs. Sequential
+    cutflows in the original step order are exact, while N-1 counts of steps before the jet
+    selection only include events for which the jet steps were evaluated, i.e., the ones passing
+    all previous steps. Disable it (e.g. in derived selectors) to evaluate the jet steps for all
+    events.
+
+    Callers can choose not to read the *deferred_columns* upfront, but to pass a function
+    *load_deferred_columns* instead, which is forwarded to the jet selection.
+    """
     # ensure coffea behavior
     events = self[attach_coffea_behavior](events, **kwargs)
 
-    # add corrected mc weights
-    if self.dataset_inst.is_mc:
-        events = self[mc_weight](events, **kwargs)
-
     # prepare the selection results that are updated at every step
     results = SelectionResult()
 
-    # filter bad data events according to golden lumi mask
-    if self.dataset_inst.is_data:
-        results.steps["golden"] = self[json_filter](events, **kwargs)
-
-    # met filter selection
-    results.steps["met_filter"] = self[met_filters](events, **kwargs)
+    # shift-invariant steps
+    if shift_cache is not None and "default" in shift_cache:
+        cached = shift_cache["default"]
+        for route, column in cached.columns.items():
+            events = set_ak_column(events, route, column)
+        trigger_results = cached.trigger_results
+        results.steps.update(cached.steps)
+    else:
+        # add corrected mc weights
+        if self.dataset_inst.is_mc:
+            events = self[mc_weight](events, **kwargs)
+
+        # filter bad data events according to golden lumi mask
+        if self.dataset_inst.is_data:
+            results.steps["golden"] = self[json_filter](events, **kwargs)
+
+        # met filter selection
+        results.steps["met_filter"] = self[met_filters](events, **kwargs)
+
+        # trigger selection
+        events, trigger_results = self[trigger_selection](events, **kwargs)
+
+        # mc-only weights that do not depend on the selection
+        if self.dataset_inst.is_mc:
+            # pdf weights
+            events = self[pdf_weights](events, **kwargs)
+
+            # renormalization/factorization scale weights
+            events = self[murmuf_weights](events, **kwargs)
+
+            # pileup weights
+            events = self[pu_weight](events, **kwargs)
+
+        # store results and produced columns for reuse
+        if shift_cache is not None:
+            funcs = [trigger_selection]
+            if self.dataset_inst.is_mc:
+                funcs += [mc_weight, pdf_weights, murmuf_weights, pu_weight]
+            shift_cache["default"] = DotDict(
+                columns={
+                    route: route.apply(events)
+                    for func in funcs
+                    for route in self[func].produced_columns
+                },
+                trigger_results=trigger_results,
+                steps=dict(results.steps),
+            )
 
-    # trigger selection
-    events, trigger_results = self[trigger_selection](events, **kwargs)
     results += trigger_results
 
     # lepton selection
-    events, lepton_results = self[lepton_selection](events, trigger_results, **kwargs)
+    leptons_shifted = any(
+        col.startswith(("Electron.", "Muon.", "Tau."))
+        for col in (shifted_columns or ())
+    )
+    if shift_cache is not None and not leptons_shifted and "lepton_selection" in shift_cache:
+        cached = shift_cache["lepton_selection"]
+        for route, column in cached.columns.items():
+            events = set_ak_column(events, route, column)
+        lepton_results = cached.lepton_results
+    else:
+        events, lepton_results = self[lepton_selection](
+            events,
+            trigger_results,
+            shift_cache=shift_cache,
+            **kwargs,
+        )
+        # store results and produced columns for reuse
+        if shift_cache is not None and not leptons_shifted:
+            shift_cache["lepton_selection"] = DotDict(
+                columns={
+                    route: route.apply(events)
+                    for route in self[lepton_selection].produced_columns
+                },
+                lepton_results=lepton_results,
+            )
     results += lepton_results
 
-    # jet selection
-    events, jet_results = self[jet_selection](events, trigger_results, lepton_results, **kwargs)
+    # jet selection, optionally evaluating expensive producers only for events that are still alive
+    alive_mask = reduce(and_, results.steps.values()) if self.skip_dead_events else None
+    events, jet_results = self[jet_selection](
+        events,
+        trigger_results,
+        lepton_results,
+        alive_mask=alive_mask,
+        stats=stats,
+        **kwargs,
+    )
     results += jet_results
 
     # mc-only functions
     if self.dataset_inst.is_mc:
-        # pdf weights
-        events = self[pdf_weights](events, **kwargs)
-
-        # renormalization/factorization scale weights
-        events = self[murmuf_weights](events, **kwargs)
-
-        # pileup weights
-        events = self[pu_weight](events, **kwargs)
-
         # btag weights
         events = self[btag_weights](events, results.x.jet_mask, **kwargs)
 
+    # encode the decisions of all steps in a single column
+    events = self[selection_steps](events, results, **kwargs)
+
     # combined event selection after all steps
     event_sel = reduce(and_, results.steps.values())
     results.main["event"] = event_sel
@@ -7,9 +7,9 @@ from columnflow.util import maybe_import, dev_sandbox
 from columnflow.columnar_util import set_ak_column
 
 from collections import defaultdict, OrderedDict
-from IPython import embed
 
 from hbt.production.gen_HH_decay import gen_HH_decay_products
+from hbt.columnar_util import ragged_isin, chain_delta_r_matches
 
 
 np = maybe_import("numpy")
@@ -36,38 +36,22 @@ def genmatching_selector(
     **kwargs,
 ) -> tuple[ak.Array, SelectionResult]:
     
-    # match genJets to genPartons from H
-    # get GenJets with b as partonFlavour
-    genBjets = events.GenJet[abs(events.GenJet.partonFlavour) == 5]
-
-    # calculate deltaR between genBjets and gen b partons from H
-    nearest_genjet_to_parton = events.genBpartonH.nearest(genBjets, threshold=0.4)
-
-    # filter unmatched cases
-    unmatched_genjets = ak.is_none(nearest_genjet_to_parton.pt, axis=1)
-
-    matched_genjets_to_parton = nearest_genjet_to_parton[~unmatched_genjets]
+    # match gen b partons from H to GenJets with b as parton flavour and further to jets, uniquely
+    # and greedily by deltaR in each stage
+    chain = chain_delta_r_matches(
+        [events.genBpartonH, events.GenJet, jet_collection],
+        0.4,
+        masks=[None, abs(events.GenJet.partonFlavour) == 5, None],
+    )
 
-    # calculated deltaR between matched Gen Jets and Jets
-    nearest_jets_to_genjets = matched_genjets_to_parton.nearest(jet_collection, threshold=0.4)
-    
-    metrics_jets_to_genjets = matched_genjets_to_parton.metric_table(jet_collection, axis=1)
-    
-    mmin = ak.argmin(metrics_jets_to_genjets, axis=2, keepdims=True)
-    metric = ak.firsts(metrics_jets_to_genjets[mmin], axis=2)
-    
-    mmin = ak.firsts(mmin.mask[metric <= 0.4], axis=2)
+    # indices of jets matched to gen b partons through GenJets, ordered by partons
+    mmin = chain.index[chain.index >= 0]
 
-     # filter unmatched cases
-    unmatched_jets = ak.is_none(nearest_jets_to_genjets.pt, axis=1)
+    selected_bjet_indices = ak.pad_none(jet_results.objects.Jet.HHBJet, 2, axis=1)
 
-    matched_jets_to_genjets = nearest_jets_to_genjets[~unmatched_jets]
-    selected_bjet_indices=ak.pad_none(jet_results.objects.Jet.HHBJet,2,axis=1)
-    padded_mmin=ak.pad_none(mmin,2,axis=1)
-   
     # implement comparison selection and matching in array matched_and_selected
     # each genjet has (at least) one btag jet
-    matched_and_selected = ak.from_iter([np.isin(selected_bjet_indices[index], padded_mmin[index]) for index in range(len(padded_mmin))])
+    matched_and_selected = ragged_isin(selected_bjet_indices, mmin)
 
     # event selection:
     at_least_one_jet_matched_event_selection=(
@@ -86,8 +70,6 @@ def genmatching_selector(
     # events = set_ak_column(events, "Jet.GenmatchedJets", events.Jet[mmin])
     # events = set_ak_column(events, "Jet.GenmatchedHHBtagJets", events.Jet[selected_bjet_indices][matched_and_selected])
 
-    embed()
-    print("genmatching_done")
     return events, SelectionResult(
     steps={
         # Gen Matching Steps
@@ -4,36 +4,337 @@
 Jet selection methods.
 """
 
-from operator import or_
+from __future__ import annotations
+
+from operator import and_
 from functools import reduce
+from typing import Callable
 
 from columnflow.selection import Selector, SelectionResult, selector
-from columnflow.util import maybe_import
-from columnflow.columnar_util import set_ak_column
+from columnflow.util import DotDict, maybe_import
+from columnflow.columnar_util import Route, set_ak_column, flat_np_view, layout_ak_array
 
 from hbt.production.hhbtag import hhbtag
+from hbt.selection.trigger import fired_only
+from hbt.columnar_util import (
+    get_offsets, all_beyond_delta_r, masked_argsort, masked_top_k, padded_to_ragged,
+)
+from hbt.util import njit
 from IPython import embed
 
 np = maybe_import("numpy")
 ak = maybe_import("awkward")
 
 
+def get_selected_lepton_indices(lepton_results: SelectionResult) -> dict[str, ak.Array]:
+    """
+    Returns the indices of selected electrons, muons and taus in *lepton_results*, mapped to the
+    names of their collections.
+    """
+    return {
+        coll: lepton_results.objects[coll][coll]
+        for coll in ["Electron", "Muon", "Tau"]
+    }
+
+
+def get_lepton_separation_mask(
+    events: ak.Array,
+    objects: ak.Array,
+    lepton_indices: dict[str, ak.Array],
+    threshold: float = 0.5,
+) -> ak.Array:
+    """
+    Returns the mask of *objects* that are separated by a delta R above *threshold* from all
+    leptons in *events* selected by *lepton_indices* (see :py:func:`get_selected_lepton_indices`),
+    checking each lepton collection separately.
+    """
+    return reduce(and_, (
+        all_beyond_delta_r(objects, events[coll][indices], threshold)
+        for coll, indices in lepton_indices.items()
+    ))
+
+
+def get_vanilla_fatjet_mask(events: ak.Array, lepton_indices: dict[str, ak.Array]) -> ak.Array:
+    """
+    Returns the mask of fatjets in *events* passing the tight jet id with lepton veto, the soft drop
+    mass and eta requirements, that are separated from all leptons selected by *lepton_indices*
+    (see :py:func:`get_selected_lepton_indices`), and that have two valid subjets.
+    """
+    return (
+        (events.FatJet.jetId == 6) &  # tight plus lepton veto
+        (events.FatJet.msoftdrop > 30.0) &
+        (abs(events.FatJet.eta) < 2.4) &
+        get_lepton_separation_mask(events, events.FatJet, lepton_indices, 0.5) &
+        (events.FatJet.subJetIdx1 >= 0) &
+        (events.FatJet.subJetIdx2 >= 0)
+    )
+
+
+@njit
+def _match_fatjet_subjets(
+    fatjet_offsets: np.ndarray,
+    fatjet_mask: np.ndarray,
+    subjet_idx1: np.ndarray,
+    subjet_idx2: np.ndarray,
+    subjet_offsets: np.ndarray,
+    subjet_eta: np.ndarray,
+    subjet_phi: np.ndarray,
+    subjet_btag: np.ndarray,
+    jet_offsets: np.ndarray,
+    jet_eta: np.ndarray,
+    jet_phi: np.ndarray,
+    hhbjet_indices: np.ndarray,
+    btag_wp: float,
+    threshold: float,
+) -> tuple[np.ndarray, np.ndarray]:
+    """
+    Kernel that decides for each fatjet passing *fatjet_mask* whether each of its valid subjets is
+    within delta R *threshold* of exactly one of the two hh bjets given per event by their local
+    *hhbjet_indices* (-1 for missing ones), requiring at most four distance evaluations per fatjet.
+    Returns the flat fatjet match mask and a per-event flag denoting whether all subjets of the
+    first matched fatjet are b-tagged above *btag_wp* (true if there is no matched fatjet).
+    """
+    n_events = len(fatjet_offsets) - 1
+    matched = np.zeros(len(fatjet_mask), dtype=np.bool_)
+    btagged = np.ones(n_events, dtype=np.bool_)
+
+    for e in range(n_events):
+        if hhbjet_indices[e, 0] < 0 or hhbjet_indices[e, 1] < 0:
+            continue
+        first = True
+        for f in range(fatjet_offsets[e], fatjet_offsets[e + 1]):
+            if not fatjet_mask[f]:
+                continue
+            match = True
+            for s_local in (subjet_idx1[f], subjet_idx2[f]):
+                if s_local < 0:
+                    continue
+                s = subjet_offsets[e] + s_local
+                n_close = 0
+                for b in range(2):
+                    j = jet_offsets[e] + hhbjet_indices[e, b]
+                    deta = subjet_eta[s] - jet_eta[j]
+                    dphi = (subjet_phi[s] - jet_phi[j] + np.pi) % (2 * np.pi) - np.pi
+                    if np.sqrt(deta**2 + dphi**2) < threshold:
+                        n_close += 1
+                if n_close != 1:
+                    match = False
+                    break
+            if not match:
+                continue
+            matched[f] = True
+
+            # b-tag decision of the first matched fatjet
+            if first:
+                first = False
+                for s_local in (subjet_idx1[f], subjet_idx2[f]):
+                    if s_local >= 0 and not subjet_btag[subjet_offsets[e] + s_local] > btag_wp:
+                        btagged[e] = False
+
+    return matched, btagged
+
+
+def match_fatjet_subjets(
+    events: ak.Array,
+    fatjet_mask: ak.Array,
+    hhbjet_indices: ak.Array,
+    btag_wp: float,
+    threshold: float = 0.4,
+) -> DotDict:
+    """
+    Matches the subjets of fatjets passing *fatjet_mask* to the two hh bjets referred to by
+    *hhbjet_indices*, requiring each valid subjet to be within delta R *threshold* of exactly one
+    of them, and events to have two hh bjets. Returns a DotDict with the final ``fatjet_mask``, the
+    ``fatjet_indices`` of matched fatjets, their ``subjet_indices`` with shape (events, fatjets, 2),
+    and a per-event flag ``subjets_btagged`` that is true if there is no matched fatjet or if the
+    subjets of the first one pass the b-tag working point *btag_wp*.
+    """
+    fatjets = events.FatJet
+    padded_hhbjet_indices = ak.to_numpy(ak.fill_none(
+        ak.pad_none(hhbjet_indices, 2, axis=1, clip=True),
+        -1,
+    )).astype(np.int64)
+    subjet_idx1 = flat_np_view(fatjets.subJetIdx1, axis=1)
+    subjet_idx2 = flat_np_view(fatjets.subJetIdx2, axis=1)
+
+    matched, subjets_btagged = _match_fatjet_subjets(
+        get_offsets(fatjets.pt),
+        flat_np_view(fatjet_mask, axis=1),
+        subjet_idx1,
+        subjet_idx2,
+        get_offsets(events.SubJet.pt),
+        flat_np_view(events.SubJet.eta, axis=1),
+        flat_np_view(events.SubJet.phi, axis=1),
+        flat_np_view(events.SubJet.btagDeepB, axis=1),
+        get_offsets(events.Jet.pt),
+        flat_np_view(events.Jet.eta, axis=1),
+        flat_np_view(events.Jet.phi, axis=1),
+        padded_hhbjet_indices,
+        float(btag_wp),
+        float(threshold),
+    )
+
+    fatjet_mask = layout_ak_array(matched, fatjets.pt)
+    counts = ak.sum(fatjet_mask, axis=1)
+    subjet_indices = ak.unflatten(
+        ak.from_regular(np.stack([subjet_idx1[matched], subjet_idx2[matched]], axis=1), axis=1),
+        counts,
+    )
+
+    return DotDict(
+        fatjet_mask=fatjet_mask,
+        fatjet_indices=ak.local_index(fatjets.pt)[fatjet_mask],
+        subjet_indices=subjet_indices,
+        subjets_btagged=subjets_btagged,
+    )
+
+
+@njit
+def _find_vbf_pairs(
+    offsets: np.ndarray,
+    mask: np.ndarray,
+    pt: np.ndarray,
+    eta: np.ndarray,
+    px: np.ndarray,
+    py: np.ndarray,
+    pz: np.ndarray,
+    energy: np.ndarray,
+    cross_mask: np.ndarray,
+    min_mjj: float,
+    min_delta_eta: float,
+    cross_min_mjj: float,
+    cross_min_pt1: float,
+    cross_min_pt2: float,
+) -> np.ndarray:
+    """
+    Kernel that finds per event the pair of jets passing *mask* with the highest invariant mass
+    above *min_mjj* and with an absolute eta difference above *min_delta_eta*. In events flagged by
+    *cross_mask*, the pair must also have a mass above *cross_min_mjj* and leading and subleading pt
+    above *cross_min_pt1* and *cross_min_pt2*. Returns local indices of the pair ordered by pt with
+    shape ``(n_events, 2)``, or -1 when no pair is found.
+    """
+    n_events = len(offsets) - 1
+    out = np.full((n_events, 2), -1, dtype=np.int64)
+
+    min_m2 = min_mjj**2
+    cross_min_m2 = cross_min_mjj**2
+
+    for e in range(n_events):
+        best_m2 = -1.0
+        best_i = -1
+        best_j = -1
+        for i in range(offsets[e], offsets[e + 1]):
+            if not mask[i]:
+                continue
+            for j in range(i + 1, offsets[e + 1]):
+                if not mask[j]:
+                    continue
+                if abs(eta[i] - eta[j]) <= min_delta_eta:
+                    continue
+                m2 = (
+                    (energy[i] + energy[j])**2 -
+                    (px[i] + px[j])**2 -
+                    (py[i] + py[j])**2 -
+                    (pz[i] + pz[j])**2
+                )
+                if m2 <= min_m2 or m2 <= best_m2:
+                    continue
+                if cross_mask[e] and (
+                    m2 <= cross_min_m2 or
+                    max(pt[i], pt[j]) <= cross_min_pt1 or
+                    min(pt[i], pt[j]) <= cross_min_pt2
+                ):
+                    continue
+                best_m2 = m2
+                best_i = i
+                best_j = j
+
+        if best_i >= 0:
+            # order by pt, keeping the original order for equal values
+            if pt[best_j] > pt[best_i]:
+                best_i, best_j = best_j, best_i
+            out[e, 0] = best_i - offsets[e]
+            out[e, 1] = best_j - offsets[e]
+
+    return out
+
+
+def find_vbf_pairs(
+    jets: ak.Array,
+    mask: ak.Array,
+    cross_mask: np.ndarray,
+    min_mjj: float,
+    min_delta_eta: float,
+    cross_min_mjj: float,
+    cross_min_pt1: float,
+    cross_min_pt2: float,
+) -> ak.Array:
+    """
+    Returns the indices of the two *jets* passing *mask* that form the vbf pair with the highest
+    invariant mass, ordered by pt, or an empty list for events without a valid pair. See
+    :py:func:`_find_vbf_pairs` for the requirements. Pairs are evaluated in a single pass over flat
+    jet buffers without building all combinations.
+    """
+    pt = flat_np_view(jets.pt, axis=1).astype(np.float64)
+    eta = flat_np_view(jets.eta, axis=1).astype(np.float64)
+    phi = flat_np_view(jets.phi, axis=1).astype(np.float64)
+    mass = flat_np_view(jets.mass, axis=1).astype(np.float64)
+    pz = pt * np.sinh(eta)
+    indices = _find_vbf_pairs(
+        get_offsets(jets.pt),
+        flat_np_view(mask, axis=1),
+        pt,
+        eta,
+        pt * np.cos(phi),
+        pt * np.sin(phi),
+        pz,
+        np.sqrt(pt**2 + pz**2 + mass**2),
+        np.asarray(cross_mask, dtype=bool),
+        float(min_mjj),
+        float(min_delta_eta),
+        float(cross_min_mjj),
+        float(cross_min_pt1),
+        float(cross_min_pt2),
+    )
+    found = indices[:, 0] >= 0
+    return ak.unflatten(indices[found].ravel(), 2 * found)
+
+
+def expand_to_events(array: ak.Array, indices: np.ndarray, n_events: int) -> ak.Array:
+    """
+    Expands a ragged *array* that was obtained for the subset of events at *indices* back to
+    *n_events* events, inserting empty lists for all other events.
+    """
+    counts = np.zeros(n_events, dtype=np.int64)
+    counts[indices] = ak.num(array, axis=1)
+    return ak.unflatten(ak.flatten(array, axis=1), counts)
+
+
+# nano columns only needed to identify boosted topologies, which can be loaded lazily
+# (the FatJet counter is excluded as other FatJet columns are used for all events, e.g. in the
+# cutflow features, and these columns are merged into the existing collection instead)
+boosted_columns = {
+    "FatJet.pt", "FatJet.eta", "FatJet.phi", "FatJet.mass", "FatJet.msoftdrop",
+    "FatJet.jetId", "FatJet.subJetIdx1", "FatJet.subJetIdx2",
+    "nSubJet", "SubJet.pt", "SubJet.eta", "SubJet.phi", "SubJet.mass", "SubJet.btagDeepB",
+}
+
+
 @selector(
     uses={
         hhbtag,
         # custom columns created upstream, probably by a selector
-        "trigger_ids",
+        "trigger_mask",
         # nano columns
         "nJet", "Jet.pt", "Jet.eta", "Jet.phi", "Jet.mass", "Jet.jetId", "Jet.puId",
         "Jet.btagDeepFlavB",
-        "nFatJet", "FatJet.pt", "FatJet.eta", "FatJet.phi", "FatJet.mass", "FatJet.msoftdrop",
-        "FatJet.jetId", "FatJet.subJetIdx1", "FatJet.subJetIdx2",
-        "nSubJet", "SubJet.pt", "SubJet.eta", "SubJet.phi", "SubJet.mass", "SubJet.btagDeepB",
-    },
+    } | boosted_columns,
     produces={
         # new columns
         "Jet.hhbtag",
     },
+    # used columns that callers may choose not to read upfront, see below
+    deferred_columns=boosted_columns,
     # shifts are declared dynamically below in jet_selection_init
 )
 def jet_selection(
@@ -41,10 +342,21 @@ def jet_selection(
     events: ak.Array,
     trigger_results: SelectionResult,
     lepton_results: SelectionResult,
+    alive_mask: ak.Array | None = None,
+    load_deferred_columns: Callable[[np.ndarray], ak.Array] | None = None,
     **kwargs,
 ) -> tuple[ak.Array, SelectionResult]:
     """
-    Jet selection based on ultra-legacy recommendations.
+    Jet selection based on ultra-legacy recommendations. When an *alive_mask* of events that can
+    still pass the full selection is given, hhbtag scores are only evaluated for these events, and
+    all other events have no hh bjets and fail the jet and bjet steps.
+
+    Boosted topologies are only identified for events with two hh bjets, so fatjet related objects
+    and the *vanilla_fatjet_mask* in the auxiliary results are empty for all other events. The
+    *deferred_columns* of this selector are only needed for these events, so callers can skip
+    reading them upfront and instead pass a function *load_deferred_columns* that receives the
+    indices of these events within the chunk and returns an array with the deferred columns of
+    these events only. Both ways lead to identical results.
 
     Resources:
     https://twiki.cern.ch/twiki/bin/view/CMS/JetID?rev=107#nanoAOD_Flags
@@ -58,10 +370,11 @@ def jet_selection(
     li = ak.local_index(events.Jet)
 
     # common ak4 jet mask for normal and vbf jets
+    lepton_indices = get_selected_lepton_indices(lepton_results)
     ak4_mask = (
         (events.Jet.jetId == 6) &  # tight plus lepton veto
         ((events.Jet.pt >= 50.0) | (events.Jet.puId == (1 if is_2016 else 4))) &  # flipped in 2016
-        ak.all(events.Jet.metric_table(lepton_results.x.lepton_pair) > 0.5, axis=2)
+        get_lepton_separation_mask(events, events.Jet, lepton_indices, 0.5)
     )
 
     # default jets
@@ -72,19 +385,27 @@ def jet_selection(
     )
 
     # get the scores of the hhbtag and per event get the two indices corresponding to the best pick
-    hhbtag_scores = self[hhbtag](events, default_mask, lepton_results.x.lepton_pair, **kwargs)
-    score_indices = ak.argsort(hhbtag_scores, axis=1, ascending=False)
-    # pad the indices to simplify creating the hhbjet mask
-    padded_hhbjet_indices = ak.pad_none(score_indices, 2, axis=1)[..., :2][..., :2]
-    hhbjet_mask = ((li == padded_hhbjet_indices[..., [0]]) | (li == padded_hhbjet_indices[..., [1]]))
+    hhbtag_scores = self[hhbtag](
+        events,
+        default_mask,
+        lepton_results.x.lepton_pair,
+        alive_mask=alive_mask,
+        **kwargs,
+    )
+    # indices of the two highest scores, padded with -1, to simplify creating the hhbjet mask
+    padded_hhbjet_indices = masked_top_k(hhbtag_scores, 2)
+    hhbjet_mask = ((li == padded_hhbjet_indices[:, [0]]) | (li == padded_hhbjet_indices[:, [1]]))
     # get indices for actual book keeping only for events with both lepton candidates and where at
     # least two jets pass the default mask (bjet candidates)
     valid_score_mask = (
         default_mask &
         (ak.sum(default_mask, axis=1) >= 2) &##  #in original paper : 2
-        (ak.num(lepton_results.x.lepton_pair, axis=1) == 2)
+        (lepton_results.x.lepton_pair.n_candidates == 2)
     )
-    hhbjet_indices = score_indices[valid_score_mask[score_indices]][..., :2]
+    if alive_mask is not None:
+        # scores of other events were not evaluated
+        valid_score_mask = valid_score_mask & alive_mask
+    hhbjet_indices = padded_to_ragged(masked_top_k(hhbtag_scores, 2, valid_score_mask))
 
     # vbf jets
     vbf_mask = (
@@ -94,93 +415,75 @@ def jet_selection(
         (~hhbjet_mask)
     )
 
-    # build vectors of vbf jets representing all combinations and apply selections
-    vbf1, vbf2 = ak.unzip(ak.combinations(events.Jet[vbf_mask], 2, axis=1))
-    vbf_pair = ak.concatenate([vbf1[..., None], vbf2[..., None]], axis=2)
-    vbfjj = vbf1 + vbf2
-    vbf_pair_mask = (
-        (vbfjj.mass > 500.0) &
-        (abs(vbf1.eta - vbf2.eta) > 3.0)
-    )
-
     # extra requirements for events for which only the tau tau vbf cross trigger fired
     cross_vbf_ids = [t.id for t in self.config_inst.x.triggers if t.has_tag("cross_tau_tau_vbf")]
     if not cross_vbf_ids:
-        cross_vbf_mask = ak.full_like(1 * events.event, False, dtype=bool)
+        cross_vbf_mask = np.zeros(len(events), dtype=bool)
     else:
-        cross_vbf_masks = [events.trigger_ids == tid for tid in cross_vbf_ids]
-        cross_vbf_mask = ak.all(reduce(or_, cross_vbf_masks), axis=1)
-    vbf_pair_mask = vbf_pair_mask & (
-        (~cross_vbf_mask) | (
-            (vbfjj.mass > 800) &
-            (ak.max(vbf_pair.pt, axis=2) > 140.0) &
-            (ak.min(vbf_pair.pt, axis=2) > 60.0)
-        )
-    )
-
-    # get the index to the pair with the highest pass
-    vbf_mass_indices = ak.argsort(vbfjj.mass, axis=1, ascending=False)
-    vbf_pair_index = vbf_mass_indices[vbf_pair_mask[vbf_mass_indices]][..., :1]
-
-    # get the two indices referring to jets passing vbf_mask
-    # and change them so that they point to jets in the full set, sorted by pt
-    vbf_indices_local = ak.concatenate(
-        [
-            ak.singletons(idx) for idx in
-            ak.unzip(ak.firsts(ak.argcombinations(events.Jet[vbf_mask], 2, axis=1)[vbf_pair_index]))
-        ],
-        axis=1,
-    )
-    vbfjet_indices = li[vbf_mask][vbf_indices_local]
-    vbfjet_indices = vbfjet_indices[ak.argsort(events.Jet[vbfjet_indices].pt, axis=1, ascending=False)]
-
-    # check whether the two bjets were matched by fatjet subjets to mark it as boosted
-    vanilla_fatjet_mask = (
-        (events.FatJet.jetId == 6) &  # tight plus lepton veto
-        (events.FatJet.msoftdrop > 30.0) &
-        (abs(events.FatJet.eta) < 2.4) &
-        ak.all(events.FatJet.metric_table(lepton_results.x.lepton_pair) > 0.5, axis=2) &
-        (events.FatJet.subJetIdx1 >= 0) &
-        (events.FatJet.subJetIdx2 >= 0)
-    )
+        cross_vbf_mask = np.asarray(fired_only(events.trigger_mask, self.config_inst, cross_vbf_ids))
 
-    # unique subjet matching
-    metrics = events.FatJet.subjets.metric_table(events.Jet[hhbjet_indices])
-    #embed()
-    subjets_match = (
-        ak.all(ak.sum(metrics < 0.4, axis=3) == 1, axis=2) &
-        (ak.num(hhbjet_indices, axis=1) >= 2)## #in original paper : 2
+    # find the vbf jet pair with the highest invariant mass passing all requirements
+    vbfjet_indices = find_vbf_pairs(
+        events.Jet,
+        ak.fill_none(vbf_mask, False),
+        cross_vbf_mask,
+        min_mjj=500.0,
+        min_delta_eta=3.0,
+        cross_min_mjj=800.0,
+        cross_min_pt1=140.0,
+        cross_min_pt2=60.0,
     )
-    fatjet_mask = vanilla_fatjet_mask & subjets_match
 
-    # store fatjet and subjet indices
-    fatjet_indices = ak.local_index(events.FatJet.pt)[fatjet_mask]
-    subjet_indices = ak.concatenate(
-        [
-            events.FatJet[fatjet_mask].subJetIdx1[..., None],
-            events.FatJet[fatjet_mask].subJetIdx2[..., None],
-        ],
-        axis=2,
+    # check whether the two bjets were matched by fatjet subjets to mark it as boosted, which is only
+    # evaluated for events with two hh bjets, optionally loading deferred boosted columns only for
+    # these events and merging them into the corresponding subset of events
+    btag_wp = self.config_inst.x.btag_working_points.deepcsv.loose
+    indices = np.flatnonzero(ak.to_numpy(ak.num(hhbjet_indices, axis=1) == 2))
+    sub_events = events[indices]
+    if load_deferred_columns is not None:
+        deferred = load_deferred_columns(indices)
+        for route in sorted(self.deferred_columns):
+            sub_events = set_ak_column(sub_events, route, Route(route).apply(deferred))
+    sub_vanilla_fatjet_mask = get_vanilla_fatjet_mask(
+        sub_events,
+        {coll: lepton_indices[coll][indices] for coll in lepton_indices},
+    )
+    sub_boosted = match_fatjet_subjets(
+        sub_events,
+        sub_vanilla_fatjet_mask,
+        hhbjet_indices[indices],
+        btag_wp=btag_wp,
     )
 
-    # discard the event in case the (first) fatjet with matching subjets is found
-    # but they are not b-tagged (TODO: move to deepjet when available for subjets)
-    wp = self.config_inst.x.btag_working_points.deepcsv.loose
-    subjets_btagged = ak.all(events.SubJet[ak.firsts(subjet_indices)].btagDeepB > wp, axis=1)
+    # expand back to all events, with empty fatjet masks and objects for other events, which the
+    # matching would not select anyway
+    vanilla_fatjet_mask = expand_to_events(sub_vanilla_fatjet_mask, indices, len(events))
+    subjets_btagged = np.ones(len(events), dtype=bool)
+    subjets_btagged[indices] = sub_boosted.subjets_btagged
+    boosted = DotDict(
+        fatjet_mask=expand_to_events(sub_boosted.fatjet_mask, indices, len(events)),
+        fatjet_indices=expand_to_events(sub_boosted.fatjet_indices, indices, len(events)),
+        subjet_indices=expand_to_events(sub_boosted.subjet_indices, indices, len(events)),
+        subjets_btagged=subjets_btagged,
+    )
+    fatjet_indices = boosted.fatjet_indices
+    subjet_indices = boosted.subjet_indices
 
-    # pt sorted indices to convert mask
-    sorted_indices = ak.argsort(events.Jet.pt, axis=-1, ascending=False)
-    jet_indices = sorted_indices[default_mask[sorted_indices]]
+    # pt sorted indices of jets passing the default mask
+    jet_indices = masked_argsort(events.Jet.pt, default_mask)
 
     # keep indices of default jets that are explicitly not selected as hhbjets for easier handling
     non_hhbjet_mask = default_mask & (~hhbjet_mask)
-    non_hhbjet_indices = sorted_indices[non_hhbjet_mask[sorted_indices]]
+    non_hhbjet_indices = masked_argsort(events.Jet.pt, non_hhbjet_mask)
 
     # final event selection
     jet_sel = (
         (ak.sum(default_mask, axis=1) >= 2) & ## #in original paper : 2
-        ak.fill_none(subjets_btagged, True)  # was none for events with no matched fatjet
+        boosted.subjets_btagged  # true for events with no matched fatjet
     )
+    if alive_mask is not None:
+        # mark events without evaluated scores as failed rather than deciding on default scores
+        jet_sel = jet_sel & alive_mask
 
     # some final type conversions
     jet_indices = ak.values_astype(ak.fill_none(jet_indices, 0), np.int32)
@@ -7,10 +7,14 @@ Lepton selection methods.
 from __future__ import annotations
 
 from columnflow.selection import Selector, SelectionResult, selector
-from columnflow.columnar_util import set_ak_column
+from columnflow.columnar_util import set_ak_column, flat_np_view
 from columnflow.util import DotDict, maybe_import
 
 from hbt.config.util import Trigger
+from hbt.columnar_util import (
+    get_offsets, any_within_delta_r, all_beyond_delta_r, flat_argsort, masked_argsort,
+)
+from hbt.selection.trigger import TriggerLegCache, fired_all
 
 
 np = maybe_import("numpy")
@@ -21,64 +25,177 @@ def trigger_object_matching(
     vectors1: ak.Array,
     vectors2: ak.Array,
     threshold: float = 0.25,
-    axis: int = 2,
-) -> ak.Array | tuple[ak.Array, ak.Array]:
+) -> ak.Array:
     """
     Helper to check per object in *vectors1* if there is at least one object in *vectors2* that
-    leads to a delta R metric below *threshold*. The final reduction is applied over *axis* of the
-    resulting metric table containing the full combinatorics. When *return_all_matches* is *True*,
-    the matrix with all matching decisions is returned as well.
+    leads to a delta R metric below *threshold*.
     """
-    # delta_r for all combinations
-    dr = vectors1.metric_table(vectors2)
+    return any_within_delta_r(vectors1, vectors2, threshold)
 
-    # check per element in vectors1 if there is at least one matching element in vectors2
-    any_match = ak.any(dr < threshold, axis=axis)
 
-    return any_match
+class LeptonPair(object):
+    """
+    Compact, struct-of-arrays representation of the selected lepton pair with two fixed slots per
+    event. Slots are filled with selected electrons, muons and taus in that order, so that the
+    first slot holds the electron or muon in etau and mutau events, and the leading tau in tautau
+    events. Attributes *pt*, *eta*, *phi*, *mass*, *charge*, *pdg_id* (absolute) and *index*
+    (local index in the original collection) are numpy arrays of shape ``(n_events, 2)``, and
+    *valid* marks filled slots. Since slots are filled in order, valid slots always form a prefix.
+    *n_candidates* counts all selected leptons per event, which can exceed two when more taus are
+    selected.
+
+    Ragged views with or without coffea Lorentz vector behavior are only built on demand via
+    :py:meth:`to_ak` and :py:meth:`to_coffea`.
+    """
+
+    fields = ["pt", "eta", "phi", "mass", "charge", "pdg_id", "index"]
+
+    def __init__(
+        self,
+        pt: np.ndarray,
+        eta: np.ndarray,
+        phi: np.ndarray,
+        mass: np.ndarray,
+        charge: np.ndarray,
+        pdg_id: np.ndarray,
+        index: np.ndarray,
+        valid: np.ndarray,
+        n_candidates: np.ndarray,
+        behavior: dict | None = None,
+    ) -> None:
+        super().__init__()
+
+        self.pt = pt
+        self.eta = eta
+        self.phi = phi
+        self.mass = mass
+        self.charge = charge
+        self.pdg_id = pdg_id
+        self.index = index
+        self.valid = valid
+        self.n_candidates = n_candidates
+        self.behavior = behavior
+
+    @classmethod
+    def from_indices(
+        cls,
+        events: ak.Array,
+        electron_indices: ak.Array,
+        muon_indices: ak.Array,
+        tau_indices: ak.Array,
+    ) -> LeptonPair:
+        """
+        Builds the pair from the indices of selected electrons, muons and taus by gathering values
+        directly from the flat buffers of the respective collections in *events*.
+        """
+        n = len(events)
+        kin = {name: np.zeros((n, 2), dtype=np.float32) for name in ["pt", "eta", "phi", "mass"]}
+        charge = np.zeros((n, 2), dtype=np.int8)
+        pdg_id = np.zeros((n, 2), dtype=np.int8)
+        index = np.full((n, 2), -1, dtype=np.int32)
+        valid = np.zeros((n, 2), dtype=bool)
+        n_candidates = np.zeros(n, dtype=np.int32)
+
+        for coll, indices, _pdg_id in [
+            (events.Electron, electron_indices, 11),
+            (events.Muon, muon_indices, 13),
+            (events.Tau, tau_indices, 15),
+        ]:
+            offsets = get_offsets(coll.pt)
+            counts = np.asarray(ak.num(indices, axis=1))
+            padded = ak.to_numpy(ak.fill_none(ak.pad_none(indices, 2, axis=1, clip=True), -1))
+            for slot in range(2):
+                # position of the object in this collection that would end up in the slot
+                pos = slot - n_candidates
+                ev = np.flatnonzero((pos >= 0) & (pos < counts))
+                if not len(ev):
+                    continue
+                obj = padded[ev, pos[ev]]
+                flat = offsets[ev] + obj
+                for name, arr in kin.items():
+                    arr[ev, slot] = flat_np_view(coll[name], axis=1)[flat]
+                charge[ev, slot] = flat_np_view(coll.charge, axis=1)[flat]
+                pdg_id[ev, slot] = _pdg_id
+                index[ev, slot] = obj
+                valid[ev, slot] = True
+            n_candidates += counts
+
+        return cls(
+            charge=charge,
+            pdg_id=pdg_id,
+            index=index,
+            valid=valid,
+            n_candidates=n_candidates,
+            behavior=events.behavior,
+            **kin,
+        )
+
+    def __len__(self) -> int:
+        return len(self.valid)
+
+    def __repr__(self) -> str:
+        return f"<{self.__class__.__name__} n_events={len(self)} at {hex(id(self))}>"
+
+    def __getitem__(self, events: np.ndarray | slice) -> LeptonPair:
+        """
+        Returns a new pair for a subset of *events*, given as indices, mask or slice.
+        """
+        return self.__class__(
+            valid=self.valid[events],
+            n_candidates=self.n_candidates[events],
+            behavior=self.behavior,
+            **{name: getattr(self, name)[events] for name in self.fields},
+        )
+
+    @property
+    def n_valid(self) -> np.ndarray:
+        """
+        Number of filled slots per event.
+        """
+        return self.valid.sum(axis=1)
+
+    def to_ak(self, with_name: str | None = None) -> ak.Array:
+        """
+        Returns a ragged awkward array of records containing all :py:attr:`fields` of valid slots.
+        When *with_name* is set, records are named accordingly and the behavior of the events the
+        pair was built from is attached.
+        """
+        records = ak.zip(
+            {name: getattr(self, name)[self.valid] for name in self.fields},
+            with_name=with_name,
+            behavior=self.behavior if with_name else None,
+        )
+        return ak.unflatten(records, self.n_valid)
+
+    def to_coffea(self) -> ak.Array:
+        """
+        Returns a ragged view of valid slots as coffea Lorentz vectors.
+        """
+        return self.to_ak(with_name="PtEtaPhiMLorentzVector")
 
 
 @selector(
     uses={
         # nano columns
-        "nElectron", "Electron.pt", "Electron.eta", "Electron.phi", "Electron.dxy", "Electron.dz",
+        "nElectron", "Electron.pt", "Electron.eta", "Electron.dxy", "Electron.dz",
         "Electron.pfRelIso03_all", "Electron.mvaIso_WP80", "Electron.mvaIso_WP90", "Electron.mvaNoIso_WP90",
-        "nTrigObj", "TrigObj.pt", "TrigObj.eta", "TrigObj.phi",
         # <= nano v9 names
         "Electron.mvaFall17V2Iso_WP80", "Electron.mvaFall17V2Iso_WP90", "Electron.mvaFall17V2noIso_WP90",
     },
 )
-def electron_selection(
+def electron_base_selection(
     self: Selector,
     events: ak.Array,
-    trigger: Trigger,
-    leg_masks: list[ak.Array],
     **kwargs,
-) -> tuple[ak.Array, ak.Array]:
+) -> DotDict:
     """
-    Electron selection returning two sets of indidces for default and veto electrons.
+    Trigger-independent part of the electron selection, to be evaluated once per chunk. Returns the
+    flat pt sorting order, the default electron mask without trigger dependent cuts, and the indices of
+    veto electrons.
     See https://twiki.cern.ch/twiki/bin/view/CMS/EgammaNanoAOD?rev=4
     """
-    is_single = trigger.has_tag("single_e")
-    is_cross = trigger.has_tag("cross_e_tau")
-    is_2016 = self.config_inst.campaign.x.year == 2016
-
-    # start per-electron mask with trigger object matching
-    if is_single:
-        # catch config errors
-        assert trigger.n_legs == len(leg_masks) == 1
-        assert abs(trigger.legs[0].pdg_id) == 11
-        # match leg 0
-        matches_leg0 = trigger_object_matching(events.Electron, events.TrigObj[leg_masks[0]])
-    elif is_cross:
-        # catch config errors
-        assert trigger.n_legs == len(leg_masks) == 2
-        assert abs(trigger.legs[0].pdg_id) == 11
-        # match leg 0
-        matches_leg0 = trigger_object_matching(events.Electron, events.TrigObj[leg_masks[0]])
-
-    # pt sorted indices for converting masks to indices
-    sorted_indices = ak.argsort(events.Electron.pt, axis=-1, ascending=False)
+    # flat pt sorting order for converting masks to indices
+    flat_order = flat_argsort(events.Electron.pt)
 
     # obtain mva flags, which might be located at different routes, depending on the nano version
     if "mvaIso_WP80" in events.Electron.fields:
@@ -92,22 +209,13 @@ def electron_selection(
         mva_iso_wp90 = events.Electron.mvaFall17V2Iso_WP90
         mva_noniso_wp90 = events.Electron.mvaFall17V2noIso_WP90
 
-    # default electron mask, only required for single and cross triggers with electron leg
-    default_mask = None
-    default_indices = None
-    if is_single or is_cross:
-        min_pt = 26.0 if is_2016 else (33.0 if is_single else 25.0)
-        default_mask = (
-            (mva_iso_wp80 == 1) &
-            (abs(events.Electron.eta) < 2.1) &
-            (abs(events.Electron.dxy) < 0.045) &
-            (abs(events.Electron.dz) < 0.2) &
-            (events.Electron.pt > min_pt) &
-            matches_leg0
-        )
-        # convert to sorted indices
-        default_indices = sorted_indices[default_mask[sorted_indices]]
-        default_indices = ak.values_astype(default_indices, np.int32)
+    # default electron mask, still to be completed by trigger dependent pt cuts and matching
+    default_mask = (
+        (mva_iso_wp80 == 1) &
+        (abs(events.Electron.eta) < 2.1) &
+        (abs(events.Electron.dxy) < 0.045) &
+        (abs(events.Electron.dz) < 0.2)
+    )
 
     # veto electron mask
     veto_mask = (
@@ -121,98 +229,237 @@ def electron_selection(
         (events.Electron.pt > 10.0)
     )
     # convert to sorted indices
-    veto_indices = sorted_indices[veto_mask[sorted_indices]]
+    veto_indices = masked_argsort(events.Electron.pt, veto_mask, flat_order=flat_order)
     veto_indices = ak.values_astype(veto_indices, np.int32)
 
-    return default_indices, veto_indices
+    return DotDict(
+        flat_order=flat_order,
+        default_mask=default_mask,
+        veto_indices=veto_indices,
+    )
 
 
 @selector(
     uses={
         # nano columns
-        "nMuon", "Muon.pt", "Muon.eta", "Muon.phi", "Muon.mediumId", "Muon.tightId",
-        "Muon.pfRelIso04_all", "Muon.dxy", "Muon.dz",
+        "nElectron", "Electron.pt", "Electron.eta", "Electron.phi",
         "nTrigObj", "TrigObj.pt", "TrigObj.eta", "TrigObj.phi",
     },
 )
-def muon_selection(
+def electron_selection(
     self: Selector,
     events: ak.Array,
     trigger: Trigger,
-    leg_masks: list[ak.Array],
+    leg_cache: TriggerLegCache,
+    base: DotDict,
     **kwargs,
 ) -> tuple[ak.Array, ak.Array]:
     """
-    Muon selection returning two sets of indidces for default and veto muons.
+    Trigger-dependent part of the electron selection based on the *base* results of
+    :py:func:`electron_base_selection`, returning two sets of indidces for default and veto electrons.
+    """
+    is_single = trigger.has_tag("single_e")
+    is_cross = trigger.has_tag("cross_e_tau")
+    is_2016 = self.config_inst.campaign.x.year == 2016
+
+    # default electron mask, only required for single and cross triggers with electron leg
+    default_indices = None
+    if is_single or is_cross:
+        # catch config errors
+        assert trigger.n_legs == (1 if is_single else 2)
+        assert abs(trigger.legs[0].pdg_id) == 11
+        # match leg 0
+        matches_leg0 = trigger_object_matching(events.Electron, leg_cache.objects(trigger.legs[0]))
+
+        min_pt = 26.0 if is_2016 else (33.0 if is_single else 25.0)
+        default_mask = (
+            base.default_mask &
+            (events.Electron.pt > min_pt) &
+            matches_leg0
+        )
+        # convert to sorted indices
+        default_indices = masked_argsort(
+            events.Electron.pt,
+            default_mask,
+            flat_order=base.flat_order,
+        )
+        default_indices = ak.values_astype(default_indices, np.int32)
+
+    return default_indices, base.veto_indices
+
+
+@selector(
+    uses={
+        # nano columns
+        "nMuon", "Muon.pt", "Muon.eta", "Muon.mediumId", "Muon.tightId", "Muon.pfRelIso04_all",
+        "Muon.dxy", "Muon.dz",
+    },
+)
+def muon_base_selection(
+    self: Selector,
+    events: ak.Array,
+    **kwargs,
+) -> DotDict:
+    """
+    Trigger-independent part of the muon selection, to be evaluated once per chunk. Returns the
+    flat pt sorting order, the default muon mask without trigger dependent cuts, and the indices of veto
+    muons.
 
     References:
 
     - Isolation working point: https://twiki.cern.ch/twiki/bin/view/CMS/SWGuideMuonIdRun2?rev=59
     - ID und ISO : https://twiki.cern.ch/twiki/bin/view/CMS/MuonUL2017?rev=15
     """
+    # flat pt sorting order for converting masks to indices
+    flat_order = flat_argsort(events.Muon.pt)
+
+    # default muon mask, still to be completed by trigger dependent pt cuts and matching
+    default_mask = (
+        (events.Muon.tightId == 1) &
+        (abs(events.Muon.eta) < 2.1) &
+        (abs(events.Muon.dxy) < 0.045) &
+        (abs(events.Muon.dz) < 0.2) &
+        (events.Muon.pfRelIso04_all < 0.15)
+    )
+
+    # veto muon mask
+    veto_mask = (
+        (events.Muon.mediumId == 1) &
+        (abs(events.Muon.eta) < 2.4) &
+        (abs(events.Muon.dxy) < 0.045) &
+        (abs(events.Muon.dz) < 0.2) &
+        (events.Muon.pfRelIso04_all < 0.3) &
+        (events.Muon.pt > 10)
+    )
+    # convert to sorted indices
+    veto_indices = masked_argsort(events.Muon.pt, veto_mask, flat_order=flat_order)
+    veto_indices = ak.values_astype(veto_indices, np.int32)
+
+    return DotDict(
+        flat_order=flat_order,
+        default_mask=default_mask,
+        veto_indices=veto_indices,
+    )
+
+
+@selector(
+    uses={
+        # nano columns
+        "nMuon", "Muon.pt", "Muon.eta", "Muon.phi",
+        "nTrigObj", "TrigObj.pt", "TrigObj.eta", "TrigObj.phi",
+    },
+)
+def muon_selection(
+    self: Selector,
+    events: ak.Array,
+    trigger: Trigger,
+    leg_cache: TriggerLegCache,
+    base: DotDict,
+    **kwargs,
+) -> tuple[ak.Array, ak.Array]:
+    """
+    Trigger-dependent part of the muon selection based on the *base* results of
+    :py:func:`muon_base_selection`, returning two sets of indidces for default and veto muons.
+    """
     is_single = trigger.has_tag("single_mu")
     is_cross = trigger.has_tag("cross_mu_tau")
     is_2016 = self.config_inst.campaign.x.year == 2016
 
-    # start per-muon mask with trigger object matching
-    if is_single:
-        # catch config errors
-        assert trigger.n_legs == len(leg_masks) == 1
-        assert abs(trigger.legs[0].pdg_id) == 13
-        # match leg 0
-        matches_leg0 = trigger_object_matching(events.Muon, events.TrigObj[leg_masks[0]])
-    elif is_cross:
+    # default muon mask, only required for single and cross triggers with muon leg
+    default_indices = None
+    if is_single or is_cross:
         # catch config errors
-        assert trigger.n_legs == len(leg_masks) == 2
+        assert trigger.n_legs == (1 if is_single else 2)
         assert abs(trigger.legs[0].pdg_id) == 13
         # match leg 0
-        matches_leg0 = trigger_object_matching(events.Muon, events.TrigObj[leg_masks[0]])
-
-    # pt sorted indices for converting masks to indices
-    sorted_indices = ak.argsort(events.Muon.pt, axis=-1, ascending=False)
+        matches_leg0 = trigger_object_matching(events.Muon, leg_cache.objects(trigger.legs[0]))
 
-    # default muon mask, only required for single and cross triggers with muon leg
-    default_mask = None
-    default_indices = None
-    if is_single or is_cross:
         if is_2016:
             min_pt = 23.0 if is_single else 20.0
         else:
             min_pt = 33.0 if is_single else 25.0
         default_mask = (
-            (events.Muon.tightId == 1) &
-            (abs(events.Muon.eta) < 2.1) &
-            (abs(events.Muon.dxy) < 0.045) &
-            (abs(events.Muon.dz) < 0.2) &
-            (events.Muon.pfRelIso04_all < 0.15) &
+            base.default_mask &
             (events.Muon.pt > min_pt) &
             matches_leg0
         )
         # convert to sorted indices
-        default_indices = sorted_indices[default_mask[sorted_indices]]
+        default_indices = masked_argsort(
+            events.Muon.pt,
+            default_mask,
+            flat_order=base.flat_order,
+        )
         default_indices = ak.values_astype(default_indices, np.int32)
 
-    # veto muon mask
-    veto_mask = (
-        (events.Muon.mediumId == 1) &
-        (abs(events.Muon.eta) < 2.4) &
-        (abs(events.Muon.dxy) < 0.045) &
-        (abs(events.Muon.dz) < 0.2) &
-        (events.Muon.pfRelIso04_all < 0.3) &
-        (events.Muon.pt > 10)
+    return default_indices, base.veto_indices
+
+
+@selector(
+    uses={
+        # nano columns
+        "nTau", "Tau.pt", "Tau.dz", "Tau.idDeepTau2017v2p1VSe", "Tau.idDeepTau2017v2p1VSmu",
+        "Tau.idDeepTau2017v2p1VSjet",
+    },
+    # shifts are declared dynamically below in tau_selection_init
+)
+def tau_base_selection(
+    self: Selector,
+    events: ak.Array,
+    **kwargs,
+) -> DotDict:
+    """
+    Trigger-independent part of the tau selection, to be evaluated once per chunk. Returns the flat
+    sorting order by isolation and pt, the base tau mask without trigger dependent cuts, the two
+    possible masks of tau-vs-lepton discriminant cuts (for di-tau triggers and all others), and a
+    mask of Medium isolated taus.
+    """
+    # tau id v2.1 working points (binary to int transition after nano v10)
+    if self.config_inst.campaign.x.version < 10:
+        # https://cms-nanoaod-integration.web.cern.ch/integration/master/mc94X_doc.html
+        tau_vs_e = DotDict(vvloose=2, vloose=4)
+        tau_vs_mu = DotDict(vloose=1, tight=8)
+        tau_vs_jet = DotDict(vvloose=2, loose=8, medium=16)
+    else:
+        # https://cms-nanoaod-integration.web.cern.ch/integration/cms-swmaster/data106Xul17v2_v10_doc.html#Tau
+        tau_vs_e = DotDict(vvloose=2, vloose=3)
+        tau_vs_mu = DotDict(vloose=1, tight=4)
+        tau_vs_jet = DotDict(vvloose=2, loose=4, medium=5)
+
+    # flat order for sorting first by isolation, then by pt
+    flat_order = flat_argsort([events.Tau.idDeepTau2017v2p1VSjet, events.Tau.pt])
+
+    return DotDict(
+        flat_order=flat_order,
+        base_mask=(
+            (abs(events.Tau.dz) < 0.2) &
+            (events.Tau.idDeepTau2017v2p1VSjet >= tau_vs_jet.loose)
+        ),
+        vs_lep_mask_cross_tau=(
+            (events.Tau.idDeepTau2017v2p1VSe >= tau_vs_e.vvloose) &
+            (events.Tau.idDeepTau2017v2p1VSmu >= tau_vs_mu.vloose)
+        ),
+        vs_lep_mask=(
+            (events.Tau.idDeepTau2017v2p1VSe >= tau_vs_e.vloose) &
+            (events.Tau.idDeepTau2017v2p1VSmu >= tau_vs_mu.tight)
+        ),
+        iso_mask=events.Tau.idDeepTau2017v2p1VSjet >= tau_vs_jet.medium,
     )
-    # convert to sorted indices
-    veto_indices = sorted_indices[veto_mask[sorted_indices]]
-    veto_indices = ak.values_astype(veto_indices, np.int32)
 
-    return default_indices, veto_indices
+
+@tau_base_selection.init
+def tau_base_selection_init(self: Selector) -> None:
+    # register tec shifts
+    self.shifts |= {
+        shift_inst.name
+        for shift_inst in self.config_inst.shifts
+        if shift_inst.has_tag("tec")
+    }
 
 
 @selector(
     uses={
         # nano columns
-        "nTau", "Tau.pt", "Tau.eta", "Tau.phi", "Tau.dz", "Tau.idDeepTau2017v2p1VSe",
-        "Tau.idDeepTau2017v2p1VSmu", "Tau.idDeepTau2017v2p1VSjet",
+        "nTau", "Tau.pt", "Tau.eta", "Tau.phi",
         "nTrigObj", "TrigObj.pt", "TrigObj.eta", "TrigObj.phi",
         "nElectron", "Electron.pt", "Electron.eta", "Electron.phi",
         "nMuon", "Muon.pt", "Muon.eta", "Muon.phi",
@@ -223,15 +470,17 @@ def tau_selection(
     self: Selector,
     events: ak.Array,
     trigger: Trigger,
-    leg_masks: list[ak.Array],
+    leg_cache: TriggerLegCache,
+    base: DotDict,
     electron_indices: ak.Array,
     muon_indices: ak.Array,
     **kwargs,
 ) -> tuple[ak.Array, ak.Array]:
     """
-    Tau selection returning a set of indices for taus that are at least VVLoose isolated (vs jet)
-    and a second mask to select the action Medium isolated ones, eventually to separate normal and
-    iso inverted taus for QCD estimations.
+    Trigger-dependent part of the tau selection based on the *base* results of
+    :py:func:`tau_base_selection`, returning a set of indices for taus that are at least VVLoose
+    isolated (vs jet) and a second mask to select the action Medium isolated ones, eventually to
+    separate normal and iso inverted taus for QCD estimations.
 
     TODO: there is no decay mode selection yet, but this should be revisited!
     """
@@ -243,33 +492,22 @@ def tau_selection(
     is_cross_tau_vbf = trigger.has_tag("cross_tau_tau_vbf")
     is_any_cross_tau = is_cross_tau or is_cross_tau_vbf
     is_2016 = self.config_inst.campaign.x.year == 2016
-    # tau id v2.1 working points (binary to int transition after nano v10)
-    if self.config_inst.campaign.x.version < 10:
-        # https://cms-nanoaod-integration.web.cern.ch/integration/master/mc94X_doc.html
-        tau_vs_e = DotDict(vvloose=2, vloose=4)
-        tau_vs_mu = DotDict(vloose=1, tight=8)
-        tau_vs_jet = DotDict(vvloose=2, loose=8, medium=16)
-    else:
-        # https://cms-nanoaod-integration.web.cern.ch/integration/cms-swmaster/data106Xul17v2_v10_doc.html#Tau
-        tau_vs_e = DotDict(vvloose=2, vloose=3)
-        tau_vs_mu = DotDict(vloose=1, tight=4)
-        tau_vs_jet = DotDict(vvloose=2, loose=4, medium=5)
 
     # start per-tau mask with trigger object matching per leg
     if is_cross_e or is_cross_mu:
         # catch config errors
-        assert trigger.n_legs == len(leg_masks) == 2
+        assert trigger.n_legs == 2
         assert abs(trigger.legs[1].pdg_id) == 15
         # match leg 1
-        matches_leg1 = trigger_object_matching(events.Tau, events.TrigObj[leg_masks[1]])
+        matches_leg1 = trigger_object_matching(events.Tau, leg_cache.objects(trigger.legs[1]))
     elif is_cross_tau or is_cross_tau_vbf:
         # catch config errors
-        assert trigger.n_legs == len(leg_masks) >= 2
+        assert trigger.n_legs >= 2
         assert abs(trigger.legs[0].pdg_id) == 15
         assert abs(trigger.legs[1].pdg_id) == 15
         # match both legs
-        matches_leg0 = trigger_object_matching(events.Tau, events.TrigObj[leg_masks[0]])
-        matches_leg1 = trigger_object_matching(events.Tau, events.TrigObj[leg_masks[1]])
+        matches_leg0 = trigger_object_matching(events.Tau, leg_cache.objects(trigger.legs[0]))
+        matches_leg1 = trigger_object_matching(events.Tau, leg_cache.objects(trigger.legs[1]))
 
     # determine minimum pt and maximum eta
     if is_single_e or is_single_mu:
@@ -292,19 +530,17 @@ def tau_selection(
 
     # base tau mask for default and qcd sideband tau
     base_mask = (
+        base.base_mask &
+        (base.vs_lep_mask_cross_tau if is_any_cross_tau else base.vs_lep_mask) &
         (abs(events.Tau.eta) < max_eta) &
-        (events.Tau.pt > min_pt) &
-        (abs(events.Tau.dz) < 0.2) &
-        (events.Tau.idDeepTau2017v2p1VSe >= (tau_vs_e.vvloose if is_any_cross_tau else tau_vs_e.vloose)) &
-        (events.Tau.idDeepTau2017v2p1VSmu >= (tau_vs_mu.vloose if is_any_cross_tau else tau_vs_mu.tight)) &
-        (events.Tau.idDeepTau2017v2p1VSjet >= tau_vs_jet.loose)
+        (events.Tau.pt > min_pt)
     )
 
     # remove taus with too close spatial separation to previously selected leptons
     if electron_indices is not None:
-        base_mask = base_mask & ak.all(events.Tau.metric_table(events.Electron[electron_indices]) > 0.5, axis=2)
+        base_mask = base_mask & all_beyond_delta_r(events.Tau, events.Electron[electron_indices], 0.5)
     if muon_indices is not None:
-        base_mask = base_mask & ak.all(events.Tau.metric_table(events.Muon[muon_indices]) > 0.5, axis=2)
+        base_mask = base_mask & all_beyond_delta_r(events.Tau, events.Muon[muon_indices], 0.5)
 
     # add trigger object masks
     if is_cross_e or is_cross_mu:
@@ -318,18 +554,16 @@ def tau_selection(
             ak.any(matches_leg1, axis=1)
         )
 
-    # indices for sorting first by isolation, then by pt
-    # for this, combine iso and pt values, e.g. iso 255 and pt 32.3 -> 2550032.3
-    f = 10 ** (np.ceil(np.log10(ak.max(events.Tau.pt))) + 1)
-    sort_key = events.Tau.idDeepTau2017v2p1VSjet * f + events.Tau.pt
-    sorted_indices = ak.argsort(sort_key, axis=-1, ascending=False)
-
     # convert to sorted indices
-    base_indices = sorted_indices[base_mask[sorted_indices]]
+    base_indices = masked_argsort(
+        [events.Tau.idDeepTau2017v2p1VSjet, events.Tau.pt],
+        base_mask,
+        flat_order=base.flat_order,
+    )
     base_indices = ak.values_astype(base_indices, np.int32)
 
     # additional mask to select final, Medium isolated taus
-    iso_mask = events.Tau[base_indices].idDeepTau2017v2p1VSjet >= tau_vs_jet.medium
+    iso_mask = base.iso_mask[base_indices]
 
     return base_indices, iso_mask
 
@@ -344,9 +578,73 @@ def tau_selection_init(self: Selector) -> None:
     }
 
 
+def resolve_lepton_pairs(candidates: list[DotDict], n_events: int) -> DotDict:
+    """
+    Resolves the selected lepton pair of *n_events* events from per-trigger *candidates* given in
+    config order, picking the first trigger that accepted a pair in each event. Each candidate is a
+    DotDict with event masks *accepted*, *is_iso* and *is_os* (missing values are considered false),
+    a *channel_id*, flags *single* and *cross*, and ragged *electron_indices*, *muon_indices* and
+    *tau_indices*, of which missing ones are considered empty.
+
+    Decisions are stored in dense matrices with one column per candidate and a last column that is
+    always accepted and used for events in which no trigger accepted a pair, so that all results are
+    gathered at once via an argmax. Returns a DotDict with fields *channel_id*, *tau2_isolated*,
+    *leptons_os*, *single_triggered*, *cross_triggered*, *electron_indices*, *muon_indices* and
+    *tau_indices*.
+    """
+    n_candidates = len(candidates)
+    accepted = np.zeros((n_events, n_candidates + 1), dtype=bool)
+    accepted[:, -1] = True
+    iso_matrix = np.zeros((n_events, n_candidates + 1), dtype=bool)
+    os_matrix = np.zeros((n_events, n_candidates + 1), dtype=bool)
+    channel_ids = np.zeros(n_candidates + 1, dtype=np.uint8)
+    single_flags = np.zeros(n_candidates + 1, dtype=bool)
+    cross_flags = np.zeros(n_candidates + 1, dtype=bool)
+    empty_indices = ak.unflatten(np.zeros(0, dtype=np.int32), np.zeros(n_events, dtype=np.int64))
+    indices = {
+        name: (n_candidates + 1) * [empty_indices]
+        for name in ["electron_indices", "muon_indices", "tau_indices"]
+    }
+
+    for c, candidate in enumerate(candidates):
+        accepted[:, c] = ak.fill_none(candidate.accepted, False)
+        iso_matrix[:, c] = ak.fill_none(candidate.is_iso, False)
+        os_matrix[:, c] = ak.fill_none(candidate.is_os, False)
+        channel_ids[c] = candidate.channel_id
+        single_flags[c] = candidate.single
+        cross_flags[c] = candidate.cross
+        for name, _indices in indices.items():
+            if candidate.get(name) is not None:
+                _indices[c] = candidate[name]
+
+    # pick the first candidate that accepted a lepton pair per event
+    # (argmax returns the first maximum, and the last column is always accepted)
+    winner = np.argmax(accepted, axis=1)
+    event_index = np.arange(n_events)
+
+    # gather results of the winning candidate
+    results = DotDict(
+        channel_id=channel_ids[winner],
+        tau2_isolated=iso_matrix[event_index, winner],
+        leptons_os=os_matrix[event_index, winner],
+        single_triggered=single_flags[winner],
+        cross_triggered=cross_flags[winner],
+    )
+    for name, _indices in indices.items():
+        results[name] = ak.values_astype(
+            ak.concatenate([idx[:, None] for idx in _indices], axis=1)[event_index, winner],
+            np.int32,
+        )
+
+    return results
+
+
 @selector(
     uses={
+        electron_base_selection, muon_base_selection, tau_base_selection,
         electron_selection, muon_selection, tau_selection,
+        # custom columns created upstream, probably by a selector
+        "trigger_mask",
         # nano columns
         "event", "Electron.charge", "Muon.charge", "Tau.charge", "Electron.mass", "Muon.mass",
         "Tau.mass",
@@ -361,56 +659,84 @@ def lepton_selection(
     self: Selector,
     events: ak.Array,
     trigger_results: SelectionResult,
+    shift_cache: dict | None = None,
     **kwargs,
 ) -> tuple[ak.Array, SelectionResult]:
     """
-    Combined lepton selection.
+    Combined lepton selection. Electron and muon selection results do not depend on taus and are
+    stored in and reused from a *shift_cache* dictionary if given, e.g. when selecting the same
+    chunk for multiple tau energy shifts.
     """
     # get channels from the config
     ch_etau = self.config_inst.get_channel("etau")
     ch_mutau = self.config_inst.get_channel("mutau")
     ch_tautau = self.config_inst.get_channel("tautau")
 
-    # prepare vectors for output vectors
-    false_mask = (abs(events.event) < 0)
-    channel_id = np.uint8(1) * false_mask
-    tau2_isolated = false_mask
-    leptons_os = false_mask
-    single_triggered = false_mask
-    cross_triggered = false_mask
-    empty_indices = ak.zeros_like(1 * events.event, dtype=np.uint16)[..., None][..., :0]
-    sel_electron_indices = empty_indices
-    sel_muon_indices = empty_indices
-    sel_tau_indices = empty_indices
+    # trigger objects per leg are shared across triggers
+    leg_cache = trigger_results.x.trigger_leg_cache
 
-    # perform each lepton election step separately per trigger
-    for trigger, trigger_fired, leg_masks in trigger_results.x.trigger_data:
-        is_single = trigger.has_tag("single_trigger")
-        is_cross = trigger.has_tag("cross_trigger")
+    # trigger-independent electron and muon selection steps, evaluated lazily on first use and
+    # cached alongside the per-trigger results
+    if shift_cache is None or "light_leptons" not in shift_cache:
+        light_leptons = DotDict(base=None, results={})
+        if shift_cache is not None:
+            shift_cache["light_leptons"] = light_leptons
+    else:
+        light_leptons = shift_cache["light_leptons"]
 
-        # electron selection
-        electron_indices, electron_veto_indices = self[electron_selection](
-            events,
-            trigger,
-            leg_masks,
-            call_force=True,
-            **kwargs,
-        )
+    # trigger-independent tau selection steps
+    tau_base = self[tau_base_selection](events, **kwargs)
 
-        # muon selection
-        muon_indices, muon_veto_indices = self[muon_selection](
-            events,
-            trigger,
-            leg_masks,
-            call_force=True,
-            **kwargs,
+    # per-trigger candidate decisions, resolved after the loop
+    candidates = []
+
+    # perform each lepton election step separately per trigger
+    for trigger, _, _ in trigger_results.x.trigger_data:
+        trigger_fired = fired_all(events.trigger_mask, self.config_inst, trigger)
+        candidate = DotDict(
+            single=trigger.has_tag("single_trigger"),
+            cross=trigger.has_tag("cross_trigger"),
         )
 
+        # electron and muon selection
+        if trigger.id not in light_leptons.results:
+            if light_leptons.base is None:
+                light_leptons.base = (
+                    self[electron_base_selection](events, **kwargs),
+                    self[muon_base_selection](events, **kwargs),
+                )
+            electron_base, muon_base = light_leptons.base
+            light_leptons.results[trigger.id] = (
+                *self[electron_selection](
+                    events,
+                    trigger,
+                    leg_cache,
+                    electron_base,
+                    call_force=True,
+                    **kwargs,
+                ),
+                *self[muon_selection](
+                    events,
+                    trigger,
+                    leg_cache,
+                    muon_base,
+                    call_force=True,
+                    **kwargs,
+                ),
+            )
+        (
+            electron_indices,
+            electron_veto_indices,
+            muon_indices,
+            muon_veto_indices,
+        ) = light_leptons.results[trigger.id]
+
         # tau selection
         tau_indices, tau_iso_mask = self[tau_selection](
             events,
             trigger,
-            leg_masks,
+            leg_cache,
+            tau_base,
             electron_indices,
             muon_indices,
             call_force=True,
@@ -432,15 +758,13 @@ def lepton_selection(
             e_charge = ak.firsts(events.Electron[electron_indices].charge, axis=1)
             tau_charge = ak.firsts(events.Tau[tau_indices].charge, axis=1)
             is_os = e_charge == -tau_charge
-            # store global variables
-            where = (channel_id == 0) & is_etau
-            channel_id = ak.where(where, ch_etau.id, channel_id)
-            tau2_isolated = ak.where(where, is_iso, tau2_isolated)
-            leptons_os = ak.where(where, is_os, leptons_os)
-            single_triggered = ak.where(where & is_single, True, single_triggered)
-            cross_triggered = ak.where(where & is_cross, True, cross_triggered)
-            sel_electron_indices = ak.where(where, electron_indices, sel_electron_indices)
-            sel_tau_indices = ak.where(where, tau_indices, sel_tau_indices)
+            # store candidate decisions
+            candidate.update(
+                accepted=is_etau,
+                channel_id=ch_etau.id,
+                electron_indices=electron_indices,
+                tau_indices=tau_indices,
+            )
 
         elif trigger.has_tag({"single_mu", "cross_mu_tau"}):
             # expect 1 muon, 1 veto muon (the same one), 0 veto electrons, and at least one tau
@@ -456,15 +780,13 @@ def lepton_selection(
             mu_charge = ak.firsts(events.Muon[muon_indices].charge, axis=1)
             tau_charge = ak.firsts(events.Tau[tau_indices].charge, axis=1)
             is_os = mu_charge == -tau_charge
-            # store global variables
-            where = (channel_id == 0) & is_mutau
-            channel_id = ak.where(where, ch_mutau.id, channel_id)
-            tau2_isolated = ak.where(where, is_iso, tau2_isolated)
-            leptons_os = ak.where(where, is_os, leptons_os)
-            single_triggered = ak.where(where & is_single, True, single_triggered)
-            cross_triggered = ak.where(where & is_cross, True, cross_triggered)
-            sel_muon_indices = ak.where(where, muon_indices, sel_muon_indices)
-            sel_tau_indices = ak.where(where, tau_indices, sel_tau_indices)
+            # store candidate decisions
+            candidate.update(
+                accepted=is_mutau,
+                channel_id=ch_mutau.id,
+                muon_indices=muon_indices,
+                tau_indices=tau_indices,
+            )
 
         elif trigger.has_tag({"cross_tau_tau", "cross_tau_tau_vbf"}):
             # expect 0 veto electrons, 0 veto muons and at least two taus of which one is isolated
@@ -489,21 +811,29 @@ def lepton_selection(
             tau1_charge = ak.firsts(events.Tau[tau_indices].charge, axis=1)
             tau2_charge = ak.firsts(events.Tau[tau_indices].charge[..., 1:], axis=1)
             is_os = tau1_charge == -tau2_charge
-            # store global variables
-            where = (channel_id == 0) & is_tautau
-            channel_id = ak.where(where, ch_tautau.id, channel_id)
-            tau2_isolated = ak.where(where, is_iso, tau2_isolated)
-            leptons_os = ak.where(where, is_os, leptons_os)
-            single_triggered = ak.where(where & is_single, True, single_triggered)
-            cross_triggered = ak.where(where & is_cross, True, cross_triggered)
-            sel_tau_indices = ak.where(where, tau_indices, sel_tau_indices)
-
-    # some final type conversions
-    channel_id = ak.values_astype(channel_id, np.uint8)
-    leptons_os = ak.fill_none(leptons_os, False)
-    sel_electron_indices = ak.values_astype(sel_electron_indices, np.int32)
-    sel_muon_indices = ak.values_astype(sel_muon_indices, np.int32)
-    sel_tau_indices = ak.values_astype(sel_tau_indices, np.int32)
+            # store candidate decisions
+            candidate.update(
+                accepted=is_tautau,
+                channel_id=ch_tautau.id,
+                tau_indices=tau_indices,
+            )
+
+        else:
+            continue
+
+        candidate.update(is_iso=is_iso, is_os=is_os)
+        candidates.append(candidate)
+
+    # pick the first trigger in config order that accepted a lepton pair per event
+    pairs = resolve_lepton_pairs(candidates, len(events))
+    channel_id = pairs.channel_id
+    tau2_isolated = pairs.tau2_isolated
+    leptons_os = pairs.leptons_os
+    single_triggered = pairs.single_triggered
+    cross_triggered = pairs.cross_triggered
+    sel_electron_indices = pairs.electron_indices
+    sel_muon_indices = pairs.muon_indices
+    sel_tau_indices = pairs.tau_indices
 
     # save new columns
     events = set_ak_column(events, "channel_id", channel_id)
@@ -529,14 +859,11 @@ def lepton_selection(
         },
         aux={
             # save the selected lepton pair for the duration of the selection
-            # multiplication of a coffea particle with 1 yields the lorentz vector
-            "lepton_pair": ak.concatenate(
-                [
-                    events.Electron[sel_electron_indices] * 1,
-                    events.Muon[sel_muon_indices] * 1,
-                    events.Tau[sel_tau_indices] * 1,
-                ],
-                axis=1,
+            "lepton_pair": LeptonPair.from_indices(
+                events,
+                sel_electron_indices,
+                sel_muon_indices,
+                sel_tau_indices,
             ),
         },
     )
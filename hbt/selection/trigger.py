@@ -4,25 +4,285 @@
 Trigger selection methods.
 """
 
+from __future__ import annotations
+
+import law
+import order as od
+
 from columnflow.selection import Selector, SelectionResult, selector
 from columnflow.util import maybe_import
-from columnflow.columnar_util import set_ak_column
+from columnflow.columnar_util import set_ak_column, flat_np_view, layout_ak_array
+
+from hbt.config.util import Trigger, TriggerLeg
+from hbt.columnar_util import get_offsets
+from hbt.util import njit
 
 
 np = maybe_import("numpy")
 ak = maybe_import("awkward")
 
+logger = law.logger.get_logger(__name__)
+
+
+@njit
+def _match_trigger_legs(
+    offsets: np.ndarray,
+    ids: np.ndarray,
+    pts: np.ndarray,
+    filter_bits: np.ndarray,
+    leg_pdg_ids: np.ndarray,
+    leg_min_pts: np.ndarray,
+    leg_bits: np.ndarray,
+    leg_n_bits: np.ndarray,
+) -> tuple[np.ndarray, np.ndarray]:
+    """
+    Kernel that evaluates all trigger legs encoded by :py:func:`encode_trigger_legs` for all trigger
+    objects given as flat buffers and event *offsets* in a single pass. Returns a uint64 word per
+    object whose bit *i* denotes whether it satisfies leg *i*, and the OR of these words per event.
+    """
+    n_events = len(offsets) - 1
+    n_legs = len(leg_pdg_ids)
+    object_legs = np.zeros(len(ids), dtype=np.uint64)
+    event_legs = np.zeros(n_events, dtype=np.uint64)
+
+    for i in range(n_events):
+        for j in range(offsets[i], offsets[i + 1]):
+            abs_id = abs(ids[j])
+            word = np.uint64(0)
+            for k in range(n_legs):
+                # pdg id and pt cut
+                if leg_pdg_ids[k] >= 0 and abs_id != leg_pdg_ids[k]:
+                    continue
+                if pts[j] < leg_min_pts[k]:
+                    continue
+                # OR across bits within a mask, AND between masks
+                for b in range(leg_n_bits[k]):
+                    if (filter_bits[j] & leg_bits[k, b]) == 0:
+                        break
+                else:
+                    word |= np.uint64(1) << np.uint64(k)
+            object_legs[j] = word
+            event_legs[i] |= word
+
+    return object_legs, event_legs
+
+
+def encode_trigger_legs(legs: list[TriggerLeg]) -> tuple[np.ndarray, np.ndarray, np.ndarray, np.ndarray]:
+    """
+    Encodes a list of trigger *legs* into the flat arrays expected by the leg matching kernel, i.e.,
+    pdg ids (-1 when not set), minimum pt values (-inf when not set), a 2D array of trigger bit masks
+    padded with zeros, and the number of masks per leg. At most 64 legs are supported.
+    """
+    if len(legs) > 64:
+        raise ValueError(f"at most 64 trigger legs can be matched at once, got {len(legs)}")
+
+    n_bits_max = max([len(leg.trigger_bits or []) for leg in legs] + [1])
+    leg_pdg_ids = np.full(len(legs), -1, dtype=np.int64)
+    leg_min_pts = np.full(len(legs), -np.inf, dtype=np.float64)
+    leg_bits = np.zeros((len(legs), n_bits_max), dtype=np.int64)
+    leg_n_bits = np.zeros(len(legs), dtype=np.int64)
+    for i, leg in enumerate(legs):
+        if leg.pdg_id is not None:
+            leg_pdg_ids[i] = abs(leg.pdg_id)
+        if leg.min_pt is not None:
+            leg_min_pts[i] = leg.min_pt
+        if leg.trigger_bits is not None:
+            leg_bits[i, :len(leg.trigger_bits)] = leg.trigger_bits
+            leg_n_bits[i] = len(leg.trigger_bits)
+
+    return leg_pdg_ids, leg_min_pts, leg_bits, leg_n_bits
+
+
+def match_trigger_legs(trig_objs: ak.Array, legs: list[TriggerLeg]) -> tuple[np.ndarray, np.ndarray]:
+    """
+    Matches all trigger *legs* against the ragged collection of trigger objects *trig_objs* in a
+    single pass and returns the flat per-object and the per-event uint64 leg words (see
+    :py:func:`_match_trigger_legs`).
+    """
+    return _match_trigger_legs(
+        get_offsets(trig_objs),
+        flat_np_view(trig_objs.id, axis=1),
+        flat_np_view(trig_objs.pt, axis=1),
+        flat_np_view(trig_objs.filterBits, axis=1).astype(np.int64),
+        *encode_trigger_legs(legs),
+    )
+
+
+class TriggerLegCache(object):
+    """
+    Per-chunk cache of trigger leg matching results. All unique legs in *legs* (according to
+    :py:attr:`TriggerLeg.key`) are matched against the trigger objects in *trig_objs* exactly once
+    via :py:func:`match_trigger_legs` upon construction. Index lists and trigger objects per leg are
+    materialized lazily on first access and shared between all legs with identical keys. Numbers of
+    cache hits and misses of these lookups are counted once per lookup in :py:attr:`hits` and
+    :py:attr:`misses`, and can be retrieved and reset via :py:meth:`pop_counts`.
+    """
+
+    def __init__(self, trig_objs: ak.Array, legs: list[TriggerLeg]):
+        super().__init__()
+
+        self.trig_objs = trig_objs
+
+        # assign one bit per unique leg
+        self.bits = {}
+        unique_legs = []
+        for leg in legs:
+            if leg.key not in self.bits:
+                self.bits[leg.key] = len(unique_legs)
+                unique_legs.append(leg)
+
+        # match all unique legs at once
+        self.object_legs, self.event_legs = match_trigger_legs(trig_objs, unique_legs)
+
+        # caches and counters
+        self._indices = {}
+        self._objects = {}
+        self.hits = 0
+        self.misses = 0
+
+    def __repr__(self):
+        return (
+            f"<{self.__class__.__name__} 'n_legs={self.n_legs}, hits={self.hits}, "
+            f"misses={self.misses}' at {hex(id(self))}>"
+        )
+
+    @property
+    def n_legs(self) -> int:
+        return len(self.bits)
+
+    def word(self, legs: TriggerLeg | list[TriggerLeg]) -> np.uint64:
+        """
+        Returns the combined uint64 bit word of one or multiple *legs*.
+        """
+        word = np.uint64(0)
+        for leg in (legs if isinstance(legs, (list, tuple)) else [legs]):
+            word |= np.uint64(1) << np.uint64(self.bits[leg.key])
+        return word
+
+    def all_legs_match(self, legs: list[TriggerLeg]) -> np.ndarray:
+        """
+        Returns an event mask denoting whether each of the *legs* is matched by at least one object.
+        """
+        word = self.word(legs)
+        return (self.event_legs & word) == word
+
+    def pop_counts(self) -> tuple[int, int]:
+        """
+        Returns the numbers of cache hits and misses since the last call and resets them, so that
+        lookups of consumers that share this cache (e.g. across shifts) are counted only once.
+        """
+        counts = (self.hits, self.misses)
+        self.hits = 0
+        self.misses = 0
+        return counts
+
+    def _get_indices(self, leg: TriggerLeg) -> ak.Array:
+        if leg.key not in self._indices:
+            mask = layout_ak_array((self.object_legs & self.word(leg)) != 0, self.trig_objs.pt)
+            self._indices[leg.key] = ak.local_index(self.trig_objs)[mask]
+        return self._indices[leg.key]
+
+    def indices(self, leg: TriggerLeg) -> ak.Array:
+        """
+        Returns the indices of trigger objects matching *leg*.
+        """
+        if leg.key in self._indices:
+            self.hits += 1
+        else:
+            self.misses += 1
+        return self._get_indices(leg)
+
+    def objects(self, leg: TriggerLeg) -> ak.Array:
+        """
+        Returns the trigger objects matching *leg*.
+        """
+        if leg.key in self._objects:
+            self.hits += 1
+        else:
+            self.misses += 1
+            self._objects[leg.key] = self.trig_objs[self._get_indices(leg)]
+        return self._objects[leg.key]
+
+
+def trigger_word(config_inst: od.Config, triggers: Trigger | int | list[Trigger | int]) -> np.uint64:
+    """
+    Returns the uint64 word with the bits of one or multiple *triggers* (objects or ids) set,
+    following the bit registry in ``config_inst.x.trigger_bits``.
+    """
+    word = np.uint64(0)
+    for trigger in (triggers if isinstance(triggers, (list, tuple, set)) else [triggers]):
+        trigger_id = trigger.id if isinstance(trigger, Trigger) else trigger
+        word |= np.uint64(1) << np.uint64(config_inst.x.trigger_bits[trigger_id])
+    return word
+
+
+def fired_any(
+    trigger_mask: np.ndarray | ak.Array,
+    config_inst: od.Config,
+    triggers: Trigger | int | list[Trigger | int],
+) -> np.ndarray:
+    """
+    Returns an event mask denoting whether at least one of the *triggers* fired (and matched all its
+    legs) according to the *trigger_mask* column.
+    """
+    word = trigger_word(config_inst, triggers)
+    return (np.asarray(trigger_mask) & word) != 0
+
+
+def fired_all(
+    trigger_mask: np.ndarray | ak.Array,
+    config_inst: od.Config,
+    triggers: Trigger | int | list[Trigger | int],
+) -> np.ndarray:
+    """
+    Returns an event mask denoting whether all of the *triggers* fired according to the
+    *trigger_mask* column.
+    """
+    word = trigger_word(config_inst, triggers)
+    return (np.asarray(trigger_mask) & word) == word
+
+
+def fired_only(
+    trigger_mask: np.ndarray | ak.Array,
+    config_inst: od.Config,
+    triggers: Trigger | int | list[Trigger | int],
+) -> np.ndarray:
+    """
+    Returns an event mask denoting whether no trigger other than the *triggers* fired according to
+    the *trigger_mask* column. Note that, just as ``ak.all`` over an empty list of fired trigger ids,
+    this is *True* for events where no trigger fired at all.
+    """
+    word = trigger_word(config_inst, triggers)
+    return (np.asarray(trigger_mask) & ~word) == 0
+
+
+def get_trigger_ids(trigger_mask: np.ndarray | ak.Array, config_inst: od.Config) -> ak.Array:
+    """
+    Converts the *trigger_mask* column into ragged lists of ids of fired triggers, ordered as in
+    ``config_inst.x.triggers``.
+    """
+    ids = np.array(list(config_inst.x.trigger_bits.keys()), dtype=np.int32)
+    bits = np.array(list(config_inst.x.trigger_bits.values()), dtype=np.uint64)
+    fired = ((np.asarray(trigger_mask)[:, None] >> bits[None, :]) & np.uint64(1)) != 0
+    n_fired = fired.sum(axis=1)
+    return ak.unflatten(np.broadcast_to(ids, fired.shape)[fired], n_fired)
+
 
 @selector(
     uses={
         # nano columns
-        "nTrigObj", "TrigObj.id", "TrigObj.pt", "TrigObj.eta", "TrigObj.phi", "TrigObj.filterBits",
+        "run", "nTrigObj", "TrigObj.id", "TrigObj.pt", "TrigObj.eta", "TrigObj.phi", "TrigObj.filterBits",
     },
     produces={
         # new columns
-        "trigger_ids",
+        "trigger_mask",
     },
     exposed=True,
+    # whether to additionally produce the ragged "trigger_ids" column, mostly for backwards
+    # compatibility as they can be obtained from "trigger_mask" via get_trigger_ids
+    produce_trigger_ids=False,
+    # whether to consult the index of existing HLT branches per file to only read existing ones
+    use_hlt_branch_index=True,
 )
 def trigger_selection(
     self: Selector,
@@ -30,44 +290,61 @@ def trigger_selection(
     **kwargs,
 ) -> tuple[ak.Array, SelectionResult]:
     """
-    HLT trigger path selection.
+    HLT trigger path selection. Decisions of triggers that fired and whose legs are all matched are
+    stored in the uint64 column "trigger_mask", using the bit registry in ``config_inst.x.trigger_bits``.
+
+    Triggers whose HLT path does not exist in the processed files according to the index created by
+    :py:class:`hbt.tasks.triggers.CreateHLTBranchIndex` are treated as not fired.
+
+    In data, triggers are only considered within their run range (if any). Triggers whose run range
+    does not overlap with the runs contained in a chunk are skipped entirely.
     """
-    any_fired = False
+    any_fired = np.zeros(len(events), dtype=bool)
     trigger_data = []
-    trigger_ids = []
+    trigger_mask = np.zeros(len(events), dtype=np.uint64)
 
-    # index of TrigObj's to repeatedly convert masks to indices
-    index = ak.local_index(events.TrigObj)
+    # in data, get the range of runs in this chunk to consider run ranges of triggers
+    runs = None
+    if self.dataset_inst.is_data and len(events):
+        runs = np.asarray(events.run)
+        run_min, run_max = runs.min(), runs.max()
 
+    # get triggers to evaluate, skipping those whose run range does not overlap with the chunk
+    triggers = []
     for trigger in self.config_inst.x.triggers:
-        # skip the trigger if it does not apply to the dataset
+        # skip the trigger if it does not apply to the dataset or its HLT path is missing
         if not trigger.applies_to_dataset(self.dataset_inst):
             continue
+        if trigger.id in self.missing_hlt_triggers:
+            continue
+        if runs is not None and trigger.run_range is not None:
+            if run_max < trigger.run_range[0] or run_min > trigger.run_range[1]:
+                continue
+        triggers.append(trigger)
 
+    # evaluate all unique legs of all remaining triggers at once
+    leg_cache = TriggerLegCache(
+        events.TrigObj,
+        [leg for trigger in triggers for leg in (trigger.legs or [])],
+    )
+
+    for trigger in triggers:
         # get bare decisions
         fired = events.HLT[trigger.hlt_field] == 1
+
+        # restrict to the run range when the chunk is not fully contained in it
+        if runs is not None and trigger.run_range is not None:
+            start, end = trigger.run_range
+            if run_min < start or run_max > end:
+                fired = fired & (runs >= start) & (runs <= end)
+
         any_fired = any_fired | fired
 
         # get trigger objects for fired events per leg
-        leg_masks = []
-        all_legs_match = True
-        for leg in trigger.legs:
-            # start with a True mask
-            leg_mask = abs(events.TrigObj.id) >= 0
-            # pdg id selection
-            if leg.pdg_id is not None:
-                leg_mask = leg_mask & (abs(events.TrigObj.id) == leg.pdg_id)
-            # pt cut
-            if leg.min_pt is not None:
-                leg_mask = leg_mask & (events.TrigObj.pt >= leg.min_pt)
-            # trigger bits match
-            if leg.trigger_bits is not None:
-                # OR across bits themselves, AND between all decision in the list
-                for bits in leg.trigger_bits:
-                    leg_mask = leg_mask & ((events.TrigObj.filterBits & bits) > 0)
-            leg_masks.append(index[leg_mask])
-            # at least one object must match this leg
-            all_legs_match = all_legs_match & ak.any(leg_mask, axis=1)
+        leg_masks = [leg_cache.indices(leg) for leg in (trigger.legs or [])]
+
+        # at least one object must match each leg
+        all_legs_match = leg_cache.all_legs_match(trigger.legs or [])
 
         # final trigger decision
         fired_and_all_legs_match = fired & all_legs_match
@@ -75,13 +352,14 @@ def trigger_selection(
         # store all intermediate results for subsequent selectors
         trigger_data.append((trigger, fired_and_all_legs_match, leg_masks))
 
-        # store the trigger id
-        ids = ak.where(fired_and_all_legs_match, np.float32(trigger.id), np.float32(np.nan))
-        trigger_ids.append(ak.singletons(ak.nan_to_none(ids)))
+        # store the trigger bit
+        trigger_mask[np.asarray(fired_and_all_legs_match)] |= trigger_word(self.config_inst, trigger)
 
-    # store the fired trigger ids
-    trigger_ids = ak.concatenate(trigger_ids, axis=1)
-    events = set_ak_column(events, "trigger_ids", trigger_ids, value_type=np.int32)
+    # store the trigger mask and optionally the ids of fired triggers
+    events = set_ak_column(events, "trigger_mask", trigger_mask, value_type=np.uint64)
+    if self.produce_trigger_ids:
+        trigger_ids = get_trigger_ids(trigger_mask, self.config_inst)
+        events = set_ak_column(events, "trigger_ids", trigger_ids, value_type=np.int32)
 
     return events, SelectionResult(
         steps={
@@ -89,12 +367,19 @@ def trigger_selection(
         },
         aux={
             "trigger_data": trigger_data,
+            "trigger_leg_cache": leg_cache,
         },
     )
 
 
 @trigger_selection.init
 def trigger_selection_init(self: Selector) -> None:
+    if self.produce_trigger_ids:
+        self.produces.add("trigger_ids")
+
+    # ids of triggers whose HLT path is missing in the processed files, updated during setup
+    self.missing_hlt_triggers = set()
+
     if getattr(self, "dataset_inst", None) is None:
         return
 
@@ -104,3 +389,42 @@ def trigger_selection_init(self: Selector) -> None:
         for trigger in self.config_inst.x.triggers
         if trigger.applies_to_dataset(self.dataset_inst)
     }
+
+
+@trigger_selection.requires
+def trigger_selection_requires(self: Selector, reqs: dict) -> None:
+    """
+    Adds the index of existing HLT branches to the requirements.
+    """
+    if not self.use_hlt_branch_index or "hlt_branch_index" in reqs:
+        return
+
+    from hbt.tasks.triggers import CreateHLTBranchIndex
+    reqs["hlt_branch_index"] = CreateHLTBranchIndex.req(self.task)
+
+
+@trigger_selection.setup
+def trigger_selection_setup(self: Selector, reqs: dict, inputs: dict) -> None:
+    """
+    Consults the index of existing HLT branches and removes paths from the used columns that are
+    missing in at least one of the files processed by the current task.
+    """
+    if "hlt_branch_index" not in inputs or not self.task.is_branch():
+        return
+
+    from hbt.tasks.triggers import load_hlt_branch_index
+    index = load_hlt_branch_index(inputs["hlt_branch_index"])
+
+    # get ids of triggers whose paths exist in all indexed files of this branch
+    file_indices = [i for i in law.util.make_list(self.task.branch_data) if i in index]
+    if not file_indices:
+        return
+    existing_ids = set.intersection(*(index[i] for i in file_indices))
+
+    # update missing triggers and used columns
+    for trigger in self.config_inst.x.triggers:
+        if trigger.id in existing_ids or not trigger.applies_to_dataset(self.dataset_inst):
+            continue
+        self.missing_hlt_triggers.add(trigger.id)
+        self.uses.discard(trigger.name)
+        logger.warning(f"HLT path {trigger.name} missing in input file(s), trigger treated as not fired")
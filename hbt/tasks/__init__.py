@@ -3,4 +3,7 @@
 
 # provisioning imports
 import hbt.tasks.base
+import hbt.tasks.production
+import hbt.tasks.selection
+import hbt.tasks.triggers
 import hbt.tasks.studies
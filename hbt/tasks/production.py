@@ -0,0 +1,131 @@
+# coding: utf-8
+
+"""
+Production related tasks.
+"""
+
+from __future__ import annotations
+
+import luigi
+import law
+
+from columnflow.tasks.framework.base import Requirements, DatasetTask
+from columnflow.tasks.framework.mixins import ProducerMixin, ChunkedIOMixin
+from columnflow.tasks.framework.remote import RemoteWorkflow
+from columnflow.tasks.external import GetDatasetLFNs
+from columnflow.util import ensure_proxy, dev_sandbox
+
+from hbt.tasks.base import HBTTask
+
+
+class ProduceGenSidecar(
+    HBTTask,
+    ProducerMixin,
+    ChunkedIOMixin,
+    DatasetTask,
+    law.LocalWorkflow,
+    RemoteWorkflow,
+):
+    """
+    Runs a *producer* of generator-level columns on the original nano files of a dataset and
+    stores the produced columns per file in a parquet sidecar with one row per entry, so that rows
+    are keyed by their entry index in the nano file. Since the producer must not depend on any
+    shift, the sidecar is created only once and can be joined to the events of all shifts in the
+    same way as calibrated columns, see :py:class:`hbt.tasks.selection.SelectEventsMultiShift`.
+
+    Example:
+
+        > law run hbt.ProduceGenSidecar --dataset hh_ggf_bbtautau_madgraph --branch 0
+    """
+
+    producer = luigi.Parameter(
+        default="gen_HH_decay_products",
+        description="the producer of generator-level columns; default: gen_HH_decay_products",
+    )
+
+    sandbox = dev_sandbox(law.config.get("analysis", "default_columnar_sandbox"))
+
+    # upstream requirements
+    reqs = Requirements(
+        RemoteWorkflow.reqs,
+        GetDatasetLFNs=GetDatasetLFNs,
+    )
+
+    register_producer_sandbox = True
+
+    def workflow_requires(self):
+        reqs = super().workflow_requires()
+        reqs["lfns"] = self.reqs.GetDatasetLFNs.req(self)
+
+        # add producer dependent requirements
+        reqs["producer"] = self.producer_inst.run_requires()
+
+        return reqs
+
+    def requires(self):
+        return {
+            "lfns": self.reqs.GetDatasetLFNs.req(self),
+            "producer": self.producer_inst.run_requires(),
+        }
+
+    def output(self):
+        return {"columns": self.target(f"gen_sidecar_{self.branch}.parquet")}
+
+    @law.decorator.log
+    @ensure_proxy
+    @law.decorator.localize(input=False)
+    @law.decorator.safe_output
+    def run(self):
+        from columnflow.columnar_util import (
+            Route, RouteFilter, mandatory_coffea_columns, sorted_ak_to_parquet,
+        )
+
+        # prepare inputs and outputs
+        reqs = self.requires()
+        lfn_task = reqs["lfns"]
+        output = self.output()
+        output_chunks = {}
+
+        # run the producer setup
+        self.producer_inst.run_setup(reqs["producer"], luigi.task.getpaths(reqs["producer"]))
+
+        # the producer must not be affected by shifts
+        if self.producer_inst.shifts:
+            raise Exception(
+                f"producer {self.producer_inst.cls_name} registers shifts "
+                f"{','.join(sorted(self.producer_inst.shifts))} and cannot be used for a "
+                "shift independent sidecar",
+            )
+
+        # create a temporary directory
+        tmp_dir = law.LocalDirectoryTarget(is_tmp=True)
+        tmp_dir.touch()
+
+        # define columns that need to be read and written
+        read_columns = set(map(Route, mandatory_coffea_columns)) | self.producer_inst.used_columns
+        route_filter = RouteFilter(self.producer_inst.produced_columns)
+
+        # let the lfn_task prepare the nano file (basically determine a good pfn)
+        [(lfn_index, input_file)] = lfn_task.iter_nano_files(self)
+
+        # open the input file with uproot
+        with self.publish_step("load and open ..."):
+            nano_file = input_file.load(formatter="uproot")
+
+        # iterate over chunks of events
+        for (events,), pos in self.iter_chunked_io(
+            [nano_file],
+            source_type=["coffea_root"],
+            read_columns=[read_columns],
+        ):
+            # invoke the producer and keep only produced columns
+            events = route_filter(self.producer_inst(events))
+
+            # save as parquet via a thread in the same pool
+            chunk = tmp_dir.child(f"file_{lfn_index}_{pos.index}.parquet", type="f")
+            output_chunks[pos.index] = chunk
+            self.chunked_io.queue(sorted_ak_to_parquet, (events, chunk.path))
+
+        # merge output files in the order of chunks to preserve the entry order
+        sorted_chunks = [output_chunks[key] for key in sorted(output_chunks)]
+        law.pyarrow.merge_parquet_task(self, sorted_chunks, output["columns"], local=True)
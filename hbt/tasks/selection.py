@@ -0,0 +1,385 @@
+# coding: utf-8
+
+"""
+Selection related tasks.
+"""
+
+from __future__ import annotations
+
+from collections import defaultdict
+
+import luigi
+import law
+
+from columnflow.tasks.framework.base import Requirements, DatasetTask
+from columnflow.tasks.framework.mixins import CalibratorsMixin, SelectorMixin
+from columnflow.tasks.selection import SelectEvents, MergeSelectionMasks
+from columnflow.util import ensure_proxy, maybe_import, dev_sandbox
+
+from hbt.tasks.base import HBTTask
+from hbt.tasks.production import ProduceGenSidecar
+
+
+np = maybe_import("numpy")
+ak = maybe_import("awkward")
+
+
+def read_entries(
+    tree,
+    routes: set,
+    entries: np.ndarray,
+    max_gap: int = 1000,
+) -> ak.Array:
+    """
+    Reads the columns referred to by *routes* for the sorted *entries* of an uproot *tree* and
+    returns them as an array with one item per entry, nesting collection fields as in nano files.
+    Only ranges around requested entries are read, joining ranges that are separated by less than
+    *max_gap* entries to limit the number of reads.
+    """
+    from columnflow.columnar_util import Route
+
+    routes = sorted(map(Route, routes), key=str)
+    branches = [route.nano_column for route in routes]
+
+    # determine contiguous ranges to read
+    entries = np.asarray(entries, dtype=np.int64)
+    if len(entries):
+        split = np.flatnonzero(np.diff(entries) > max_gap) + 1
+        starts = entries[np.concatenate([[0], split])]
+        stops = entries[np.concatenate([split - 1, [len(entries) - 1]])] + 1
+    else:
+        starts = stops = entries
+
+    # read ranges and pick entries
+    chunks = []
+    for start, stop in zip(starts, stops):
+        arrays = tree.arrays(branches, entry_start=start, entry_stop=stop, how=dict)
+        pick = entries[(entries >= start) & (entries < stop)] - start
+        chunks.append({branch: arr[pick] for branch, arr in arrays.items()})
+
+    # concatenate and build nested records
+    fields = {}
+    for route, branch in zip(routes, branches):
+        if chunks:
+            arr = ak.concatenate([chunk[branch] for chunk in chunks], axis=0)
+        else:
+            arr = tree.arrays([branch], entry_start=0, entry_stop=0, how=dict)[branch]
+        if len(route.fields) == 1:
+            fields[route.fields[0]] = arr
+        else:
+            fields.setdefault(route.fields[0], {})[route.fields[1]] = arr
+
+    return ak.zip(
+        {
+            name: ak.zip(value) if isinstance(value, dict) else value
+            for name, value in fields.items()
+        },
+        depth_limit=1,
+    )
+
+
+class SelectEventsMultiShift(HBTTask, SelectEvents):
+    """
+    Runs the event selection for the nominal shift and all shifts with at least one of the
+    *shift_tags* in a single job and writes the outputs of the corresponding :py:class:`SelectEvents`
+    tasks. Supported are shifts that are implemented purely through column aliases whose source
+    columns are part of the nominal calibration output, such as tau energy corrections (tec) or jet
+    energy corrections and resolution (jec, jer).
+
+    Inputs are read once and shift-invariant selection steps are evaluated once per chunk through a
+    cache that is passed to the selector as *shift_cache*, along with the names of columns altered
+    by the current shift as *shifted_columns*.
+
+    Used columns that the selector declares as *deferred_columns* are not read upfront when
+    *defer_columns* is set. Instead, a function *load_deferred_columns* is passed to the selector
+    that reads them from the nano file only for the requested events.
+
+    For simulated datasets and with *gen_sidecar* set, shift independent generator-level columns
+    are joined from the output of :py:class:`hbt.tasks.production.ProduceGenSidecar`, and columns
+    the selector declares as *gen_sidecar_columns* are not read from the nano file.
+
+    Examples:
+
+        > law run hbt.SelectEventsMultiShift --dataset hh_ggf_bbtautau_madgraph --branch 0
+
+        > law run hbt.SelectEventsMultiShift --dataset hh_ggf_bbtautau_madgraph --shift-tags jec,jer
+    """
+
+    shift_tags = law.CSVParameter(
+        default=("tec",),
+        significant=False,
+        description="tags of shifts to select together with the nominal one; default: tec",
+    )
+
+    defer_columns = luigi.BoolParameter(
+        default=True,
+        significant=False,
+        description="read columns declared as deferred by the selector only for events that need "
+        "them; default: True",
+    )
+
+    gen_sidecar = luigi.BoolParameter(
+        default=False,
+        significant=False,
+        description="join shift independent generator-level columns from a sidecar created by "
+        "ProduceGenSidecar instead of reading the columns declared as gen_sidecar_columns by the "
+        "selector; default: False",
+    )
+
+    @property
+    def batched_shifts(self) -> list[str]:
+        return ["nominal"] + [
+            shift_inst.name
+            for shift_inst in self.config_inst.shifts
+            if shift_inst.has_tag(tuple(self.shift_tags))
+        ]
+
+    @property
+    def use_gen_sidecar(self) -> bool:
+        return (
+            self.gen_sidecar and
+            self.dataset_inst.is_mc and
+            bool(getattr(self.selector_inst, "gen_sidecar_columns", None))
+        )
+
+    def workflow_requires(self):
+        reqs = super().workflow_requires()
+        if self.use_gen_sidecar:
+            reqs["gen_sidecar"] = ProduceGenSidecar.req(self)
+        return reqs
+
+    def requires(self):
+        reqs = super().requires()
+        if self.use_gen_sidecar:
+            reqs["gen_sidecar"] = ProduceGenSidecar.req(self)
+        return reqs
+
+    def output(self):
+        return {
+            shift: SelectEvents.req(self, shift=shift).output()
+            for shift in self.batched_shifts
+        }
+
+    @law.decorator.log
+    @ensure_proxy
+    @law.decorator.localize(input=False)
+    @law.decorator.safe_output
+    def run(self):
+        from columnflow.columnar_util import (
+            Route, RouteFilter, mandatory_coffea_columns, update_ak_array, add_ak_aliases,
+            sorted_ak_to_parquet,
+        )
+
+        # prepare inputs and outputs
+        reqs = self.requires()
+        lfn_task = reqs["lfns"]
+        inputs = self.input()
+        outputs = self.output()
+        result_chunks = defaultdict(dict)
+        column_chunks = defaultdict(dict)
+        stats = {shift: defaultdict(float) for shift in self.batched_shifts}
+
+        # run the selector setup
+        selector_reqs = self.selector_inst.run_requires()
+        self.selector_inst.run_setup(selector_reqs, luigi.task.getpaths(selector_reqs))
+
+        # create a temporary directory
+        tmp_dir = law.LocalDirectoryTarget(is_tmp=True)
+        tmp_dir.touch()
+
+        # get aliases per shift
+        aliases = {
+            shift: self.config_inst.get_shift(shift).x("column_aliases", {})
+            for shift in self.batched_shifts
+        }
+
+        # define columns that need to be read, including the sources of all shifted columns
+        read_columns = set(map(Route, mandatory_coffea_columns))
+        read_columns |= self.selector_inst.used_columns
+        for shift_aliases in aliases.values():
+            read_columns |= set(map(Route, shift_aliases.values()))
+
+        # columns to be read lazily
+        deferred_columns = set()
+        if self.defer_columns:
+            deferred_columns = set(map(Route, getattr(self.selector_inst, "deferred_columns", [])))
+            deferred_columns -= set(map(Route, mandatory_coffea_columns))
+            read_columns -= deferred_columns
+
+        # optionally join generator-level columns from a sidecar instead of reading their sources
+        if self.use_gen_sidecar:
+            read_columns -= set(map(Route, self.selector_inst.gen_sidecar_columns))
+            read_columns |= reqs["gen_sidecar"].producer_inst.produced_columns
+
+        # define columns that will be written
+        write_columns = self.selector_inst.produced_columns
+        route_filter = RouteFilter(write_columns)
+
+        # let the lfn_task prepare the nano file (basically determine a good pfn)
+        [(lfn_index, input_file)] = lfn_task.iter_nano_files(self)
+
+        # open the input file with uproot
+        with self.publish_step("load and open ..."):
+            nano_file = input_file.load(formatter="uproot")
+
+        # iterate over chunks of events and diffs, as well as sidecar columns
+        sources = [nano_file, *(inp.path for inp in inputs["calibrations"])]
+        if self.use_gen_sidecar:
+            sources.append(inputs["gen_sidecar"]["columns"].path)
+        for (events, *cols), pos in self.iter_chunked_io(
+            sources,
+            source_type=["coffea_root"] + (len(sources) - 1) * ["awkward_parquet"],
+            read_columns=len(sources) * [read_columns],
+        ):
+            # apply the calibrated diffs and join sidecar columns
+            events = update_ak_array(events, *cols)
+
+            # prepare lazy reading of deferred columns, shared across shifts per set of entries
+            selector_kwargs = {}
+            if deferred_columns:
+                deferred_cache = {}
+
+                def load_deferred_columns(indices: np.ndarray) -> ak.Array:
+                    key = indices.tobytes()
+                    if key not in deferred_cache:
+                        deferred_cache[key] = read_entries(
+                            nano_file["Events"],
+                            deferred_columns,
+                            indices + pos.entry_start,
+                        )
+                    return deferred_cache[key]
+
+                selector_kwargs["load_deferred_columns"] = load_deferred_columns
+
+            # select the chunk once per shift, sharing shift-invariant steps
+            shift_cache = {}
+            for shift in self.batched_shifts:
+                # add aliases to a shallow copy to leave source columns intact for other shifts
+                shift_events = add_ak_aliases(ak.Array(events), aliases[shift], remove_src=True)
+
+                # invoke the selection function
+                shift_events, results = self.selector_inst(
+                    shift_events,
+                    stats[shift],
+                    shift_cache=shift_cache,
+                    shifted_columns=set(aliases[shift]),
+                    **selector_kwargs,
+                )
+
+                # complain when there is no event mask
+                if results.event is None:
+                    raise Exception(
+                        f"selector {self.selector_inst.cls_name} did not set an event mask in "
+                        "the selection results",
+                    )
+
+                # save results as parquet via a thread in the same pool
+                chunk = tmp_dir.child(f"res_{shift}_{lfn_index}_{pos.index}.parquet", type="f")
+                result_chunks[shift][(lfn_index, pos.index)] = chunk
+                self.chunked_io.queue(sorted_ak_to_parquet, (results.to_ak(), chunk.path))
+
+                # save produced columns
+                if write_columns:
+                    shift_events = route_filter(shift_events)
+                    chunk = tmp_dir.child(f"cols_{shift}_{lfn_index}_{pos.index}.parquet", type="f")
+                    column_chunks[shift][(lfn_index, pos.index)] = chunk
+                    self.chunked_io.queue(sorted_ak_to_parquet, (shift_events, chunk.path))
+
+        # merge the result and column files per shift
+        for shift in self.batched_shifts:
+            for key, chunks in [("results", result_chunks), ("columns", column_chunks)]:
+                if key not in outputs[shift]:
+                    continue
+                sorted_chunks = [chunks[shift][_key] for _key in sorted(chunks[shift])]
+                law.pyarrow.merge_parquet_task(
+                    self,
+                    sorted_chunks,
+                    outputs[shift][key],
+                    local=True,
+                    writer_opts=self.get_parquet_writer_opts(),
+                )
+
+            # save stats
+            outputs[shift]["stats"].dump(stats[shift], indent=4, formatter="json")
+
+        self.publish_message(f"selected {len(self.batched_shifts)} shifts in one pass")
+
+
+class SelectionStepsCutflow(HBTTask, SelectorMixin, CalibratorsMixin, DatasetTask):
+    """
+    Computes sequential and N-1 cutflow tables of a dataset from the ``selection_steps`` column in
+    the merged selection masks, see :py:func:`hbt.selection.cutflow.selection_steps`. Only this
+    column (and normalization weights for simulation) is read, so that arbitrary combinations of
+    steps can be studied without rerunning the selection. Steps can be reordered and subsets chosen
+    through *steps*, with names prefixed with "!" denoting steps that must have failed.
+
+    Example:
+
+        > law run hbt.SelectionStepsCutflow --dataset hh_ggf_bbtautau_madgraph --selector boosted \\
+            --steps "trigger,lepton,fatjet,!gen_matched_2"
+    """
+
+    steps = law.CSVParameter(
+        default=(),
+        description="selection steps to consider in the given order, with a '!' prefix for steps "
+        "that must have failed; empty default: all registered steps that are encoded in the column",
+    )
+    table_format = luigi.Parameter(
+        default="fancy_grid",
+        significant=False,
+        description="a tabulate table format; default: 'fancy_grid'",
+    )
+
+    sandbox = dev_sandbox("bash::$CF_BASE/sandboxes/venv_columnar.sh")
+
+    # upstream requirements
+    reqs = Requirements(
+        MergeSelectionMasks=MergeSelectionMasks,
+    )
+
+    def requires(self):
+        return self.reqs.MergeSelectionMasks.req(self, tree_index=0, branch=0, _exclude={"branches"})
+
+    def output(self):
+        steps_repr = "__".join(self.steps).replace("!", "not_") if self.steps else "all"
+        return self.target(f"cutflow__{steps_repr}.json")
+
+    @law.decorator.log
+    @law.decorator.safe_output
+    def run(self):
+        from tabulate import tabulate
+        from hbt.selection.cutflow import Cutflow
+
+        # read only the steps column and weights
+        columns = ["selection_steps"] + (["normalization_weight"] if self.dataset_inst.is_mc else [])
+        with self.publish_step("reading selection steps ..."):
+            masks = ak.from_parquet(self.input()["masks"].path, columns=columns)
+
+        weights = {"normalization_weight": masks.normalization_weight} if self.dataset_inst.is_mc else None
+        cutflow = Cutflow.from_column(
+            masks.selection_steps,
+            self.config_inst.x.selection_step_bits,
+            weights=weights,
+        )
+
+        # by default, consider all steps that were encoded for at least one event
+        steps = list(self.steps)
+        if not steps:
+            steps = [step for step in cutflow.steps if cutflow.passed([step]) > 0]
+
+        # compute tables per count
+        data = {"steps": steps, "sequential": {}, "n_minus_one": {}}
+        for key in cutflow.counts:
+            data["sequential"][key] = cutflow.sequential(key=key, steps=steps)
+            data["n_minus_one"][key] = cutflow.n_minus_one(key=key, steps=steps)
+
+            header = ["step", key, "efficiency", f"{key} (N-1)", "efficiency (N-1)"]
+            rows = [
+                [step, *data["sequential"][key][step], *data["n_minus_one"][key][step]]
+                for step in steps
+            ]
+            print("")
+            print(tabulate(rows, headers=header, tablefmt=self.table_format, floatfmt=".4g"))
+        print("")
+
+        self.output().dump(data, indent=4, formatter="json")
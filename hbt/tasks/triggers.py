@@ -0,0 +1,107 @@
+# coding: utf-8
+
+"""
+Trigger related tasks.
+"""
+
+from __future__ import annotations
+
+from concurrent.futures import ThreadPoolExecutor
+
+import luigi
+import law
+
+from columnflow.tasks.framework.base import Requirements, DatasetTask
+from columnflow.tasks.external import GetDatasetLFNs
+from columnflow.util import ensure_proxy, dev_sandbox
+
+from hbt.tasks.base import HBTTask
+
+
+class CreateHLTBranchIndex(HBTTask, DatasetTask):
+    """
+    Creates an index of the HLT paths of all configured triggers that exist as branches in each file
+    of a dataset. Per file, existing paths are stored as an integer bitset following the trigger bit
+    registry in ``config.x.trigger_bits``. Only the metadata of the "Events" trees is read, with
+    files being opened in parallel.
+
+    Example:
+
+        > law run hbt.CreateHLTBranchIndex --dataset data_mu_b
+    """
+
+    n_threads = luigi.IntParameter(
+        default=8,
+        significant=False,
+        description="number of files to open in parallel; default: 8",
+    )
+
+    sandbox = dev_sandbox("bash::$CF_BASE/sandboxes/venv_columnar.sh")
+
+    version = None
+
+    # upstream requirements
+    reqs = Requirements(
+        GetDatasetLFNs=GetDatasetLFNs,
+    )
+
+    def requires(self):
+        return self.reqs.GetDatasetLFNs.req(self)
+
+    def output(self):
+        return self.target("hlt_branch_index.json")
+
+    @law.decorator.log
+    @ensure_proxy
+    @law.decorator.safe_output
+    def run(self):
+        lfn_task = self.requires()
+        triggers = list(self.config_inst.x.triggers)
+        trigger_bits = self.config_inst.x.trigger_bits
+
+        def get_bitset(input_file: law.FileSystemFileTarget) -> int:
+            # only the tree metadata is read to obtain branch names
+            nano_file = input_file.load(formatter="uproot")
+            hlt_paths = set(nano_file["Events"].keys(filter_name="HLT_*"))
+            bitset = 0
+            for trigger in triggers:
+                if trigger.name in hlt_paths:
+                    bitset |= 1 << trigger_bits[trigger.id]
+            return bitset
+
+        # locate all files and open them in parallel
+        lfn_indices = list(range(self.dataset_info_inst.n_files))
+        with self.publish_step(f"reading HLT branches of {len(lfn_indices)} file(s) ..."):
+            file_indices, input_files = zip(*lfn_task.iter_nano_files(self, lfn_indices=lfn_indices))
+            with ThreadPoolExecutor(max_workers=self.n_threads) as pool:
+                bitsets = list(pool.map(get_bitset, input_files))
+
+        # save the index
+        self.output().dump({
+            "triggers": {trigger.id: trigger.name for trigger in triggers},
+            "trigger_bits": trigger_bits,
+            "files": dict(zip(map(int, file_indices), bitsets)),
+        }, indent=4, formatter="json")
+
+        # some stats
+        n_missing = sum(
+            any(not (bitset >> bit) & 1 for bit in trigger_bits.values())
+            for bitset in bitsets
+        )
+        self.publish_message(f"{n_missing} of {len(bitsets)} file(s) lack at least one HLT path")
+
+
+def load_hlt_branch_index(target: law.FileSystemFileTarget) -> dict[int, set[int]]:
+    """
+    Loads the index created by :py:class:`CreateHLTBranchIndex` from *target* and returns a mapping
+    of file indices to sets of ids of triggers whose HLT path exists in the file.
+    """
+    index = target.load(formatter="json")
+    trigger_bits = {int(trigger_id): bit for trigger_id, bit in index["trigger_bits"].items()}
+    return {
+        int(file_index): {
+            trigger_id for trigger_id, bit in trigger_bits.items()
+            if (bitset >> bit) & 1
+        }
+        for file_index, bitset in index["files"].items()
+    }
@@ -0,0 +1,41 @@
+# coding: utf-8
+
+"""
+Collection of general helpers and utilities.
+"""
+
+from __future__ import annotations
+
+__all__ = ["njit"]
+
+from typing import Callable
+
+from columnflow.util import MockModule, maybe_import
+
+
+numba = maybe_import("numba")
+
+
+def njit(func: Callable | None = None, **kwargs) -> Callable:
+    """
+    Decorator that compiles *func* with ``numba.njit``, forwarding all *kwargs*. When numba is not
+    available (e.g. when a module is merely imported outside of a columnar sandbox to build the task
+    graph), *func* is returned unchanged so that the decorated kernel remains usable in pure python.
+    Can be used with and without parentheses:
+
+    .. code-block:: python
+
+        @njit
+        def kernel(...):
+            ...
+
+        @njit(parallel=True)
+        def kernel(...):
+            ...
+    """
+    def decorator(func: Callable) -> Callable:
+        if isinstance(numba, MockModule):
+            return func
+        return numba.njit(**kwargs)(func)
+
+    return decorator if func is None else decorator(func)
@@ -16,4 +16,8 @@ sys.path.append(base)
 import hbt  # noqa
 
 # import all tests
-# ...
+from .test_lepton_selection import *
+from .test_columnar_util import *
+from .test_jet_selection import *
+from .test_gen_HH_decay import *
+from .test_hhbtag import *
@@ -0,0 +1,420 @@
+# coding: utf-8
+
+"""
+Tests for the helpers and compiled kernels in hbt.columnar_util.
+"""
+
+__all__ = ["DeltaRMaskTest", "SortingTest", "RaggedIsinTest", "DeltaRMatchingTest"]
+
+import unittest
+
+from columnflow.util import maybe_import
+from columnflow.columnar_util import EMPTY_FLOAT
+
+from hbt.columnar_util import (
+    get_offsets, any_within_delta_r, all_beyond_delta_r, flat_argsort, masked_argsort, masked_top_k,
+    take_padded, padded_to_ragged, ragged_isin,
+    unique_delta_r_match, match_pairs, chain_delta_r_matches,
+)
+
+
+np = maybe_import("numpy")
+ak = maybe_import("awkward")
+
+
+def random_objects(rng: np.random.Generator, n_events: int, max_count: int, width: float = 1.0):
+    """
+    Returns a ragged collection of objects with random *eta* and *phi* within +-*width* and between
+    zero and *max_count* objects per event.
+    """
+    counts = rng.integers(0, max_count + 1, n_events)
+    return ak.unflatten(
+        ak.zip({
+            "eta": rng.uniform(-width, width, counts.sum()),
+            "phi": rng.uniform(-width, width, counts.sum()),
+        }),
+        counts,
+    )
+
+
+def grid_objects(rng: np.random.Generator, n_events: int, max_count: int) -> ak.Array:
+    """
+    Returns a ragged collection of objects with *eta* and *phi* on a grid with a spacing of 0.25, so
+    that many pairs of objects have identical distances, e.g. exactly 0.5.
+    """
+    counts = rng.integers(0, max_count + 1, n_events)
+    return ak.unflatten(
+        ak.zip({
+            "eta": 0.25 * rng.integers(-4, 5, counts.sum()),
+            "phi": 0.25 * rng.integers(-4, 5, counts.sum()),
+        }),
+        counts,
+    )
+
+
+def metric_table_reference(objects1: ak.Array, objects2: ak.Array) -> ak.Array:
+    """
+    Reference implementation of the table of delta R values between all pairs of objects per event
+    with shape ``(n_events, n_objects1, n_objects2)``, as built by coffea's ``metric_table``.
+    """
+    a, b = ak.unzip(ak.cartesian([objects1, objects2], axis=1, nested=True))
+    deta = a.eta - b.eta
+    dphi = (a.phi - b.phi + np.pi) % (2 * np.pi) - np.pi
+    return np.sqrt(deta**2 + dphi**2)
+
+
+def random_keys(rng: np.random.Generator, counts: np.ndarray, n_values: int) -> ak.Array:
+    """
+    Returns a ragged float array with *counts* elements per event and integer values between zero
+    and *n_values*, so that ties are frequent.
+    """
+    return ak.unflatten(rng.integers(0, n_values, counts.sum()).astype(np.float32), counts)
+
+
+def argsort_reference(keys: list[ak.Array], ascending: bool) -> ak.Array:
+    """
+    Reference implementation of a stable, lexicographic sort of multiple ragged *keys* within each
+    event by successive stable sorts with awkward, starting with the least significant key.
+    """
+    indices = ak.local_index(keys[0], axis=1)
+    for key in keys[::-1]:
+        indices = indices[ak.argsort(key[indices], axis=1, ascending=ascending, stable=True)]
+    return indices
+
+
+def pad_reference(indices: ak.Array, k: int) -> np.ndarray:
+    """
+    Pads or clips ragged *indices* to *k* entries per event, filling missing entries with -1.
+    """
+    return ak.to_numpy(ak.fill_none(ak.pad_none(indices, k, axis=1, clip=True), -1))
+
+
+def isin_reference(elements: ak.Array, test_elements: ak.Array) -> ak.Array:
+    """
+    Reference implementation of the membership test of ragged *elements* in *test_elements* per
+    event with a python loop over ``np.isin``, as previously done in the gen matching. Missing
+    values are never considered contained.
+    """
+    return ak.from_iter([
+        [
+            x is not None and bool(np.isin(x, [y for y in b if y is not None]))
+            for x in a
+        ]
+        for a, b in zip(elements.tolist(), test_elements.tolist())
+    ])
+
+
+def unique_match_reference(
+    objects1: ak.Array,
+    objects2: ak.Array,
+    threshold: float,
+    mask1: ak.Array,
+    mask2: ak.Array,
+) -> list[list[int]]:
+    """
+    Reference implementation of the greedy, one-to-one matching by delta R with a python loop over
+    the sorted pairs of each event, resolving ties by the order of objects.
+    """
+    index = []
+    for table, m1, m2 in zip(
+        metric_table_reference(objects1, objects2).tolist(),
+        mask1.tolist(),
+        mask2.tolist(),
+    ):
+        pairs = sorted(
+            (
+                (dr, i, j)
+                for i, row in enumerate(table)
+                for j, dr in enumerate(row)
+                if m1[i] and m2[j] and dr < threshold
+            ),
+            key=lambda pair: pair[0],
+        )
+        event_index = len(m1) * [-1]
+        used = set()
+        for _, i, j in pairs:
+            if event_index[i] < 0 and j not in used:
+                event_index[i] = j
+                used.add(j)
+        index.append(event_index)
+    return index
+
+
+def split_chain_reference(partons: ak.Array, gen_jets: ak.Array, jets: ak.Array, gen_mask: ak.Array):
+    """
+    Reference implementation of the matching of partons to gen jets and further to jets that
+    matches the gen jets selected in the first stage, in the order of partons, to jets. Returns the
+    local indices of jets matched to partons through both stages, ordered by partons.
+    """
+    match1 = unique_delta_r_match(partons, gen_jets, 0.4, mask2=gen_mask)
+    matched_gen_jets = gen_jets[match1.index[match1.index >= 0]]
+    match2 = unique_delta_r_match(matched_gen_jets, jets, 0.4)
+    return match2.index[match2.index >= 0]
+
+
+class DeltaRMaskTest(unittest.TestCase):
+
+    def test_delta_r_masks(self):
+        rng = np.random.default_rng(7)
+        for objects1, objects2 in [
+            (random_objects(rng, 1000, 5), random_objects(rng, 1000, 4)),
+            # distances equal to the threshold
+            (grid_objects(rng, 1000, 5), grid_objects(rng, 1000, 4)),
+        ]:
+            table = metric_table_reference(objects1, objects2)
+            for threshold in [0.25, 0.5, 1.0]:
+                self.assertEqual(
+                    any_within_delta_r(objects1, objects2, threshold).tolist(),
+                    ak.any(table < threshold, axis=2).tolist(),
+                )
+                self.assertEqual(
+                    all_beyond_delta_r(objects1, objects2, threshold).tolist(),
+                    ak.all(table > threshold, axis=2).tolist(),
+                )
+
+        # the grid must contain distances equal to the threshold
+        self.assertTrue(ak.any(table == 0.5))
+
+    def test_delta_r_masks_empty(self):
+        objects = random_objects(np.random.default_rng(7), 4, 3)
+        empty = objects[:, :0]
+        counts = ak.num(objects).tolist()
+        self.assertEqual(any_within_delta_r(objects, empty, 0.5).tolist(), [n * [False] for n in counts])
+        self.assertEqual(all_beyond_delta_r(objects, empty, 0.5).tolist(), [n * [True] for n in counts])
+        self.assertEqual(any_within_delta_r(empty, objects, 0.5).tolist(), [[], [], [], []])
+
+
+class SortingTest(unittest.TestCase):
+
+    def setUp(self):
+        rng = np.random.default_rng(19)
+        # include events without elements and a chunk without any element at all
+        counts = rng.integers(0, 7, 1000)
+        self.keys1 = random_keys(rng, counts, 4)
+        self.keys2 = random_keys(rng, counts, 3)
+        self.mask = ak.unflatten(rng.random(counts.sum()) < 0.6, counts)
+        self.empty = ak.unflatten(np.zeros(0, dtype=np.float32), np.zeros(3, dtype=np.int64))
+
+    def assert_ragged_equal(self, a: ak.Array, b: ak.Array) -> None:
+        self.assertEqual(ak.num(a, axis=1).tolist(), ak.num(b, axis=1).tolist())
+        self.assertEqual(ak.flatten(a).tolist(), ak.flatten(b).tolist())
+
+    def test_flat_argsort(self):
+        offsets = get_offsets(self.keys1)
+        for keys in [[self.keys1], [self.keys1, self.keys2]]:
+            for ascending in [False, True]:
+                ref = argsort_reference(keys, ascending)
+                flat_ref = ak.flatten(ref + offsets[:-1]).tolist()
+                arg = keys[0] if len(keys) == 1 else keys
+                self.assertEqual(flat_argsort(arg, ascending=ascending).tolist(), flat_ref)
+
+        self.assertEqual(len(flat_argsort(self.empty)), 0)
+
+    def test_masked_argsort(self):
+        for keys in [[self.keys1], [self.keys1, self.keys2]]:
+            for ascending in [False, True]:
+                ref = argsort_reference(keys, ascending)
+                ref = ref[self.mask[ref]]
+                arg = keys[0] if len(keys) == 1 else keys
+                self.assert_ragged_equal(masked_argsort(arg, self.mask, ascending=ascending), ref)
+
+                # reuse of a precomputed order
+                flat_order = flat_argsort(arg, ascending=ascending)
+                self.assert_ragged_equal(masked_argsort(arg, self.mask, flat_order=flat_order), ref)
+
+        # without mask
+        self.assert_ragged_equal(masked_argsort(self.keys1), argsort_reference([self.keys1], False))
+        self.assertEqual(masked_argsort(self.empty).tolist(), [[], [], []])
+
+    def test_masked_top_k(self):
+        for keys in [[self.keys1], [self.keys1, self.keys2]]:
+            for ascending in [False, True]:
+                ref = argsort_reference(keys, ascending)
+                ref = ref[self.mask[ref]]
+                arg = keys[0] if len(keys) == 1 else keys
+                # k exceeding the number of elements in most events
+                for k in [1, 2, 4, 10]:
+                    top_k = masked_top_k(arg, k, self.mask, ascending=ascending)
+                    self.assertEqual(top_k.shape, (len(self.keys1), k))
+                    self.assertEqual(top_k.tolist(), pad_reference(ref, k).tolist())
+
+        # without mask
+        top_k = masked_top_k(self.keys1, 3)
+        self.assertEqual(top_k.tolist(), pad_reference(argsort_reference([self.keys1], False), 3).tolist())
+        self.assertEqual(masked_top_k(self.empty, 2).tolist(), 3 * [[-1, -1]])
+
+    def test_take_padded_and_padded_to_ragged(self):
+        ref = argsort_reference([self.keys1, self.keys2], False)
+        ref = ref[self.mask[ref]]
+        for k in [2, 10]:
+            top_k = masked_top_k([self.keys1, self.keys2], k, self.mask)
+            ref_k = ref[:, :k]
+
+            # values with fill values for missing entries
+            values = take_padded(self.keys2, top_k, -1.0)
+            self.assertEqual(values.dtype, np.float32)
+            self.assertEqual(
+                values.tolist(),
+                ak.to_numpy(ak.fill_none(ak.pad_none(self.keys2[ref_k], k, axis=1, clip=True), -1.0)).tolist(),
+            )
+
+            # ragged indices
+            self.assert_ragged_equal(padded_to_ragged(top_k), ref_k)
+
+        self.assertEqual(take_padded(self.empty, np.full((3, 2), -1), 0.0).tolist(), 3 * [[0.0, 0.0]])
+        self.assertEqual(padded_to_ragged(np.full((3, 2), -1)).tolist(), [[], [], []])
+
+
+class RaggedIsinTest(unittest.TestCase):
+
+    def test_ragged_isin(self):
+        rng = np.random.default_rng(20)
+        n_events = 1000
+        # few distinct values, so that duplicates within events are frequent
+        elements = ak.values_astype(random_keys(rng, rng.integers(0, 5, n_events), 5), np.int32)
+        test_elements = ak.values_astype(random_keys(rng, rng.integers(0, 4, n_events), 5), np.int32)
+
+        # without missing values, compare with np.isin per event directly
+        isin = ragged_isin(elements, test_elements)
+        self.assertEqual(
+            isin.tolist(),
+            [np.isin(a, b).tolist() for a, b in zip(elements.tolist(), test_elements.tolist())],
+        )
+        self.assertTrue(ak.any(isin) and not ak.all(isin))
+
+        # with missing values from padding, as used in the gen matching
+        padded_elements = ak.pad_none(elements, 2, axis=1)
+        padded_test_elements = ak.pad_none(test_elements, 2, axis=1)
+        self.assertEqual(
+            ragged_isin(padded_elements, padded_test_elements).tolist(),
+            isin_reference(padded_elements, padded_test_elements).tolist(),
+        )
+
+    def test_ragged_isin_empty(self):
+        elements = ak.Array([[], [1, 2], [3], []])
+        test_elements = ak.Array([[1], [], [3, 3], []])
+        self.assertEqual(ragged_isin(elements, test_elements).tolist(), [[], [False, False], [True], []])
+
+
+class DeltaRMatchingTest(unittest.TestCase):
+
+    def test_match_pairs(self):
+        objects1 = ak.Array([
+            [{"eta": 0.0, "phi": 0.0}, {"eta": 1.0, "phi": 0.0}, {"eta": 2.0, "phi": 0.0}],
+            [],
+            [{"eta": 0.0, "phi": 0.0}],
+        ])
+        objects2 = ak.Array([
+            [{"eta": 2.1, "phi": 0.0}, {"eta": 0.1, "phi": 0.0}],
+            [{"eta": 0.0, "phi": 0.0}],
+            [],
+        ])
+        pairs = match_pairs(unique_delta_r_match(objects1, objects2, 0.4))
+
+        self.assertEqual(pairs.index1.tolist(), [[0, 2], [], []])
+        self.assertEqual(pairs.index2.tolist(), [[1, 0], [], []])
+        self.assertTrue(np.allclose(ak.flatten(pairs.delta_r), [0.1, 0.1]))
+
+    def test_unique_delta_r_match(self):
+        rng = np.random.default_rng(21)
+        n_events = 1000
+        for objects1, objects2 in [
+            (random_objects(rng, n_events, 4), random_objects(rng, n_events, 5)),
+            # identical distances
+            (grid_objects(rng, n_events, 4), grid_objects(rng, n_events, 5)),
+        ]:
+            mask1 = ak.unflatten(rng.random(ak.sum(ak.num(objects1))) < 0.8, ak.num(objects1))
+            mask2 = ak.unflatten(rng.random(ak.sum(ak.num(objects2))) < 0.8, ak.num(objects2))
+            for masks in [(None, None), (mask1, mask2)]:
+                match = unique_delta_r_match(objects1, objects2, 0.5, mask1=masks[0], mask2=masks[1])
+                ref = unique_match_reference(
+                    objects1,
+                    objects2,
+                    0.5,
+                    ak.ones_like(objects1.eta, dtype=bool) if masks[0] is None else masks[0],
+                    ak.ones_like(objects2.eta, dtype=bool) if masks[1] is None else masks[1],
+                )
+                self.assertEqual(match.index.tolist(), ref)
+
+                # distances of matched objects
+                matched = match.index >= 0
+                table = metric_table_reference(objects1, objects2)
+                ref_delta_r = [
+                    rows[i][j]
+                    for rows, index in zip(table.tolist(), match.index.tolist())
+                    for i, j in enumerate(index)
+                    if j >= 0
+                ]
+                self.assertTrue(np.allclose(ak.flatten(match.delta_r[matched]), ref_delta_r))
+                self.assertTrue(ak.all(match.delta_r[~matched] == EMPTY_FLOAT))
+
+        # the last chunk must contain ties and contended objects
+        self.assertTrue(ak.any(ak.sum(table == 0.25, axis=2) > 1))
+
+    def test_unique_delta_r_match_nearest(self):
+        # when nearest objects are not contended, the matching is identical to the previous
+        # matching to the nearest object within the threshold
+        rng = np.random.default_rng(21)
+        objects1 = random_objects(rng, 2000, 3)
+        objects2 = random_objects(rng, 2000, 5)
+        table = metric_table_reference(objects1, objects2)
+        nearest = ak.argmin(table, axis=2, keepdims=True)
+        nearest = ak.fill_none(ak.firsts(nearest.mask[ak.firsts(table[nearest], axis=2) <= 0.4], axis=2), -1)
+
+        match = unique_delta_r_match(objects1, objects2, 0.4)
+        valid = nearest[nearest >= 0]
+        uncontended = ak.num(valid) == ak.num(ak.run_lengths(ak.sort(valid, axis=1)))
+        self.assertTrue(ak.mean(uncontended) > 0.5)
+        self.assertEqual(match.index[uncontended].tolist(), nearest[uncontended].tolist())
+
+    def test_unique_delta_r_match_empty(self):
+        objects = random_objects(np.random.default_rng(21), 4, 3)
+        match = unique_delta_r_match(objects, objects[:, :0], 0.4)
+        self.assertEqual(match.index.tolist(), [n * [-1] for n in ak.num(objects).tolist()])
+        match = unique_delta_r_match(objects[:, :0], objects, 0.4)
+        self.assertEqual(match.index.tolist(), [[], [], [], []])
+
+    def test_chain_restricts_intermediate_objects(self):
+        # the first gen jet is close to the jet, but not matched to the parton
+        partons = ak.Array([[{"eta": 0.0, "phi": 0.0}]])
+        gen_jets = ak.Array([[{"eta": 1.0, "phi": 0.0}, {"eta": 0.1, "phi": 0.0}]])
+        jets = ak.Array([[{"eta": 1.0, "phi": 0.05}]])
+
+        chain = chain_delta_r_matches([partons, gen_jets, jets], 0.4)
+        self.assertEqual(chain.stages[0].index.tolist(), [[1]])
+        self.assertEqual(chain.stages[1].index.tolist(), [[-1, -1]])
+        self.assertEqual(chain.index.tolist(), [[-1]])
+
+        # per-stage thresholds
+        chain = chain_delta_r_matches([partons, gen_jets, jets], [0.4, 1.0])
+        self.assertEqual(chain.stages[1].index.tolist(), [[-1, 0]])
+        self.assertEqual(chain.index.tolist(), [[0]])
+
+    def test_chain_matches_split_matching(self):
+        rng = np.random.default_rng(21)
+        n_events = 2000
+        partons = random_objects(rng, n_events, 3)
+        gen_jets = random_objects(rng, n_events, 5)
+        jets = random_objects(rng, n_events, 6)
+        gen_mask = ak.unflatten(rng.random(ak.sum(ak.num(gen_jets))) < 0.7, ak.num(gen_jets))
+
+        chain = chain_delta_r_matches([partons, gen_jets, jets], 0.4, masks=[None, gen_mask, None])
+        ref = split_chain_reference(partons, gen_jets, jets, gen_mask)
+
+        self.assertEqual(len(chain.stages), 2)
+        self.assertEqual(ak.num(chain.index).tolist(), ak.num(partons).tolist())
+        self.assertEqual(chain.index[chain.index >= 0].tolist(), ref.tolist())
+
+        # the chunk must contain events with matches through both stages and without any match
+        n_matched = ak.sum(chain.index >= 0, axis=1)
+        self.assertTrue(ak.any(n_matched >= 2))
+        self.assertTrue(ak.any((n_matched == 0) & (ak.num(partons) > 0)))
+
+        # each stage only uses objects passing the masks and matched in the previous stage
+        stage1, stage2 = chain.stages
+        self.assertTrue(ak.all(gen_mask[stage1.index[stage1.index >= 0]]))
+        matched_gen = ak.any(
+            ak.local_index(gen_jets.eta)[:, :, None] == stage1.index[:, None, :],
+            axis=2,
+        )
+        self.assertTrue(ak.all(matched_gen | (stage2.index < 0)))
@@ -0,0 +1,100 @@
+# coding: utf-8
+
+"""
+Tests for the resolution of distinct parents of generator particles.
+"""
+
+__all__ = ["DistinctParentTest"]
+
+import unittest
+
+from columnflow.util import maybe_import
+
+from hbt.production.gen_HH_decay import get_distinct_parents
+
+
+np = maybe_import("numpy")
+ak = maybe_import("awkward")
+
+
+def random_gen_particles(rng: np.random.Generator, n_events: int, max_count: int) -> ak.Array:
+    """
+    Returns random generator particles with few distinct pdg ids, so that chains of mothers with
+    the same pdg id are frequent. Mothers mostly precede their daughters, but not always.
+    """
+    counts = rng.integers(0, max_count + 1, n_events)
+    local_index = np.asarray(ak.flatten(ak.local_index(ak.unflatten(np.zeros(counts.sum()), counts))))
+    n = np.repeat(counts, counts)
+    # preceding mothers, -1 for first particles
+    mother = (rng.random(counts.sum()) * local_index).astype(np.int64) - (local_index == 0)
+    # some particles without mother, and some with any mother but themselves
+    mother = np.where(rng.random(counts.sum()) < 0.1, -1, mother)
+    any_mother = (local_index + 1 + rng.integers(0, 2 ** 16, counts.sum()) % np.maximum(n - 1, 1)) % n
+    mother = np.where((rng.random(counts.sum()) < 0.05) & (n > 1), any_mother, mother)
+    return ak.unflatten(
+        ak.zip({
+            "pdgId": rng.choice([-5, 5, 25, 21], counts.sum()).astype(np.int32),
+            "genPartIdxMother": mother.astype(np.int16),
+        }),
+        counts,
+    )
+
+
+def distinct_parents_reference(gen_part: ak.Array) -> list[int]:
+    """
+    Reference implementation that walks the chain of mothers of each particle in a python loop
+    until a particle with a different pdg id is found, returning flat indices or -1 when there is
+    none or when the chain is cyclic.
+    """
+    out = []
+    offset = 0
+    for particles in gen_part.tolist():
+        for i, p in enumerate(particles):
+            parent, visited, m = -1, {i}, p["genPartIdxMother"]
+            while m >= 0 and m not in visited:
+                if particles[m]["pdgId"] != p["pdgId"]:
+                    parent = offset + m
+                    break
+                visited.add(m)
+                m = particles[m]["genPartIdxMother"]
+            out.append(parent)
+        offset += len(particles)
+    return out
+
+
+class DistinctParentTest(unittest.TestCase):
+
+    def test_distinct_parents(self):
+        gen_part = random_gen_particles(np.random.default_rng(22), 2000, 12)
+        parents = get_distinct_parents(gen_part)
+        self.assertEqual(parents.tolist(), distinct_parents_reference(gen_part))
+
+        # the chunk must contain particles whose mother has the same pdg id
+        counts = np.asarray(ak.num(gen_part.pdgId))
+        pdg_id = np.asarray(ak.flatten(gen_part.pdgId))
+        mother = np.asarray(ak.flatten(gen_part.genPartIdxMother)).astype(np.int64)
+        mother = np.where(mother >= 0, np.repeat(np.cumsum(counts) - counts, counts) + mother, -1)
+        has_mother = mother >= 0
+        self.assertTrue(np.any(pdg_id[has_mother] == pdg_id[mother[has_mother]]))
+
+    def test_distinct_parents_chains(self):
+        gen_part = ak.zip({
+            "pdgId": ak.Array([
+                [25, 5, 5, 5, 21],
+                [],
+                # cyclic chain with the same pdg id, and daughters preceding mothers
+                [5, 5, 5, 25],
+            ]),
+            "genPartIdxMother": ak.Array([
+                [-1, 0, 1, 2, 3],
+                [],
+                [1, 0, 3, -1],
+            ]),
+        })
+        parents = get_distinct_parents(gen_part)
+        self.assertEqual(parents.tolist(), [-1, 0, 0, 0, 3, -1, -1, 8, -1])
+        self.assertEqual(parents.tolist(), distinct_parents_reference(gen_part))
+
+    def test_distinct_parents_empty(self):
+        gen_part = random_gen_particles(np.random.default_rng(22), 3, 0)
+        self.assertEqual(len(get_distinct_parents(gen_part)), 0)
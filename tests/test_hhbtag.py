@@ -0,0 +1,203 @@
+# coding: utf-8
+
+"""
+Tests for the compiled kernels building the hhbtag inputs and distributing its scores.
+"""
+
+__all__ = ["HHBtagKernelTest"]
+
+import unittest
+
+from columnflow.util import maybe_import
+from columnflow.columnar_util import EMPTY_FLOAT, flat_np_view, layout_ak_array
+
+from hbt.columnar_util import get_offsets
+from hbt.production.hhbtag import sum_pt_eta_phi_m, _fill_hhbtag_features, _scatter_hhbtag_scores
+
+
+np = maybe_import("numpy")
+ak = maybe_import("awkward")
+
+
+N_JETS_MAX = 10
+N_FEATURES = 15
+YEAR = 2017
+
+
+def make_chunk(rng: np.random.Generator, n_events: int) -> tuple[ak.Array, ak.Array, np.ndarray]:
+    """
+    Returns random events with jets, two leptons and MET, a mask of selected jets and the indices of
+    events for which the hhbtag is evaluated, including events with more than :py:attr:`N_JETS_MAX`
+    and without any selected jet.
+    """
+    n_jets = rng.integers(0, 15, n_events)
+    n = n_jets.sum()
+    events = ak.zip(
+        {
+            "Jet": ak.unflatten(
+                ak.zip({
+                    "pt": rng.uniform(20.0, 300.0, n).astype(np.float32),
+                    "eta": rng.uniform(-2.4, 2.4, n).astype(np.float32),
+                    "phi": rng.uniform(-np.pi, np.pi, n).astype(np.float32),
+                    "mass": rng.uniform(0.0, 30.0, n).astype(np.float32),
+                    "btagDeepFlavB": rng.random(n).astype(np.float32),
+                }),
+                n_jets,
+            ),
+            "Lepton": ak.zip({
+                "pt": rng.uniform(20.0, 200.0, (n_events, 2)).astype(np.float32),
+                "eta": rng.uniform(-2.4, 2.4, (n_events, 2)).astype(np.float32),
+                "phi": rng.uniform(-np.pi, np.pi, (n_events, 2)).astype(np.float32),
+                "mass": rng.uniform(0.0, 2.0, (n_events, 2)).astype(np.float32),
+            }),
+            "MET": ak.zip({
+                "pt": rng.uniform(0.0, 200.0, n_events).astype(np.float32),
+                "phi": rng.uniform(-np.pi, np.pi, n_events).astype(np.float32),
+            }),
+            "channel_id": rng.integers(1, 4, n_events).astype(np.uint8),
+        },
+        depth_limit=1,
+    )
+    jet_mask = ak.unflatten(rng.random(n) < 0.8, n_jets)
+    event_indices = np.flatnonzero(rng.random(n_events) < 0.7)
+    return events, jet_mask, event_indices
+
+
+def features_reference(events: ak.Array, jet_mask: ak.Array, event_indices: np.ndarray) -> np.ndarray:
+    """
+    Reference implementation of the previous construction of the input features with awkward, by
+    concatenating per-jet features and padding them with zeros to :py:attr:`N_JETS_MAX` jets.
+    """
+    def delta_phi(a, b):
+        return (a - b + np.pi) % (2 * np.pi) - np.pi
+
+    jets = events.Jet[jet_mask][event_indices][..., :N_JETS_MAX]
+    leps = events.Lepton[event_indices]
+    met = events.MET[event_indices]
+    channel_id = events.channel_id[event_indices]
+
+    # di-tau system
+    px = ak.sum(leps.pt * np.cos(leps.phi), axis=1)
+    py = ak.sum(leps.pt * np.sin(leps.phi), axis=1)
+    pz = ak.sum(leps.pt * np.sinh(leps.eta), axis=1)
+    htt_pt = np.hypot(px, py)
+    htt_eta = np.arcsinh(pz / htt_pt)
+    htt_phi = np.arctan2(py, px)
+
+    jet_shape = abs(jets.pt) >= 0
+    jet_energy = np.sqrt((jets.pt * np.cosh(jets.eta))**2 + jets.mass**2)
+    input_features = [
+        jet_shape * 1,
+        jets.pt,
+        jets.eta,
+        jets.mass / jets.pt,
+        jet_energy / jets.pt,
+        abs(jets.eta - htt_eta),
+        jets.btagDeepFlavB,
+        delta_phi(jets.phi, htt_phi),
+        jet_shape * YEAR,
+        jet_shape * (channel_id - 1),
+        jet_shape * htt_pt,
+        jet_shape * htt_eta,
+        jet_shape * delta_phi(htt_phi, met.phi),
+        jet_shape * (met.pt / htt_pt),
+        jet_shape * ak.sum(leps.pt, axis=1),
+    ]
+
+    features = ak.concatenate([ak.values_astype(f[..., None], np.float32) for f in input_features], axis=2)
+    features = ak.fill_none(
+        ak.pad_none(features, N_JETS_MAX, axis=1),
+        np.zeros(len(input_features), dtype=np.float32),
+        axis=1,
+    )
+    return ak.to_numpy(features[..., list(range(len(input_features)))]).reshape(
+        len(event_indices),
+        N_JETS_MAX,
+        N_FEATURES,
+    )
+
+
+def scores_reference(
+    events: ak.Array,
+    jet_mask: ak.Array,
+    event_indices: np.ndarray,
+    scores: np.ndarray,
+) -> ak.Array:
+    """
+    Reference implementation of the previous insertion of *scores* with awkward, removing scores of
+    padded jets, adding zero scores for selected jets beyond :py:attr:`N_JETS_MAX` and using
+    ``EMPTY_FLOAT`` for all other jets.
+    """
+    event_mask = np.zeros(len(events), dtype=bool)
+    event_mask[event_indices] = True
+    selected_pt = events.Jet.pt[jet_mask][event_mask]
+
+    n_jets_capped = ak.num(selected_pt[..., :N_JETS_MAX], axis=1)
+    where = ak.from_regular(ak.local_index(scores) < n_jets_capped[..., None], axis=1)
+    scores = ak.from_regular(scores, axis=1)[where]
+    layout_ext = selected_pt[..., N_JETS_MAX:]
+    scores_ext = layout_ak_array(np.zeros(len(ak.flatten(layout_ext)), dtype=np.float32), layout_ext)
+    scores = ak.concatenate([scores, scores_ext], axis=1)
+
+    all_scores = np.full(len(ak.flatten(events.Jet.pt)), EMPTY_FLOAT, dtype=np.float32)
+    all_scores[ak.to_numpy(ak.flatten(jet_mask & event_mask, axis=1))] = ak.to_numpy(ak.flatten(scores))
+    return layout_ak_array(all_scores, events.Jet.pt)
+
+
+class HHBtagKernelTest(unittest.TestCase):
+
+    def setUp(self):
+        self.events, self.jet_mask, self.event_indices = make_chunk(np.random.default_rng(12), 1000)
+
+    def fill_features(self, event_indices: np.ndarray) -> np.ndarray:
+        events = self.events
+        htt_pt, htt_eta, htt_phi = sum_pt_eta_phi_m(
+            *(np.asarray(events.Lepton[field][:, 0]) for field in ["pt", "eta", "phi", "mass"]),
+            *(np.asarray(events.Lepton[field][:, 1]) for field in ["pt", "eta", "phi", "mass"]),
+        )
+        features = np.zeros((len(event_indices), N_JETS_MAX, N_FEATURES), dtype=np.float32)
+        _fill_hhbtag_features(
+            features,
+            event_indices,
+            get_offsets(events.Jet.pt),
+            flat_np_view(self.jet_mask, axis=1),
+            *(flat_np_view(events.Jet[field], axis=1) for field in ["pt", "eta", "phi", "mass", "btagDeepFlavB"]),
+            htt_pt,
+            htt_eta,
+            htt_phi,
+            np.asarray(events.Lepton.pt[:, 0] + events.Lepton.pt[:, 1]),
+            np.asarray(events.MET.pt),
+            np.asarray(events.MET.phi),
+            np.asarray(events.channel_id),
+            YEAR,
+        )
+        return features
+
+    def test_fill_features(self):
+        features = self.fill_features(self.event_indices)
+        ref = features_reference(self.events, self.jet_mask, self.event_indices)
+        self.assertEqual(features.shape, ref.shape)
+        self.assertTrue(np.allclose(features, ref, rtol=1e-5, atol=1e-5))
+
+        # the chunk must contain events with more than N_JETS_MAX and without any selected jets
+        n_selected = ak.to_numpy(ak.sum(self.jet_mask, axis=1))[self.event_indices]
+        self.assertTrue(np.any(n_selected > N_JETS_MAX) and np.any(n_selected == 0))
+        self.assertTrue(np.all(features[n_selected == 0] == 0))
+
+    def test_scatter_scores(self):
+        scores = np.random.default_rng(12).random((len(self.event_indices), N_JETS_MAX)).astype(np.float32)
+        all_scores = ak.full_like(self.events.Jet.pt, EMPTY_FLOAT, dtype=np.float32)
+        flat_scores = flat_np_view(all_scores, axis=1)
+        _scatter_hhbtag_scores(
+            flat_scores,
+            self.event_indices,
+            scores,
+            get_offsets(self.events.Jet.pt),
+            flat_np_view(self.jet_mask, axis=1),
+        )
+        ref = scores_reference(self.events, self.jet_mask, self.event_indices, scores)
+        self.assertEqual(layout_ak_array(flat_scores, self.events.Jet.pt).tolist(), ref.tolist())
+
+    def test_empty(self):
+        event_indices = np.zeros(0, dtype=np.int64)
+        self.assertEqual(self.fill_features(event_indices).shape, (0, N_JETS_MAX, N_FEATURES))
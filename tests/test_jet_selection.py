@@ -0,0 +1,269 @@
+# coding: utf-8
+
+"""
+Tests for the compiled kernels of the jet selection.
+"""
+
+__all__ = ["VBFPairTest", "FatjetSubjetMatchingTest"]
+
+import unittest
+
+from columnflow.util import maybe_import
+
+from hbt.selection.jet import find_vbf_pairs, match_fatjet_subjets
+
+
+np = maybe_import("numpy")
+ak = maybe_import("awkward")
+
+
+# vbf pair requirements as used in the jet selection
+VBF_KWARGS = {
+    "min_mjj": 500.0,
+    "min_delta_eta": 3.0,
+    "cross_min_mjj": 800.0,
+    "cross_min_pt1": 140.0,
+    "cross_min_pt2": 60.0,
+}
+
+
+def random_jets(rng: np.random.Generator, n_events: int, max_count: int) -> ak.Array:
+    """
+    Returns random jets with *pt*, *eta*, *phi* and *mass* chosen from coarse grids, so that jets
+    with identical kinematics and pairs with identical masses are frequent.
+    """
+    counts = rng.integers(0, max_count + 1, n_events)
+    n = counts.sum()
+    return ak.unflatten(
+        ak.zip({
+            "pt": rng.choice([40.0, 80.0, 160.0, 320.0], n),
+            "eta": 0.5 * rng.integers(-9, 10, n),
+            "phi": rng.choice([0.0, 1.0, 2.0], n),
+            "mass": rng.choice([5.0, 10.0], n),
+        }),
+        counts,
+    )
+
+
+def vbf_pairs_reference(
+    jets: ak.Array,
+    mask: ak.Array,
+    cross_mask: np.ndarray,
+    min_mjj: float,
+    min_delta_eta: float,
+    cross_min_mjj: float,
+    cross_min_pt1: float,
+    cross_min_pt2: float,
+) -> ak.Array:
+    """
+    Reference implementation of the previous vbf pair selection that builds all combinations of
+    jets passing *mask* with awkward and picks the valid one with the highest mass, ordered by pt.
+    """
+    def p4(jet):
+        pz = jet.pt * np.sinh(jet.eta)
+        return (
+            np.sqrt(jet.pt**2 + pz**2 + jet.mass**2),
+            jet.pt * np.cos(jet.phi),
+            jet.pt * np.sin(jet.phi),
+            pz,
+        )
+
+    li = ak.local_index(jets.pt)
+    vbf1, vbf2 = ak.unzip(ak.combinations(jets[mask], 2, axis=1))
+    (e1, px1, py1, pz1), (e2, px2, py2, pz2) = p4(vbf1), p4(vbf2)
+    mjj = np.sqrt((e1 + e2)**2 - (px1 + px2)**2 - (py1 + py2)**2 - (pz1 + pz2)**2)
+    vbf_pair_mask = (
+        (mjj > min_mjj) &
+        (abs(vbf1.eta - vbf2.eta) > min_delta_eta)
+    )
+    vbf_pair_mask = vbf_pair_mask & (
+        (~cross_mask) | (
+            (mjj > cross_min_mjj) &
+            (np.maximum(vbf1.pt, vbf2.pt) > cross_min_pt1) &
+            (np.minimum(vbf1.pt, vbf2.pt) > cross_min_pt2)
+        )
+    )
+
+    # index of the pair with the highest mass
+    vbf_mass_indices = ak.argsort(mjj, axis=1, ascending=False, stable=True)
+    vbf_pair_index = vbf_mass_indices[vbf_pair_mask[vbf_mass_indices]][..., :1]
+
+    # indices of the two jets in the full collection, sorted by pt
+    vbf_indices_local = ak.concatenate(
+        [
+            ak.singletons(idx) for idx in
+            ak.unzip(ak.firsts(ak.argcombinations(jets[mask], 2, axis=1)[vbf_pair_index]))
+        ],
+        axis=1,
+    )
+    vbfjet_indices = li[mask][vbf_indices_local]
+    return vbfjet_indices[ak.argsort(jets[vbfjet_indices].pt, axis=1, ascending=False, stable=True)]
+
+
+def random_boosted_events(rng: np.random.Generator, n_events: int) -> tuple[ak.Array, ak.Array, ak.Array]:
+    """
+    Returns random events with jets, fatjets and subjets on a coarse eta-phi grid, so that subjets
+    are frequently close to one or both hh bjets, along with a fatjet mask and hh bjet indices.
+    """
+    def grid_collection(counts, **fields):
+        n = counts.sum()
+        return ak.unflatten(
+            ak.zip({
+                "pt": rng.uniform(20.0, 200.0, n),
+                "eta": 0.2 * rng.integers(-3, 4, n),
+                "phi": 0.2 * rng.integers(-3, 4, n),
+                **{name: func(n) for name, func in fields.items()},
+            }),
+            counts,
+        )
+
+    n_jets = rng.integers(0, 5, n_events)
+    n_subjets = rng.integers(0, 5, n_events)
+    n_fatjets = rng.integers(0, 4, n_events)
+    events = ak.zip(
+        {
+            "Jet": grid_collection(n_jets),
+            "SubJet": grid_collection(n_subjets, btagDeepB=lambda n: rng.random(n)),
+            # subjet indices referring to existing subjets or -1
+            "FatJet": grid_collection(
+                n_fatjets,
+                subJetIdx1=lambda n: -1 + rng.integers(0, 2 ** 16, n) % (np.repeat(n_subjets, n_fatjets) + 1),
+                subJetIdx2=lambda n: -1 + rng.integers(0, 2 ** 16, n) % (np.repeat(n_subjets, n_fatjets) + 1),
+            ),
+        },
+        depth_limit=1,
+    )
+    fatjet_mask = (
+        (rng.random(n_fatjets.sum()) < 0.8) &
+        (ak.flatten(events.FatJet.subJetIdx1) >= 0) &
+        (ak.flatten(events.FatJet.subJetIdx2) >= 0)
+    )
+    fatjet_mask = ak.unflatten(fatjet_mask, n_fatjets)
+
+    # zero to two hh bjets in random order
+    jet_order = ak.argsort(ak.unflatten(rng.random(n_jets.sum()), n_jets), axis=1)
+    hhbjet_indices = ak.where(rng.random(n_events) < 0.8, jet_order[:, :2], jet_order[:, :1])
+
+    return events, fatjet_mask, hhbjet_indices
+
+
+def subjet_matching_reference(
+    events: ak.Array,
+    fatjet_mask: ak.Array,
+    hhbjet_indices: ak.Array,
+    btag_wp: float,
+    threshold: float = 0.4,
+) -> tuple[ak.Array, ak.Array, ak.Array]:
+    """
+    Reference implementation of the previous subjet matching based on the full table of distances
+    between the valid subjets of all fatjets and the hh bjets. Returns the final fatjet mask, the
+    subjet indices of matched fatjets and the b-tag decision of the first matched fatjet.
+    """
+    fatjets = events.FatJet
+
+    # valid subjets per fatjet
+    subjet_idx = ak.concatenate([fatjets.subJetIdx1[..., None], fatjets.subJetIdx2[..., None]], axis=2)
+    valid_subjet_idx = subjet_idx[subjet_idx >= 0]
+    subjets = ak.flatten(events.SubJet[ak.flatten(valid_subjet_idx, axis=2)], axis=1)
+    subjets = ak.unflatten(subjets, ak.flatten(ak.num(valid_subjet_idx, axis=2)))
+    subjets = ak.unflatten(subjets, ak.num(valid_subjet_idx, axis=1))
+
+    # table with shape (events, fatjets, subjets, hh bjets)
+    bjets = events.Jet[hhbjet_indices]
+    deta = subjets.eta[:, :, :, None] - bjets.eta[:, None, None, :]
+    dphi = (subjets.phi[:, :, :, None] - bjets.phi[:, None, None, :] + np.pi) % (2 * np.pi) - np.pi
+    metrics = np.sqrt(deta**2 + dphi**2)
+
+    subjets_match = (
+        ak.all(ak.sum(metrics < threshold, axis=3) == 1, axis=2) &
+        (ak.num(hhbjet_indices, axis=1) >= 2)
+    )
+    fatjet_mask = fatjet_mask & subjets_match
+    subjet_indices = subjet_idx[fatjet_mask]
+
+    subjets_btagged = ak.all(events.SubJet[ak.firsts(subjet_indices)].btagDeepB > btag_wp, axis=1)
+    subjets_btagged = ak.fill_none(subjets_btagged, True)
+
+    return fatjet_mask, subjet_indices, subjets_btagged
+
+
+class VBFPairTest(unittest.TestCase):
+
+    def test_find_vbf_pairs(self):
+        rng = np.random.default_rng(15)
+        n_events = 2000
+        jets = random_jets(rng, n_events, 8)
+        mask = ak.unflatten(rng.random(ak.sum(ak.num(jets))) < 0.8, ak.num(jets))
+
+        for cross_mask in [np.zeros(n_events, dtype=bool), rng.random(n_events) < 0.5]:
+            pairs = find_vbf_pairs(jets, mask, cross_mask, **VBF_KWARGS)
+            ref = vbf_pairs_reference(jets, mask, cross_mask, **VBF_KWARGS)
+            self.assertEqual(pairs.tolist(), ref.tolist())
+
+        # the chunk must contain events with and without a pair
+        n_pairs = ak.num(pairs, axis=1)
+        self.assertTrue(ak.any(n_pairs == 2) and ak.any(n_pairs == 0))
+
+    def test_find_vbf_pairs_ties(self):
+        # two identical jets forming pairs with the same mass, and a subleading jet with equal pt
+        jets = ak.zip({
+            "pt": ak.Array([[80.0, 80.0, 80.0], [80.0, 80.0]]),
+            "eta": ak.Array([[-2.5, 2.0, 2.0], [-2.5, 2.0]]),
+            "phi": ak.Array([[0.0, 1.0, 1.0], [0.0, 0.0]]),
+            "mass": ak.Array([[5.0, 5.0, 5.0], [5.0, 5.0]]),
+        })
+        mask = ak.ones_like(jets.pt, dtype=bool)
+        cross_mask = np.zeros(2, dtype=bool)
+
+        pairs = find_vbf_pairs(jets, mask, cross_mask, **VBF_KWARGS)
+        self.assertEqual(pairs.tolist(), [[0, 1], [0, 1]])
+        self.assertEqual(pairs.tolist(), vbf_pairs_reference(jets, mask, cross_mask, **VBF_KWARGS).tolist())
+
+    def test_find_vbf_pairs_empty(self):
+        jets = random_jets(np.random.default_rng(15), 3, 0)
+        pairs = find_vbf_pairs(jets, ak.ones_like(jets.pt, dtype=bool), np.ones(3, dtype=bool), **VBF_KWARGS)
+        self.assertEqual(pairs.tolist(), [[], [], []])
+
+
+class FatjetSubjetMatchingTest(unittest.TestCase):
+
+    def test_match_fatjet_subjets(self):
+        rng = np.random.default_rng(16)
+        events, fatjet_mask, hhbjet_indices = random_boosted_events(rng, 2000)
+
+        for threshold in [0.3, 0.4]:
+            boosted = match_fatjet_subjets(events, fatjet_mask, hhbjet_indices, 0.5, threshold=threshold)
+            ref_mask, ref_subjet_indices, ref_btagged = subjet_matching_reference(
+                events,
+                fatjet_mask,
+                hhbjet_indices,
+                0.5,
+                threshold=threshold,
+            )
+            self.assertEqual(boosted.fatjet_mask.tolist(), ref_mask.tolist())
+            self.assertEqual(
+                boosted.fatjet_indices.tolist(),
+                ak.local_index(events.FatJet.pt)[ref_mask].tolist(),
+            )
+            self.assertEqual(boosted.subjet_indices.tolist(), ref_subjet_indices.tolist())
+            self.assertEqual(boosted.subjets_btagged.tolist(), ref_btagged.tolist())
+
+        # the chunk must contain matched fatjets in events with passing and failing b-tags, and
+        # subjets close to both hh bjets
+        n_matched = ak.sum(boosted.fatjet_mask, axis=1)
+        self.assertTrue(ak.any(n_matched >= 2))
+        self.assertTrue(ak.any((n_matched >= 1) & boosted.subjets_btagged))
+        self.assertTrue(ak.any((n_matched >= 1) & ~boosted.subjets_btagged))
+        self.assertTrue(ak.any(ak.sum(fatjet_mask & ~boosted.fatjet_mask, axis=1) > 0))
+
+    def test_match_fatjet_subjets_empty(self):
+        events, fatjet_mask, hhbjet_indices = random_boosted_events(np.random.default_rng(16), 20)
+        empty = events[:0]
+        boosted = match_fatjet_subjets(empty, fatjet_mask[:0], hhbjet_indices[:0], 0.5)
+        self.assertEqual(len(boosted.fatjet_mask), 0)
+        self.assertEqual(len(boosted.subjets_btagged), 0)
+
+        # no hh bjets
+        boosted = match_fatjet_subjets(events, fatjet_mask, hhbjet_indices[:, :0], 0.5)
+        self.assertFalse(ak.any(boosted.fatjet_mask))
+        self.assertTrue(np.all(boosted.subjets_btagged))
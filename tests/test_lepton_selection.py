@@ -0,0 +1,634 @@
+# coding: utf-8
+
+"""
+Tests for the lepton selection and the resolution of lepton pairs across triggers.
+"""
+
+__all__ = ["LeptonSelectionTest"]
+
+import unittest
+
+import order as od
+
+from columnflow.selection import SelectionResult
+from columnflow.util import DotDict, maybe_import
+
+from hbt.config.util import Trigger
+from hbt.config.triggers import add_triggers_2017
+from hbt.selection.lepton import lepton_selection, resolve_lepton_pairs
+from hbt.selection.trigger import TriggerLegCache, trigger_word
+
+from .test_columnar_util import metric_table_reference
+
+
+np = maybe_import("numpy")
+ak = maybe_import("awkward")
+
+
+# channel ids and tags of triggers in config order, with overlapping channels
+CH_ETAU, CH_MUTAU, CH_TAUTAU = 1, 2, 3
+TRIGGERS = [
+    (CH_ETAU, "single_trigger"),
+    (CH_MUTAU, "single_trigger"),
+    (CH_ETAU, "cross_trigger"),
+    (CH_MUTAU, "cross_trigger"),
+    (CH_TAUTAU, "cross_trigger"),
+    (CH_TAUTAU, "cross_trigger"),
+]
+
+
+def random_indices(rng: np.random.Generator, counts: np.ndarray, p: float) -> ak.Array:
+    """
+    Returns a random subset of local indices per event of a collection with *counts* objects, each
+    selected with probability *p*, in random order.
+    """
+    indices = ak.local_index(ak.unflatten(np.zeros(counts.sum()), counts))
+    indices = indices[ak.unflatten(rng.random(counts.sum()) < p, counts)]
+    order = ak.argsort(ak.unflatten(rng.random(ak.sum(ak.num(indices))), ak.num(indices)), axis=1)
+    return ak.values_astype(indices[order], np.int32)
+
+
+def make_chunk(n_events: int, seed: int) -> tuple[ak.Array, list[DotDict]]:
+    """
+    Creates a synthetic chunk of events with electrons, muons and taus, and the per-trigger results
+    of the electron, muon and tau selections that are passed to the lepton pairing.
+    """
+    rng = np.random.default_rng(seed)
+
+    events = ak.Array({
+        coll: ak.unflatten(
+            ak.zip({"charge": rng.choice([-1, 1], counts.sum()).astype(np.int32)}),
+            counts,
+        )
+        for coll, counts in [
+            ("Electron", rng.integers(0, 3, n_events)),
+            ("Muon", rng.integers(0, 3, n_events)),
+            ("Tau", rng.integers(0, 5, n_events)),
+        ]
+    })
+
+    trigger_results = []
+    for channel_id, tag in TRIGGERS:
+        tau_indices = random_indices(rng, np.asarray(ak.num(events.Tau, axis=1)), 0.8)
+        electron_indices = random_indices(rng, np.asarray(ak.num(events.Electron, axis=1)), 0.5)
+        muon_indices = random_indices(rng, np.asarray(ak.num(events.Muon, axis=1)), 0.5)
+        trigger_results.append(DotDict(
+            channel_id=channel_id,
+            tag=tag,
+            fired=rng.random(n_events) < 0.8,
+            electron_indices=electron_indices,
+            electron_veto_indices=electron_indices,
+            muon_indices=muon_indices,
+            muon_veto_indices=muon_indices,
+            tau_indices=tau_indices,
+            tau_iso_mask=ak.unflatten(
+                rng.random(ak.sum(ak.num(tau_indices))) < 0.6,
+                ak.num(tau_indices),
+            ),
+        ))
+
+    return events, trigger_results
+
+
+def pair_decisions(events: ak.Array, res: DotDict) -> tuple[ak.Array, ak.Array, ak.Array]:
+    """
+    Returns the acceptance, isolation and charge decisions of the lepton pair of a single trigger
+    following the lepton counting of the lepton selection.
+    """
+    n_taus = ak.num(res.tau_indices, axis=1)
+    n_iso = ak.sum(res.tau_iso_mask, axis=1)
+    tau_charge = events.Tau[res.tau_indices].charge
+    if res.channel_id == CH_TAUTAU:
+        accepted = (
+            res.fired &
+            (ak.num(res.electron_veto_indices, axis=1) == 0) &
+            (ak.num(res.muon_veto_indices, axis=1) == 0) &
+            (n_taus >= 2) &
+            (n_iso >= 1)
+        )
+        is_os = ak.firsts(tau_charge, axis=1) == -ak.firsts(tau_charge[..., 1:], axis=1)
+        return accepted, n_iso >= 2, is_os
+
+    light, veto, other_veto = (
+        (events.Electron[res.electron_indices], res.electron_veto_indices, res.muon_veto_indices)
+        if res.channel_id == CH_ETAU else
+        (events.Muon[res.muon_indices], res.muon_veto_indices, res.electron_veto_indices)
+    )
+    accepted = (
+        res.fired &
+        (ak.num(light, axis=1) == 1) &
+        (ak.num(veto, axis=1) == 1) &
+        (ak.num(other_veto, axis=1) == 0) &
+        (n_taus >= 1)
+    )
+    is_os = ak.firsts(light.charge, axis=1) == -ak.firsts(tau_charge, axis=1)
+    return accepted, n_iso >= 1, is_os
+
+
+def first_match_lepton_pairs(events: ak.Array, trigger_results: list[DotDict]) -> DotDict:
+    """
+    Reference implementation that updates the results of each event with the first accepting
+    trigger in a loop over triggers via ``ak.where``.
+    """
+    false_mask = (ak.num(events.Tau, axis=1) < 0)
+    channel_id = np.uint8(1) * false_mask
+    tau2_isolated = false_mask
+    leptons_os = false_mask
+    single_triggered = false_mask
+    cross_triggered = false_mask
+    empty_indices = ak.zeros_like(ak.num(events.Tau, axis=1), dtype=np.uint16)[..., None][..., :0]
+    sel_indices = {
+        "electron_indices": empty_indices,
+        "muon_indices": empty_indices,
+        "tau_indices": empty_indices,
+    }
+
+    for res in trigger_results:
+        accepted, is_iso, is_os = pair_decisions(events, res)
+        where = (channel_id == 0) & accepted
+        channel_id = ak.where(where, res.channel_id, channel_id)
+        tau2_isolated = ak.where(where, is_iso, tau2_isolated)
+        leptons_os = ak.where(where, is_os, leptons_os)
+        single_triggered = ak.where(where & (res.tag == "single_trigger"), True, single_triggered)
+        cross_triggered = ak.where(where & (res.tag == "cross_trigger"), True, cross_triggered)
+        names = ["tau_indices"]
+        if res.channel_id == CH_ETAU:
+            names.append("electron_indices")
+        elif res.channel_id == CH_MUTAU:
+            names.append("muon_indices")
+        for name in names:
+            sel_indices[name] = ak.where(where, res[name], sel_indices[name])
+
+    return DotDict(
+        channel_id=ak.values_astype(channel_id, np.uint8),
+        tau2_isolated=tau2_isolated,
+        leptons_os=ak.fill_none(leptons_os, False),
+        single_triggered=single_triggered,
+        cross_triggered=cross_triggered,
+        **{name: ak.values_astype(indices, np.int32) for name, indices in sel_indices.items()},
+    )
+
+
+def make_config() -> od.Config:
+    """
+    Creates a minimal config with the campaign information, channels and 2017 triggers that are
+    accessed by the lepton selection.
+    """
+    analysis = od.Analysis("test_analysis", 1)
+    campaign = od.Campaign("test_campaign", 1, aux={"year": 2017, "version": 9})
+    config = analysis.add_config(campaign)
+    config.add_channel(name="mutau", id=1)
+    config.add_channel(name="etau", id=2)
+    config.add_channel(name="tautau", id=3)
+    add_triggers_2017(config)
+    return config
+
+
+def make_events(config: od.Config, n_events: int, seed: int) -> tuple[ak.Array, dict[int, np.ndarray]]:
+    """
+    Creates a synthetic chunk of nano-like events with electrons, muons, taus and trigger objects,
+    and random HLT decisions per id of triggers in *config*. Most leptons are accompanied by a trigger object close
+    in delta R with random filter bits so that all trigger legs are matched frequently.
+    """
+    rng = np.random.default_rng(seed)
+
+    def leptons(counts: np.ndarray, pt_max: float, **fields) -> ak.Array:
+        n = counts.sum()
+        return ak.unflatten(
+            ak.zip({
+                "pt": rng.uniform(15.0, pt_max, n).astype(np.float32),
+                "eta": rng.uniform(-2.3, 2.3, n).astype(np.float32),
+                "phi": rng.uniform(-np.pi, np.pi, n).astype(np.float32),
+                "mass": rng.uniform(0.0, 2.0, n).astype(np.float32),
+                "charge": rng.choice([-1, 1], n).astype(np.int32),
+                "dz": rng.uniform(-0.22, 0.22, n).astype(np.float32),
+                **{name: func(n) for name, func in fields.items()},
+            }),
+            counts,
+        )
+
+    def trig_objs(objects: ak.Array, pdg_id: int) -> ak.Array:
+        objects = objects[ak.unflatten(rng.random(ak.sum(ak.num(objects))) < 0.8, ak.num(objects))]
+        n = ak.sum(ak.num(objects))
+        return ak.unflatten(
+            ak.zip({
+                "id": np.full(n, pdg_id, dtype=np.int32),
+                "pt": (np.asarray(ak.flatten(objects.pt)) * rng.uniform(0.9, 1.3, n)).astype(np.float32),
+                "eta": (np.asarray(ak.flatten(objects.eta)) + rng.normal(0.0, 0.1, n)).astype(np.float32),
+                "phi": (np.asarray(ak.flatten(objects.phi)) + rng.normal(0.0, 0.1, n)).astype(np.float32),
+                "filterBits": np.where(rng.random(n) < 0.8, 4095, rng.integers(0, 4096, n)).astype(np.int32),
+            }),
+            ak.num(objects),
+        )
+
+    def flags(p: float):
+        return lambda n: rng.random(n) < p
+
+    def tau_ids(wps: list[int]):
+        # prefer tighter working points
+        p = np.arange(1, len(wps) + 1) / (len(wps) * (len(wps) + 1) / 2)
+        return lambda n: rng.choice(wps, n, p=p).astype(np.uint8)
+
+    electrons = leptons(
+        rng.choice([0, 0, 1, 1, 2], n_events),
+        80.0,
+        dxy=lambda n: rng.uniform(-0.05, 0.05, n).astype(np.float32),
+        pfRelIso03_all=lambda n: rng.uniform(0.0, 0.4, n).astype(np.float32),
+        mvaFall17V2Iso_WP80=flags(0.9),
+        mvaFall17V2Iso_WP90=flags(0.8),
+        mvaFall17V2noIso_WP90=flags(0.8),
+    )
+    muons = leptons(
+        rng.choice([0, 0, 1, 1, 2], n_events),
+        80.0,
+        dxy=lambda n: rng.uniform(-0.05, 0.05, n).astype(np.float32),
+        pfRelIso04_all=lambda n: rng.uniform(0.0, 0.25, n).astype(np.float32),
+        mediumId=flags(0.9),
+        tightId=flags(0.9),
+    )
+    taus = leptons(
+        rng.integers(0, 5, n_events),
+        120.0,
+        idDeepTau2017v2p1VSe=tau_ids([0, 1, 3, 7, 15, 31, 63, 127, 255]),
+        idDeepTau2017v2p1VSmu=tau_ids([0, 1, 3, 7, 15]),
+        idDeepTau2017v2p1VSjet=tau_ids([0, 1, 3, 7, 15, 31, 63, 127, 255]),
+    )
+
+    # trigger objects close to leptons, and others with random ids and kinematics
+    counts = rng.integers(0, 3, n_events)
+    n = counts.sum()
+    other_objs = ak.unflatten(
+        ak.zip({
+            "id": rng.choice([1, 11, 13, 15], n).astype(np.int32),
+            "pt": rng.uniform(15.0, 150.0, n).astype(np.float32),
+            "eta": rng.uniform(-2.5, 2.5, n).astype(np.float32),
+            "phi": rng.uniform(-np.pi, np.pi, n).astype(np.float32),
+            "filterBits": rng.integers(0, 4096, n).astype(np.int32),
+        }),
+        counts,
+    )
+    trig_obj = ak.concatenate(
+        [trig_objs(electrons, 11), trig_objs(muons, 13), trig_objs(taus, 15), other_objs],
+        axis=1,
+    )
+
+    events = ak.Array({
+        "event": np.arange(n_events, dtype=np.uint64),
+        "Electron": electrons,
+        "Muon": muons,
+        "Tau": taus,
+        "TrigObj": trig_obj,
+    })
+
+    # random hlt decisions
+    hlt_fired = {
+        trigger.id: rng.random(n_events) < 0.7
+        for trigger in config.x.triggers
+    }
+
+    return events, hlt_fired
+
+
+def make_trigger_results(
+    events: ak.Array,
+    config: od.Config,
+    hlt_fired: dict[int, np.ndarray],
+) -> tuple[ak.Array, SelectionResult]:
+    """
+    Adds the "trigger_mask" column to *events* and returns them together with the trigger results
+    as created by the trigger selection.
+    """
+    triggers = list(config.x.triggers)
+    leg_cache = TriggerLegCache(events.TrigObj, [leg for trigger in triggers for leg in trigger.legs])
+    trigger_data = []
+    trigger_mask = np.zeros(len(events), dtype=np.uint64)
+    for trigger in triggers:
+        fired = hlt_fired[trigger.id] & leg_cache.all_legs_match(trigger.legs)
+        trigger_data.append((trigger, fired, [leg_cache.indices(leg) for leg in trigger.legs]))
+        trigger_mask[fired] |= trigger_word(config, trigger)
+
+    events = ak.with_field(events, trigger_mask, "trigger_mask")
+    return events, SelectionResult(aux={"trigger_data": trigger_data, "trigger_leg_cache": leg_cache})
+
+
+def baseline_trigger_data(
+    events: ak.Array,
+    config: od.Config,
+    hlt_fired: dict[int, np.ndarray],
+) -> list[tuple]:
+    """
+    Reference implementation of the previous trigger leg matching with awkward, returning the
+    trigger, the decision and trigger object indices per leg for each trigger.
+    """
+    index = ak.local_index(events.TrigObj)
+    trigger_data = []
+    for trigger in config.x.triggers:
+        leg_masks = []
+        all_legs_match = True
+        for leg in trigger.legs:
+            leg_mask = abs(events.TrigObj.id) >= 0
+            if leg.pdg_id is not None:
+                leg_mask = leg_mask & (abs(events.TrigObj.id) == leg.pdg_id)
+            if leg.min_pt is not None:
+                leg_mask = leg_mask & (events.TrigObj.pt >= leg.min_pt)
+            if leg.trigger_bits is not None:
+                for bits in leg.trigger_bits:
+                    leg_mask = leg_mask & ((events.TrigObj.filterBits & bits) > 0)
+            leg_masks.append(index[leg_mask])
+            all_legs_match = all_legs_match & ak.any(leg_mask, axis=1)
+        trigger_data.append((trigger, hlt_fired[trigger.id] & all_legs_match, leg_masks))
+    return trigger_data
+
+
+def baseline_matches(objects: ak.Array, trig_objs: ak.Array) -> ak.Array:
+    """
+    Reference implementation of the previous trigger object matching within a delta R of 0.25.
+    """
+    return ak.any(metric_table_reference(objects, trig_objs) < 0.25, axis=2)
+
+
+def baseline_electrons(events: ak.Array, trigger: Trigger, leg_masks: list[ak.Array]) -> tuple[ak.Array, ak.Array]:
+    """
+    Reference implementation of the previous electron selection for 2017, returning default and
+    veto electron indices.
+    """
+    electrons = events.Electron
+    sorted_indices = ak.argsort(electrons.pt, axis=-1, ascending=False)
+    default_indices = None
+    if trigger.has_tag({"single_e", "cross_e_tau"}):
+        default_mask = (
+            (electrons.mvaFall17V2Iso_WP80 == 1) &
+            (abs(electrons.eta) < 2.1) &
+            (abs(electrons.dxy) < 0.045) &
+            (abs(electrons.dz) < 0.2) &
+            (electrons.pt > (33.0 if trigger.has_tag("single_e") else 25.0)) &
+            baseline_matches(electrons, events.TrigObj[leg_masks[0]])
+        )
+        default_indices = ak.values_astype(sorted_indices[default_mask[sorted_indices]], np.int32)
+    veto_mask = (
+        (
+            (electrons.mvaFall17V2Iso_WP90 == 1) |
+            ((electrons.mvaFall17V2noIso_WP90 == 1) & (electrons.pfRelIso03_all < 0.3))
+        ) &
+        (abs(electrons.eta) < 2.5) &
+        (abs(electrons.dxy) < 0.045) &
+        (abs(electrons.dz) < 0.2) &
+        (electrons.pt > 10.0)
+    )
+    veto_indices = ak.values_astype(sorted_indices[veto_mask[sorted_indices]], np.int32)
+    return default_indices, veto_indices
+
+
+def baseline_muons(events: ak.Array, trigger: Trigger, leg_masks: list[ak.Array]) -> tuple[ak.Array, ak.Array]:
+    """
+    Reference implementation of the previous muon selection for 2017, returning default and veto
+    muon indices.
+    """
+    muons = events.Muon
+    sorted_indices = ak.argsort(muons.pt, axis=-1, ascending=False)
+    default_indices = None
+    if trigger.has_tag({"single_mu", "cross_mu_tau"}):
+        default_mask = (
+            (muons.tightId == 1) &
+            (abs(muons.eta) < 2.1) &
+            (abs(muons.dxy) < 0.045) &
+            (abs(muons.dz) < 0.2) &
+            (muons.pfRelIso04_all < 0.15) &
+            (muons.pt > (33.0 if trigger.has_tag("single_mu") else 25.0)) &
+            baseline_matches(muons, events.TrigObj[leg_masks[0]])
+        )
+        default_indices = ak.values_astype(sorted_indices[default_mask[sorted_indices]], np.int32)
+    veto_mask = (
+        (muons.mediumId == 1) &
+        (abs(muons.eta) < 2.4) &
+        (abs(muons.dxy) < 0.045) &
+        (abs(muons.dz) < 0.2) &
+        (muons.pfRelIso04_all < 0.3) &
+        (muons.pt > 10)
+    )
+    veto_indices = ak.values_astype(sorted_indices[veto_mask[sorted_indices]], np.int32)
+    return default_indices, veto_indices
+
+
+def baseline_taus(
+    events: ak.Array,
+    trigger: Trigger,
+    leg_masks: list[ak.Array],
+    electron_indices: ak.Array | None,
+    muon_indices: ak.Array | None,
+) -> tuple[ak.Array, ak.Array]:
+    """
+    Reference implementation of the previous tau selection for 2017 with nano v9 working points,
+    returning tau indices sorted by isolation and pt, and a mask of Medium isolated taus.
+    """
+    taus = events.Tau
+    is_any_cross_tau = trigger.has_tag({"cross_tau_tau", "cross_tau_tau_vbf"})
+    if trigger.has_tag({"single_e", "single_mu"}):
+        min_pt, max_eta = 20.0, 2.3
+    elif trigger.has_tag("cross_e_tau"):
+        min_pt, max_eta = 35.0, 2.1
+    elif trigger.has_tag("cross_mu_tau"):
+        min_pt, max_eta = 32.0, 2.1
+    elif trigger.has_tag("cross_tau_tau"):
+        min_pt, max_eta = 40.0, 2.1
+    else:
+        min_pt, max_eta = 25.0, 2.1
+
+    base_mask = (
+        (abs(taus.eta) < max_eta) &
+        (taus.pt > min_pt) &
+        (abs(taus.dz) < 0.2) &
+        (taus.idDeepTau2017v2p1VSe >= (2 if is_any_cross_tau else 4)) &
+        (taus.idDeepTau2017v2p1VSmu >= (1 if is_any_cross_tau else 8)) &
+        (taus.idDeepTau2017v2p1VSjet >= 8)
+    )
+    if electron_indices is not None:
+        base_mask = base_mask & ak.all(metric_table_reference(taus, events.Electron[electron_indices]) > 0.5, axis=2)
+    if muon_indices is not None:
+        base_mask = base_mask & ak.all(metric_table_reference(taus, events.Muon[muon_indices]) > 0.5, axis=2)
+    if trigger.has_tag({"cross_e_tau", "cross_mu_tau"}):
+        base_mask = base_mask & baseline_matches(taus, events.TrigObj[leg_masks[1]])
+    elif is_any_cross_tau:
+        matches_leg0 = baseline_matches(taus, events.TrigObj[leg_masks[0]])
+        matches_leg1 = baseline_matches(taus, events.TrigObj[leg_masks[1]])
+        base_mask = base_mask & (
+            (matches_leg0 | matches_leg1) &
+            ak.any(matches_leg0, axis=1) &
+            ak.any(matches_leg1, axis=1)
+        )
+
+    # combined sort key of isolation and pt
+    f = 10 ** (np.ceil(np.log10(ak.max(taus.pt))) + 1)
+    sorted_indices = ak.argsort(taus.idDeepTau2017v2p1VSjet * f + taus.pt, axis=-1, ascending=False)
+    base_indices = ak.values_astype(sorted_indices[base_mask[sorted_indices]], np.int32)
+    return base_indices, taus[base_indices].idDeepTau2017v2p1VSjet >= 16
+
+
+def baseline_lepton_selection(events: ak.Array, config: od.Config, trigger_data: list[tuple]) -> DotDict:
+    """
+    Reference implementation of the previous lepton selection that runs all object selections per
+    trigger and updates the results of each event with the first accepting trigger via ``ak.where``.
+    """
+    false_mask = abs(events.event) < 0
+    channel_id = np.uint8(1) * false_mask
+    tau2_isolated = false_mask
+    leptons_os = false_mask
+    single_triggered = false_mask
+    cross_triggered = false_mask
+    empty_indices = ak.zeros_like(1 * events.event, dtype=np.uint16)[..., None][..., :0]
+    sel_indices = {"Electron": empty_indices, "Muon": empty_indices, "Tau": empty_indices}
+
+    for trigger, trigger_fired, leg_masks in trigger_data:
+        electron_indices, electron_veto_indices = baseline_electrons(events, trigger, leg_masks)
+        muon_indices, muon_veto_indices = baseline_muons(events, trigger, leg_masks)
+        tau_indices, tau_iso_mask = baseline_taus(events, trigger, leg_masks, electron_indices, muon_indices)
+        taus = events.Tau[tau_indices]
+
+        if trigger.has_tag({"single_e", "cross_e_tau", "single_mu", "cross_mu_tau"}):
+            is_etau = trigger.has_tag({"single_e", "cross_e_tau"})
+            indices, veto_indices, other_veto_indices = (
+                (electron_indices, electron_veto_indices, muon_veto_indices)
+                if is_etau else
+                (muon_indices, muon_veto_indices, electron_veto_indices)
+            )
+            accepted = (
+                trigger_fired &
+                (ak.num(indices, axis=1) == 1) &
+                (ak.num(veto_indices, axis=1) == 1) &
+                (ak.num(other_veto_indices, axis=1) == 0) &
+                (ak.num(tau_indices, axis=1) >= 1)
+            )
+            is_iso = ak.sum(tau_iso_mask, axis=1) >= 1
+            light = events["Electron" if is_etau else "Muon"][indices]
+            is_os = ak.firsts(light.charge, axis=1) == -ak.firsts(taus.charge, axis=1)
+            ch = config.get_channel("etau" if is_etau else "mutau")
+            updates = {"Electron" if is_etau else "Muon": indices, "Tau": tau_indices}
+        else:
+            accepted = (
+                trigger_fired &
+                (ak.num(electron_veto_indices, axis=1) == 0) &
+                (ak.num(muon_veto_indices, axis=1) == 0) &
+                (ak.num(tau_indices, axis=1) >= 2) &
+                (ak.sum(tau_iso_mask, axis=1) >= 1)
+            )
+            if trigger.has_tag("cross_tau_tau_vbf"):
+                accepted = accepted & (ak.num(taus.pt > 40, axis=1) <= 1)
+            is_iso = ak.sum(tau_iso_mask, axis=1) >= 2
+            is_os = ak.firsts(taus.charge, axis=1) == -ak.firsts(taus.charge[..., 1:], axis=1)
+            ch = config.get_channel("tautau")
+            updates = {"Tau": tau_indices}
+
+        where = (channel_id == 0) & accepted
+        channel_id = ak.where(where, ch.id, channel_id)
+        tau2_isolated = ak.where(where, is_iso, tau2_isolated)
+        leptons_os = ak.where(where, is_os, leptons_os)
+        single_triggered = ak.where(where & trigger.has_tag("single_trigger"), True, single_triggered)
+        cross_triggered = ak.where(where & trigger.has_tag("cross_trigger"), True, cross_triggered)
+        for name, indices in updates.items():
+            sel_indices[name] = ak.where(where, indices, sel_indices[name])
+
+    return DotDict(
+        channel_id=ak.values_astype(channel_id, np.uint8),
+        tau2_isolated=tau2_isolated,
+        leptons_os=ak.fill_none(leptons_os, False),
+        single_triggered=single_triggered,
+        cross_triggered=cross_triggered,
+        **{name: ak.values_astype(indices, np.int32) for name, indices in sel_indices.items()},
+    )
+
+
+class LeptonSelectionTest(unittest.TestCase):
+
+    def test_resolve_lepton_pairs(self):
+        events, trigger_results = make_chunk(500, seed=123)
+
+        # build candidates as done in the lepton selection
+        candidates = []
+        for res in trigger_results:
+            accepted, is_iso, is_os = pair_decisions(events, res)
+            candidate = DotDict(
+                accepted=accepted,
+                is_iso=is_iso,
+                is_os=is_os,
+                channel_id=res.channel_id,
+                single=res.tag == "single_trigger",
+                cross=res.tag == "cross_trigger",
+                tau_indices=res.tau_indices,
+            )
+            if res.channel_id == CH_ETAU:
+                candidate.electron_indices = res.electron_indices
+            elif res.channel_id == CH_MUTAU:
+                candidate.muon_indices = res.muon_indices
+            candidates.append(candidate)
+
+        # the chunk must contain events accepted by triggers of different channels
+        accepted = np.stack([np.asarray(c.accepted) for c in candidates], axis=1)
+        channels = np.array([c.channel_id for c in candidates])
+        n_channels = np.array([len(set(channels[row])) for row in accepted])
+        self.assertTrue(np.any(n_channels > 1))
+        self.assertTrue(set(channels) == {CH_ETAU, CH_MUTAU, CH_TAUTAU})
+
+        pairs = resolve_lepton_pairs(candidates, len(events))
+        ref = first_match_lepton_pairs(events, trigger_results)
+
+        for name in [
+            "channel_id", "tau2_isolated", "leptons_os", "single_triggered", "cross_triggered",
+        ]:
+            self.assertEqual(np.asarray(pairs[name]).dtype, np.asarray(ref[name]).dtype, name)
+            self.assertEqual(np.asarray(pairs[name]).tolist(), np.asarray(ref[name]).tolist(), name)
+
+        for name in ["electron_indices", "muon_indices", "tau_indices"]:
+            self.assertEqual(str(ak.type(pairs[name])), str(ak.type(ref[name])), name)
+            self.assertEqual(pairs[name].tolist(), ref[name].tolist(), name)
+
+        # all channels must be selected in some events
+        self.assertTrue(set(np.unique(pairs.channel_id)) >= {CH_ETAU, CH_MUTAU, CH_TAUTAU})
+
+    def test_resolve_lepton_pairs_empty(self):
+        pairs = resolve_lepton_pairs([], 3)
+        self.assertEqual(pairs.channel_id.tolist(), [0, 0, 0])
+        self.assertEqual(pairs.tau_indices.tolist(), [[], [], []])
+
+    def run_lepton_selection(self, events: ak.Array, config: od.Config, hlt_fired: dict, **kwargs):
+        events, trigger_results = make_trigger_results(events, config, hlt_fired)
+        selector_inst = lepton_selection(inst_dict={"config_inst": config})
+        return selector_inst(events, trigger_results, **kwargs)
+
+    def assert_baseline_results(self, events: ak.Array, results: SelectionResult, ref: DotDict):
+        for name in [
+            "channel_id", "tau2_isolated", "leptons_os", "single_triggered", "cross_triggered",
+        ]:
+            self.assertEqual(np.asarray(events[name]).dtype, np.asarray(ref[name]).dtype, name)
+            self.assertEqual(np.asarray(events[name]).tolist(), np.asarray(ref[name]).tolist(), name)
+        self.assertEqual(np.asarray(results.steps.lepton).tolist(), np.asarray(ref.channel_id != 0).tolist())
+
+        for name in ["Electron", "Muon", "Tau"]:
+            indices = results.objects[name][name]
+            self.assertEqual(str(ak.type(indices)), str(ak.type(ref[name])), name)
+            self.assertEqual(indices.tolist(), ref[name].tolist(), name)
+
+    def test_lepton_selection(self):
+        config = make_config()
+        events, hlt_fired = make_events(config, 1000, seed=8)
+        ref = baseline_lepton_selection(events, config, baseline_trigger_data(events, config, hlt_fired))
+
+        # the chunk must contain all channels, selected by single and cross triggers
+        self.assertEqual(set(np.unique(ref.channel_id)), {0, 1, 2, 3})
+        self.assertTrue(np.any(ref.single_triggered) and np.any(ref.cross_triggered))
+        self.assertTrue(np.any(ref.tau2_isolated) and not np.all(ref.tau2_isolated))
+        self.assertTrue(np.any(ref.leptons_os) and not np.all(ref.leptons_os))
+
+        events, results = self.run_lepton_selection(events, config, hlt_fired)
+        self.assert_baseline_results(events, results, ref)
+
+    def test_lepton_selection_shift_cache(self):
+        # selecting the same chunk twice with a shared cache must reuse light lepton results
+        config = make_config()
+        events, hlt_fired = make_events(config, 200, seed=9)
+        ref = baseline_lepton_selection(events, config, baseline_trigger_data(events, config, hlt_fired))
+
+        shift_cache = {}
+        for _ in range(2):
+            _events, results = self.run_lepton_selection(events, config, hlt_fired, shift_cache=shift_cache)
+            self.assert_baseline_results(_events, results, ref)
+        self.assertEqual(set(shift_cache["light_leptons"].results), {trigger.id for trigger in config.x.triggers})